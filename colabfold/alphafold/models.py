@@ -1,11 +1,15 @@
+import logging
+import threading
 from pathlib import Path
 from functools import wraps, partialmethod
-from typing import Tuple, List, Optional
+from typing import Dict, Tuple, List, Optional
 import haiku
 from alphafold.model import model, config, data
 from alphafold.model.modules import AlphaFold
 from alphafold.model.modules_multimer import AlphaFold as AlphaFoldMultimer
 
+logger = logging.getLogger(__name__)
+
 def get_model_haiku_params(
     data_dir: str,
     model_type: str,
@@ -13,31 +17,14 @@ def get_model_haiku_params(
     use_fuse: bool = True,
     to_jnp: bool = True,
 ) -> haiku.Params:
-    """Get the Haiku parameters from a model type and number."""
-    import os
-    import numpy as np
-    from alphafold.model import utils
-    import jax.numpy as jnp
+    """Get the Haiku parameters from a model type and number.
 
-    is_deepfold = False
-    if model_type == "alphafold2_multimer_v1":
-        file = f"params_model_{model_number}_multimer.npz"
-    elif model_type == "alphafold2_multimer_v2":
-        file = f"params_model_{model_number}_multimer_v2.npz"
-    elif model_type == "alphafold2_multimer_v3":
-        file = f"params_model_{model_number}_multimer_v3.npz"
-    elif model_type == "alphafold2_ptm":
-        file = f"params_model_{model_number}_ptm.npz"
-    elif model_type == "alphafold2":
-        file = f"params_model_{model_number}.npz"
-    elif model_type == "deepfold_v1":
-        file = f"deepfold_model_{model_number}.npz"
-        is_deepfold = True
-    else:
-        raise ValueError(f"Unknown model_type {model_type}")
+    The arrays are read from the memory-mapped weights store of the model type, see
+    `colabfold.alphafold.weights`. With `to_jnp=False` they stay views of the store until used."""
+    from alphafold.model import utils
+    from colabfold.alphafold.weights import load_flat_params
 
-    path = os.path.join(data_dir, "params", file)
-    params = np.load(path, allow_pickle=False)
+    params = load_flat_params(Path(data_dir).joinpath("params"), model_type, model_number)
     return utils.flat_params_to_haiku(params, fuse=use_fuse, to_jnp=to_jnp)
 
 
@@ -77,14 +64,21 @@ def load_models_and_params(
     use_dropout: bool = False,
     save_all: bool = False,
     calc_extra_ptm: bool = False,
-    use_probs_extra: bool = True
+    use_probs_extra: bool = True,
+    lazy_params: bool = False,
 ) -> List[Tuple[str, model.RunModel, haiku.Params]]:
     """We use only two actual models and swap the parameters to avoid recompiling.
 
     Note that models 1 and 2 have a different number of parameters compared to models 3, 4 and 5,
     so we load model 1 and model 3.
+
+    With `lazy_params`, the parameters stay on the host and `predict_structure` copies only the
+    models it runs to the device, see `DeviceParams`.
     """
 
+    import jax
+    import jax.numpy as jnp
+
     # Use only two model and later swap params to avoid recompiling
     model_runner_and_params: [Tuple[str, model.RunModel, haiku.Params]] = []
 
@@ -103,6 +97,14 @@ def load_models_and_params(
     model_runner_and_params_build_order: [Tuple[str, model.RunModel, haiku.Params]] = []
     model_runner = None
     for model_number in model_build_order:
+        # loaded once, as views of the weights store
+        params = get_model_haiku_params(
+            model_type=model_type,
+            model_number=model_number,
+            data_dir=str(data_dir),
+            use_fuse=use_fuse,
+            to_jnp=False,
+        )
         if model_number in models_need_compilation:
             # get configurations
             config_name = model_to_config_name(model_type, model_number)
@@ -159,13 +161,6 @@ def load_models_and_params(
                 model_config.model.recycle_early_stop_tolerance = recycle_early_stop_tolerance
             
             # get model runner
-            params = get_model_haiku_params(
-                model_type=model_type,
-                model_number=model_number,
-                data_dir=str(data_dir),
-                use_fuse=use_fuse
-            )
-
             model_runner = model.RunModel(
                 model_config,
                 params,
@@ -173,16 +168,12 @@ def load_models_and_params(
                                      'use_probs_extended': use_probs_extra}
             )
         
-        params = get_model_haiku_params(
-            model_type=model_type,
-            model_number=model_number,
-            data_dir=str(data_dir),
-            use_fuse=use_fuse,
-        )
-        # keep only parameters of compiled model
+        # keep only parameters of compiled model, only these are copied to the device
         params_subset = {}
         for k in model_runner.params.keys():
-            params_subset[k] = params[k]
+            params_subset[k] = params[k] if lazy_params else jax.tree_util.tree_map(jnp.asarray, params[k])
+        if model_number in models_need_compilation:
+            model_runner.params = params_subset
 
         model_name = f"model_{model_number}"
         model_runner_and_params_build_order.append(
@@ -197,4 +188,112 @@ def load_models_and_params(
             if model_name == m[0]:
                 model_runner_and_params.append(m)
                 break
+    if lazy_params:
+        sizes = [params_nbytes(params) for _, _, params in model_runner_and_params]
+        logger.info(
+            f"Keeping the parameters of {len(sizes)} models on the host ({sum(sizes) / 2**20:.0f} MB), "
+            f"at most two are on the device at once ({sum(sorted(sizes)[-2:]) / 2**20:.0f} MB)"
+        )
     return model_runner_and_params
+
+
+def params_nbytes(params: haiku.Params) -> int:
+    import jax
+
+    return sum(leaf.nbytes for leaf in jax.tree_util.tree_leaves(params))
+
+
+def device_memory_stats() -> Optional[Dict[str, int]]:
+    """Memory statistics of the default device, None if the platform doesn't report them (CPU)"""
+    import jax
+
+    device = jax.config.jax_default_device or jax.local_devices()[0]
+    try:
+        return device.memory_stats()
+    except Exception:
+        return None
+
+
+class DeviceParams:
+    """Copies the parameters of one model at a time from the host to the default device, and those of
+    the next model while the current one runs. Only these two models are on the device, instead of
+    all of them."""
+
+    def __init__(self, model_runner_and_params: List[Tuple[str, model.RunModel, haiku.Params]]):
+        self.params = [params for _, _, params in model_runner_and_params]
+        self._device: Dict[int, haiku.Params] = {}
+        # the most bytes of parameters on the device at once
+        self.peak_nbytes = 0
+
+    def get(self, index: int, next_index: Optional[int] = None) -> haiku.Params:
+        """The parameters of model `index` on the device. Starts copying those of model `next_index`
+        and frees all others."""
+        import jax
+
+        keep = [index] if next_index is None else [index, next_index]
+        for i in list(self._device):
+            if i not in keep:
+                del self._device[i]
+        for i in keep:
+            if i not in self._device:
+                # returns immediately, the copy runs in the background
+                self._device[i] = jax.device_put(self.params[i])
+        self.peak_nbytes = max(self.peak_nbytes, sum(params_nbytes(params) for params in self._device.values()))
+        return self._device[index]
+
+    def release(self):
+        self._device.clear()
+
+
+class CompilationCacheStats:
+    """Counts hits and misses of the persistent XLA compilation cache, in total and per thread.
+
+    Jax compiles in the thread that calls a function, so `snapshot()` only counts the compilations
+    of the calling thread, e.g. of one device while the other devices compile their own models."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+
+    def _on_event(self, event: str, **kwargs):
+        if event == "/jax/compilation_cache/cache_hits":
+            with self._lock:
+                self.hits += 1
+            self._thread.hits = getattr(self._thread, "hits", 0) + 1
+        elif event == "/jax/compilation_cache/cache_misses":
+            with self._lock:
+                self.misses += 1
+            self._thread.misses = getattr(self._thread, "misses", 0) + 1
+
+    def snapshot(self) -> Tuple[int, int]:
+        """Hits and misses of the calling thread"""
+        return getattr(self._thread, "hits", 0), getattr(self._thread, "misses", 0)
+
+
+_compilation_cache_stats: Optional[CompilationCacheStats] = None
+
+
+def enable_compilation_cache(cache_dir: Path) -> CompilationCacheStats:
+    """Store compiled models on disk, so restarted or parallel processes don't compile them again.
+
+    Jax keys the entries by the computation, i.e. model config and input shapes, the device and
+    compile options. A subdirectory per jax/jaxlib version keeps stale entries apart."""
+    global _compilation_cache_stats
+    import jax
+    import jax.monitoring
+    import jaxlib
+
+    cache_dir = Path(cache_dir).joinpath(f"jax-{jax.__version__}-jaxlib-{jaxlib.__version__}")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", str(cache_dir))
+    # cache every compiled model, also small ones that compile quickly
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+
+    # listeners can't be removed, so only one is registered per process
+    if _compilation_cache_stats is None:
+        _compilation_cache_stats = CompilationCacheStats()
+        jax.monitoring.register_event_listener(_compilation_cache_stats._on_event)
+    return _compilation_cache_stats
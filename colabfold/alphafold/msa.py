@@ -1,6 +1,10 @@
-from typing import Mapping, Any
+import io
+from pathlib import Path
+from typing import Mapping, Any, Iterable, List, Optional, TextIO, Union
 import numpy as np
 
+from alphafold.common import residue_constants
+from alphafold.data import msa_identifiers
 from alphafold.model.features import FeatureDict
 from alphafold.model.tf import shape_placeholders
 
@@ -41,4 +45,242 @@ def make_fixed_size(
 
         if padding:
             feat[k] = np.pad(v, padding)
-    return feat
\ No newline at end of file
+    return feat
+
+# shapes of the multimer input features, which aren't described by the model config
+MULTIMER_FEATURE_SHAPES = {
+    "aatype": [NUM_RES],
+    "residue_index": [NUM_RES],
+    "seq_mask": [NUM_RES],
+    "asym_id": [NUM_RES],
+    "sym_id": [NUM_RES],
+    "entity_id": [NUM_RES],
+    "entity_mask": [NUM_RES],
+    "deletion_mean": [NUM_RES],
+    "all_atom_mask": [NUM_RES, None],
+    "all_atom_positions": [NUM_RES, None, None],
+    "msa": [NUM_MSA_SEQ, NUM_RES],
+    "msa_mask": [NUM_MSA_SEQ, NUM_RES],
+    "deletion_matrix": [NUM_MSA_SEQ, NUM_RES],
+    "bert_mask": [NUM_MSA_SEQ, NUM_RES],
+    "cluster_bias_mask": [NUM_MSA_SEQ],
+    "template_aatype": [NUM_TEMPLATES, NUM_RES],
+    "template_all_atom_mask": [NUM_TEMPLATES, NUM_RES, None],
+    "template_all_atom_positions": [NUM_TEMPLATES, NUM_RES, None, None],
+}
+
+def make_fixed_size_multimer(
+    feat: Mapping[str, Any],
+    num_res: int,
+    msa_size: int = 0,
+    num_templates: int = 0,
+) -> FeatureDict:
+    """Zero pad the multimer features to the given number of residues, MSA sequences and
+    templates. Padded residues and sequences are masked out through `seq_mask` and `msa_mask`,
+    padding of the `entity_id` is 0 as in the alphafold data pipeline."""
+    pad_size_map = {
+        NUM_RES: num_res,
+        NUM_MSA_SEQ: msa_size,
+        NUM_TEMPLATES: num_templates,
+    }
+    feat = dict(feat)
+    for k, schema in MULTIMER_FEATURE_SHAPES.items():
+        if k not in feat:
+            continue
+        v = feat[k]
+        assert v.ndim == len(schema), (
+            f"Rank mismatch between shape and shape schema for {k}: "
+            f"{v.shape} vs {schema}"
+        )
+        padding = [(0, max(pad_size_map.get(s, 0) - n, 0)) for n, s in zip(v.shape, schema)]
+        if any(p > 0 for _, p in padding):
+            feat[k] = np.pad(v, padding)
+    return feat
+
+# HHBLITS_AA_TO_ID as a lookup table over bytes, -1 for characters that aren't allowed in an alignment
+_A3M_TO_ID = np.full(256, -1, dtype=np.int32)
+for _res, _id in residue_constants.HHBLITS_AA_TO_ID.items():
+    _A3M_TO_ID[ord(_res)] = _id
+
+class _A3mFeatureBuilder:
+    """Collects aligned a3m sequences into preallocated MSA and deletion matrices, which grow in
+    place by at least `chunk_size` rows at a time."""
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.msa = None
+        self.deletion_matrix = None
+        self.species_ids = []
+        self.descriptions = []
+        # insertions after the last aligned residue, which count as deletions of the next chain in a complex
+        self.trailing_insertions = []
+        self.num_alignments = 0
+
+    def add(self, description: str, sequence: List[str]):
+        data = np.frombuffer("".join(sequence).encode(), dtype=np.uint8)
+        is_insertion = (data >= ord("a")) & (data <= ord("z"))
+        aligned = _A3M_TO_ID[data[~is_insertion]]
+        if np.any(aligned < 0):
+            invalid = sorted(set(bytes(data[~is_insertion][aligned < 0]).decode(errors="replace")))
+            raise ValueError(f"Invalid characters {invalid} in MSA sequence {description}")
+        # number of insertions in front of each aligned residue, trailing insertions are dropped
+        insertions = np.cumsum(is_insertion, dtype=np.int32)[~is_insertion]
+        deletions = np.diff(insertions, prepend=0)
+
+        if self.msa is None:
+            # the model input pipeline expects the int32 MSA of make_msa_features
+            self.msa = np.empty((self.chunk_size, len(aligned)), dtype=np.int32)
+            self.deletion_matrix = np.empty((self.chunk_size, len(aligned)), dtype=np.int32)
+        num_res = self.msa.shape[1]
+        if len(aligned) != num_res:
+            raise ValueError(
+                f"MSA sequence {description} has {len(aligned)} aligned residues, "
+                f"expected {num_res} as in the query"
+            )
+        if self.num_alignments == len(self.msa):
+            self._resize(len(self.msa) + max(self.chunk_size, len(self.msa)))
+        self.msa[self.num_alignments] = aligned
+        self.deletion_matrix[self.num_alignments] = deletions
+        species_id = msa_identifiers.get_identifiers(description).species_id
+        self.species_ids.append(species_id.encode("utf-8"))
+        self.descriptions.append(description)
+        trailing_insertions = len(data) - len(aligned) - (int(insertions[-1]) if len(aligned) > 0 else 0)
+        self.trailing_insertions.append(trailing_insertions)
+        self.num_alignments += 1
+
+    def _resize(self, num_rows: int):
+        # the buffers are never shared, resizing reallocates them without an extra copy
+        self.msa.resize((num_rows, self.msa.shape[1]), refcheck=False)
+        self.deletion_matrix.resize((num_rows, self.deletion_matrix.shape[1]), refcheck=False)
+
+    def features(self) -> FeatureDict:
+        num_res = self.msa.shape[1]
+        return {
+            "deletion_matrix_int": self.deletion_matrix,
+            "msa": self.msa,
+            "num_alignments": np.array([self.num_alignments] * num_res, dtype=np.int32),
+            "msa_species_identifiers": np.array(self.species_ids, dtype=np.object_),
+        }
+
+def parse_a3m_features(
+    a3m: Union[str, Path, TextIO, Iterable[str]],
+    max_seqs: Optional[int] = None,
+    chunk_size: int = 1024,
+) -> FeatureDict:
+    """Build the MSA features of `pipeline.make_msa_features([parsers.parse_a3m(a3m)])` while
+    reading the a3m line by line, without keeping the sequences as python strings and lists.
+
+    :param a3m: The a3m content as string, the path of an a3m file or an open text file
+    :param max_seqs: Only read the first `max_seqs` sequences
+    :param chunk_size: Minimum number of rows the feature matrices grow by
+    """
+    return _read_a3m(a3m, max_seqs, chunk_size).features()
+
+def _read_a3m(
+    a3m: Union[str, Path, TextIO, Iterable[str]],
+    max_seqs: Optional[int] = None,
+    chunk_size: int = 1024,
+) -> _A3mFeatureBuilder:
+    if isinstance(a3m, Path):
+        with a3m.open() as f:
+            return _read_a3m(f, max_seqs, chunk_size)
+    if isinstance(a3m, str):
+        a3m = io.StringIO(a3m)
+
+    builder = _A3mFeatureBuilder(chunk_size)
+    description = None
+    sequence = []
+    for line in a3m:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            if description is not None:
+                builder.add(description, sequence)
+                if max_seqs is not None and builder.num_alignments >= max_seqs:
+                    description = None
+                    break
+            description = line[1:]
+            sequence = []
+        elif description is not None:
+            # sequences can span several lines
+            sequence.append(line)
+        elif not line.startswith("#"):
+            raise ValueError(f"a3m sequence without a header: {line[:50]}")
+    if description is not None and (max_seqs is None or builder.num_alignments < max_seqs):
+        builder.add(description, sequence)
+    if builder.num_alignments == 0:
+        raise ValueError("MSA must contain at least one sequence.")
+    builder._resize(builder.num_alignments)
+    return builder
+
+def make_complex_msa_features(
+    query_seqs_unique: List[str],
+    query_seqs_cardinality: List[int],
+    paired_msa: Optional[List[str]],
+    unpaired_msa: Optional[List[str]],
+) -> FeatureDict:
+    """Build the MSA features of a complex for the monomer models, the same as parsing the query
+    of the whole complex followed by `colabfold.input.pair_msa`. The paired rows and the gap padded,
+    block diagonal unpaired rows are written directly into the feature matrices, without building
+    and parsing the padded a3m, which grows quadratically with the number of chains."""
+    if paired_msa is None and unpaired_msa is None:
+        raise ValueError("Invalid pairing")
+    chains = [n for n, cardinality in enumerate(query_seqs_cardinality) for _ in range(cardinality)]
+    offsets = np.cumsum([0] + [len(query_seqs_unique[n]) for n in chains]).tolist()
+    num_res = offsets[-1]
+
+    def read_chain_msas(msas):
+        # homo-oligomers can have an msa per copy, only the first of each unique chain is used
+        chain_msas = [_read_a3m(msa) for msa in msas[: len(query_seqs_unique)]]
+        for n, chain_msa in enumerate(chain_msas):
+            if chain_msa.msa.shape[1] != len(query_seqs_unique[n]):
+                raise ValueError(
+                    f"MSA of chain {n} has {chain_msa.msa.shape[1]} aligned residues, "
+                    f"expected {len(query_seqs_unique[n])} as in the query"
+                )
+        return chain_msas
+
+    paired = read_chain_msas(paired_msa) if paired_msa is not None else []
+    unpaired = read_chain_msas(unpaired_msa) if unpaired_msa is not None else []
+    num_paired = paired[0].num_alignments if paired else 0
+    if any(chain_msa.num_alignments != num_paired for chain_msa in paired):
+        raise ValueError("All chains of a paired MSA need the same number of sequences")
+    num_unpaired = sum(unpaired[n].num_alignments for n in chains) if unpaired else 0
+    num_alignments = 1 + num_paired + num_unpaired
+
+    msa = np.full((num_alignments, num_res), residue_constants.HHBLITS_AA_TO_ID["-"], dtype=np.int32)
+    deletion_matrix = np.zeros((num_alignments, num_res), dtype=np.int32)
+    full_sequence = "".join(query_seqs_unique[n] for n in chains)
+    msa[0] = _A3M_TO_ID[np.frombuffer(full_sequence.encode(), dtype=np.uint8)]
+    species_ids = [b""]
+
+    if paired:
+        rows = slice(1, 1 + num_paired)
+        for k, n in enumerate(chains):
+            msa[rows, offsets[k] : offsets[k + 1]] = paired[n].msa
+            deletion_matrix[rows, offsets[k] : offsets[k + 1]] = paired[n].deletion_matrix
+        # insertions at the end of a chain are deletions in front of the next chain
+        for k, n in enumerate(chains[:-1]):
+            deletion_matrix[rows, offsets[k + 1]] += paired[n].trailing_insertions
+        for descriptions in zip(*[chain_msa.descriptions for chain_msa in paired]):
+            # the species of the paired headers joined by tabs
+            species_id = msa_identifiers.get_identifiers("\t".join(descriptions)).species_id
+            species_ids.append(species_id.encode("utf-8"))
+
+    row = 1 + num_paired
+    for k, n in enumerate(chains if unpaired else []):
+        rows = slice(row, row + unpaired[n].num_alignments)
+        msa[rows, offsets[k] : offsets[k + 1]] = unpaired[n].msa
+        deletion_matrix[rows, offsets[k] : offsets[k + 1]] = unpaired[n].deletion_matrix
+        if offsets[k + 1] < num_res:
+            deletion_matrix[rows, offsets[k + 1]] += unpaired[n].trailing_insertions
+        species_ids.extend(unpaired[n].species_ids)
+        row = rows.stop
+
+    return {
+        "deletion_matrix_int": deletion_matrix,
+        "msa": msa,
+        "num_alignments": np.array([num_alignments] * num_res, dtype=np.int32),
+        "msa_species_identifiers": np.array(species_ids, dtype=np.object_),
+    }
@@ -0,0 +1,205 @@
+"""
+Memory-mapped store of the model parameters of a model type.
+
+The `params_model_*.npz` files of the five models of a model type are converted once into a single
+uncompressed file `params/<model_type>.weights`: the raw arrays, each aligned to 64 bytes, followed
+by a json manifest with the name, dtype, shape and offset of every array. Loading maps the file
+read-only, so the arrays are views into the page cache that are only read from disk when they are
+used, and processes on the same node share the pages instead of each reading its own copy.
+
+The manifest also records the size and modification time of the npz files, the store is rebuilt
+when one of them changes or a model is added.
+"""
+
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# bump when the layout of the store changes
+WEIGHTS_STORE_VERSION = 1
+WEIGHTS_STORE_MAGIC = b"CFWEIGHT"
+# manifest length and magic at the end of the file
+_TRAILER = struct.Struct("<Q8s")
+_ALIGNMENT = 64
+MODEL_NUMBERS = [1, 2, 3, 4, 5]
+
+
+def params_file(model_type: str, model_number: Union[int, str]) -> str:
+    """The npz file name of the parameters of a model"""
+    if model_type == "alphafold2_multimer_v1":
+        return f"params_model_{model_number}_multimer.npz"
+    elif model_type == "alphafold2_multimer_v2":
+        return f"params_model_{model_number}_multimer_v2.npz"
+    elif model_type == "alphafold2_multimer_v3":
+        return f"params_model_{model_number}_multimer_v3.npz"
+    elif model_type == "alphafold2_ptm":
+        return f"params_model_{model_number}_ptm.npz"
+    elif model_type == "alphafold2":
+        return f"params_model_{model_number}.npz"
+    elif model_type == "deepfold_v1":
+        return f"deepfold_model_{model_number}.npz"
+    else:
+        raise ValueError(f"Unknown model_type {model_type}")
+
+
+def weights_store_path(params_dir: Path, model_type: str) -> Path:
+    return params_dir.joinpath(f"{model_type}.weights")
+
+
+def _sources(params_dir: Path, model_type: str) -> Dict[str, list]:
+    """Size and modification time of the existing npz files of a model type"""
+    sources = {}
+    for model_number in MODEL_NUMBERS:
+        path = params_dir.joinpath(params_file(model_type, model_number))
+        if path.is_file():
+            stat = path.stat()
+            sources[str(model_number)] = [path.name, stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+def build_weights_store(params_dir: Path, model_type: str) -> Path:
+    """Convert the npz files of a model type into its weights store. The store is written to a
+    temporary file and moved in place, so concurrent readers only ever see a complete store."""
+    params_dir = Path(params_dir)
+    path = weights_store_path(params_dir, model_type)
+    sources = _sources(params_dir, model_type)
+    if not sources:
+        raise FileNotFoundError(f"No parameters of {model_type} in {params_dir}")
+
+    # models whose npz file was removed after an earlier conversion are kept
+    previous = read_manifest(path)
+    kept = {}
+    if previous is not None:
+        kept = {number: source for number, source in previous["sources"].items() if number not in sources}
+    old_store = WeightsStore(path, previous) if kept else None
+
+    models = {}
+    fd, tmp_path = tempfile.mkstemp(dir=params_dir, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            offset = 0
+            for model_number in sorted({**sources, **kept}, key=int):
+                if model_number in kept:
+                    arrays = old_store.arrays(model_number)
+                else:
+                    with np.load(params_dir.joinpath(sources[model_number][0]), allow_pickle=False) as npz:
+                        arrays = {key: npz[key] for key in npz.files}
+                models[model_number] = {}
+                for key, array in arrays.items():
+                    array = np.ascontiguousarray(array)
+                    padding = -offset % _ALIGNMENT
+                    f.write(b"\0" * padding)
+                    offset += padding
+                    models[model_number][key] = [array.dtype.str, list(array.shape), offset]
+                    f.write(array.tobytes())
+                    offset += array.nbytes
+            manifest = json.dumps({
+                "version": WEIGHTS_STORE_VERSION,
+                "model_type": model_type,
+                "sources": {**sources, **kept},
+                "models": models,
+            }).encode()
+            f.write(manifest)
+            f.write(_TRAILER.pack(len(manifest), WEIGHTS_STORE_MAGIC))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def read_manifest(path: Path) -> Optional[dict]:
+    """The manifest of a weights store, None if it doesn't exist or is not a store of this version"""
+    try:
+        with path.open("rb") as f:
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            length, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != WEIGHTS_STORE_MAGIC:
+                return None
+            f.seek(-_TRAILER.size - length, os.SEEK_END)
+            manifest = json.loads(f.read(length))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"Could not read the weights store {path}: {e}")
+        return None
+    if manifest.get("version") != WEIGHTS_STORE_VERSION:
+        return None
+    return manifest
+
+
+def _is_current(manifest: dict, sources: Dict[str, list]) -> bool:
+    # the npz files may be removed after the conversion to save space, only changed or added ones count
+    return all(manifest["sources"].get(number) == source for number, source in sources.items())
+
+
+class WeightsStore:
+    """A weights store mapped into memory. The arrays are read-only views of the mapped file."""
+
+    def __init__(self, path: Union[str, Path], manifest: Optional[dict] = None):
+        self.path = Path(path)
+        manifest = manifest or read_manifest(self.path)
+        if manifest is None:
+            raise ValueError(f"{self.path} is not a weights store")
+        self.manifest = manifest
+        # maps the file as it is now, a store that is replaced later stays valid
+        self._data = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, model_number: Union[int, str]) -> bool:
+        return str(model_number) in self.manifest["models"]
+
+    def arrays(self, model_number: Union[int, str]) -> Dict[str, np.ndarray]:
+        """The flat parameters of a model like in its npz file, without reading or copying them"""
+        arrays = {}
+        for key, (dtype, shape, offset) in self.manifest["models"][str(model_number)].items():
+            arrays[key] = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=self._data, offset=offset)
+        return arrays
+
+
+_stores: Dict[Path, WeightsStore] = {}
+_stores_lock = threading.Lock()
+
+
+def open_weights_store(params_dir: Path, model_type: str) -> WeightsStore:
+    """The weights store of a model type, built from the npz files if it's missing or outdated.
+    A store is mapped once per process and shared by all models loaded from it."""
+    params_dir = Path(params_dir)
+    path = weights_store_path(params_dir, model_type)
+    sources = _sources(params_dir, model_type)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is not None and _is_current(store.manifest, sources):
+            return store
+        manifest = read_manifest(path)
+        if manifest is None or not _is_current(manifest, sources):
+            logger.info(f"Converting the {model_type} parameters into {path}")
+            build_weights_store(params_dir, model_type)
+            manifest = read_manifest(path)
+        store = WeightsStore(path, manifest)
+        _stores[path] = store
+        return store
+
+
+def load_flat_params(params_dir: Path, model_type: str, model_number: Union[int, str]) -> Dict[str, np.ndarray]:
+    """The flat parameters of a model, from the weights store if possible and from the npz file
+    otherwise, e.g. if the params directory is read-only and has no store"""
+    params_dir = Path(params_dir)
+    npz_file = params_dir.joinpath(params_file(model_type, model_number))
+    try:
+        store = open_weights_store(params_dir, model_type)
+        if model_number in store:
+            return store.arrays(model_number)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not use a weights store for {model_type}, loading the npz files: {e}")
+    return dict(np.load(npz_file, allow_pickle=False))
@@ -9,6 +9,8 @@ import warnings
 from Bio import BiopythonDeprecationWarning # what can possibly go wrong...
 warnings.simplefilter(action='ignore', category=BiopythonDeprecationWarning)
 
+import asyncio
+import bisect
 import json
 import logging
 import math
@@ -18,10 +20,14 @@ import zipfile
 import shutil
 import pickle
 import gzip
+import queue
+import threading
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, Union, TYPE_CHECKING
 from io import StringIO
 
 import importlib_metadata
@@ -42,8 +48,8 @@ if TYPE_CHECKING:
     import haiku
     from alphafold.model import model
     from numpy import ndarray
+    from colabfold.mmseqs.cache import MsaCache
 
-from alphafold.common.protein import Protein
 from alphafold.data import (
     feature_processing,
     msa_pairing,
@@ -57,7 +63,6 @@ from colabfold.download import default_data_dir, download_alphafold_params
 from colabfold.utils import (
     ACCEPT_DEFAULT_TERMS,
     DEFAULT_API_SERVER,
-    NO_GPU_FOUND,
     CIF_REVISION_DATE,
     get_commit,
     setup_logging,
@@ -65,7 +70,6 @@ from colabfold.utils import (
     AF3Utils,
 )
 from colabfold.input import (
-    pair_msa,
     msa_to_str,
     get_queries,
     safe_filename,
@@ -297,6 +301,213 @@ def pad_input(
     )  # template_mask (4, 4) second value
     return input_fix
 
+def pad_input_multimer(
+    input_features: model.features.FeatureDict,
+    pad_len: int,
+    num_templates: int = 4,
+) -> model.features.FeatureDict:
+    from colabfold.alphafold.msa import make_fixed_size_multimer
+
+    # the multimer model samples the MSA itself, so its depth is padded to the next power of two
+    # to compile a few MSA shapes only
+    msa_size = 1 << max(int(input_features["msa"].shape[0]) - 1, 0).bit_length()
+    return make_fixed_size_multimer(
+        input_features,
+        num_res=pad_len,
+        msa_size=msa_size,
+        num_templates=num_templates,
+    )
+
+def unpad_extra_ptm_inputs(
+    result: Dict[str, Any], asym_id: np.ndarray, seq_len: int
+) -> Tuple[Dict[str, Any], np.ndarray]:
+    """The result and asym_id of a padded input cut to the `seq_len` residues of the query, for
+    `extra_ptm.get_chain_and_interface_metrics`. The padding has asym_id 0 and would otherwise be
+    counted as part of the first chain."""
+
+    def unpad_logits(output: Dict[str, Any]) -> Dict[str, Any]:
+        output = {**output, "logits": output["logits"][:seq_len, :seq_len]}
+        if "asym_id" in output:
+            output["asym_id"] = output["asym_id"][:seq_len]
+        return output
+
+    unpadded = {"distogram": unpad_logits(result["distogram"])}
+    pae = result["predicted_aligned_error"]
+    unpadded["predicted_aligned_error"] = pae[:seq_len, :seq_len] if isinstance(pae, np.ndarray) else unpad_logits(pae)
+    if "pae_matrix_with_logits" in result:
+        unpadded["pae_matrix_with_logits"] = unpad_logits(result["pae_matrix_with_logits"])
+    return unpadded, asym_id[..., :seq_len]
+
+def get_length_buckets(
+    lengths: List[int],
+    compile_cost: float = 10.0,
+    runs_per_query: int = 1,
+) -> List[int]:
+    """Choose the lengths to pad queries to, so that models are compiled once per bucket.
+
+    The prediction cost of a query padded to length L is estimated as (L / 256)^2 per model run and
+    one compilation costs as much as `compile_cost` runs of a 256 residue query. The buckets
+    minimizing the total cost are found by dynamic programming over the sorted distinct lengths."""
+    counts = Counter(lengths)
+    unique = sorted(counts)
+    # best[j]: cost of the j shortest distinct lengths, split[j]: start of the last bucket
+    best = [0.0] * (len(unique) + 1)
+    split = [0] * (len(unique) + 1)
+    for j in range(1, len(unique) + 1):
+        bucket_cost = runs_per_query * (unique[j - 1] / 256) ** 2
+        best[j] = math.inf
+        num_queries = 0
+        for i in range(j, 0, -1):
+            num_queries += counts[unique[i - 1]]
+            cost = best[i - 1] + compile_cost + num_queries * bucket_cost
+            if cost < best[j]:
+                best[j], split[j] = cost, i - 1
+    buckets = []
+    j = len(unique)
+    while j > 0:
+        buckets.append(unique[j - 1])
+        j = split[j]
+    return buckets[::-1]
+
+def run_on_devices(
+    jobs: List[Any],
+    workers: List[Dict[str, Any]],
+    process_job: Callable[[int, Any, Dict[str, Any]], None],
+):
+    """Process the jobs in order with `process_job(job_index, job, worker)`. With more than one worker,
+    each worker takes the next job from a shared queue in its own thread, with its device as the default
+    jax device, so the models of each worker are placed on and run on its device."""
+    if len(workers) == 1:
+        for job_index, job in enumerate(jobs):
+            process_job(job_index, job, workers[0])
+        return
+
+    import jax
+
+    job_queue = queue.Queue()
+    for job_index, job in enumerate(jobs):
+        job_queue.put((job_index, job))
+
+    def work(worker: Dict[str, Any]):
+        with jax.default_device(worker["device"]):
+            while True:
+                try:
+                    job_index, job = job_queue.get_nowait()
+                except queue.Empty:
+                    return
+                process_job(job_index, job, worker)
+
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        # result() re-raises exceptions of the workers
+        for future in [executor.submit(work, worker) for worker in workers]:
+            future.result()
+
+class background_writer:
+    """Writes result files in background threads, so the next model can start predicting.
+
+    At most `max_pending` writes are queued, `submit` blocks beyond that to bound the memory held by
+    pending results. `flush` waits for all writes and re-raises the first error of a failed write."""
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures: List[Future] = []
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        # fail early instead of after the last model
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+def write_pdb(unrelaxed_protein: protein.Protein, path: Path) -> str:
+    protein_lines = protein.to_pdb(unrelaxed_protein)
+    path.write_text(protein_lines)
+    return protein_lines
+
+def write_pickle(obj: Any, path: Path):
+    with path.open("wb") as handle:
+        pickle.dump(obj, handle)
+
+def write_scores(
+    paths: List[Path],
+    plddt: np.ndarray,
+    pae: Optional[np.ndarray],
+    conf: Dict[str, Any],
+    extra_ptm_output: Optional[Dict[str, Any]],
+):
+    """Write pLDDT, PAE and the summary scores of a model as json and/or as npz, depending on the suffix
+    of each path. The npz format stores pLDDT and PAE as float32 arrays, which is much smaller and faster
+    to write and read than the json lists for long sequences, see `read_scores`. Unlike the json format,
+    the values aren't rounded to two decimals."""
+    for path in paths:
+        if path.suffix == ".npz":
+            scores = {"plddt": plddt.astype(np.float32)}
+            if pae is not None:
+                scores.update({"max_pae": np.asarray(pae.max(), dtype=np.float32),
+                               "pae": pae.astype(np.float32)})
+                for k in ["ptm","iptm"]:
+                    if k in conf: scores[k] = np.asarray(conf[k], dtype=np.float32)
+                if extra_ptm_output is not None:
+                    # nested per chain metrics
+                    scores["extra_ptm"] = np.asarray(json.dumps(extra_ptm_output))
+            np.savez(path, **scores)
+            continue
+
+        # write an easy-to-use format (pAE and pLDDT)
+        scores = {"plddt": np.around(plddt.astype(float), 2).tolist()}
+        if pae is not None:
+          scores.update({"max_pae": pae.max().astype(float).item(),
+                         "pae": np.around(pae.astype(float), 2).tolist()})
+          if extra_ptm_output is not None:
+            scores.update(extra_ptm_output)
+          for k in ["ptm","iptm"]:
+            if k in conf: scores[k] = np.around(conf[k], 2).item()
+        with path.open("w") as handle:
+            json.dump(scores, handle)
+
+def read_scores(path: Union[str, Path]) -> Dict[str, Any]:
+    """Read the scores written by `write_scores`. pLDDT and PAE are returned as numpy arrays,
+    for both the json and the npz format."""
+    path = Path(path)
+    if path.suffix == ".npz":
+        with np.load(path) as npz:
+            scores = {}
+            for k in npz.files:
+                if k == "extra_ptm":
+                    scores.update(json.loads(npz[k].item()))
+                elif npz[k].ndim == 0:
+                    scores[k] = npz[k].item()
+                else:
+                    scores[k] = npz[k].astype(np.float32)
+        return scores
+
+    with path.open("r") as handle:
+        scores = json.load(handle)
+    for k in ["plddt", "pae"]:
+        if k in scores:
+            scores[k] = np.asarray(scores[k])
+    return scores
+
 class file_manager:
     def __init__(self, prefix: str, result_dir: Path):
         self.prefix = prefix
@@ -342,8 +553,17 @@ def predict_structure(
     save_recycles: bool = False,
     calc_extra_ptm: bool = False,
     use_probs_extra: bool = True,
+    scores_format: str = "json",
+    lazy_params: bool = False,
+    pad_multimer: bool = False,
 ):
-    """Predicts structure using AlphaFold for the given sequence."""
+    """Predicts structure using AlphaFold for the given sequence.
+
+    With `lazy_params`, the params of `model_runner_and_params` are on the host and only the model that
+    runs and the next one are copied to the device. Multimer inputs are only padded to `pad_len` with
+    `pad_multimer`, i.e. with length buckets."""
+    from colabfold.alphafold.models import DeviceParams, device_memory_stats, params_nbytes
+
     mean_scores = []
     conf = []
     unrelaxed_pdb_lines = []
@@ -351,175 +571,207 @@ def predict_structure(
     model_names = []
     files = file_manager(prefix, result_dir)
     seq_len = sum(sequences_lengths)
+    device_params = DeviceParams(model_runner_and_params) if lazy_params else None
 
-    # iterate through random seeds
-    for seed_num, seed in enumerate(range(random_seed, random_seed+num_seeds)):
-
-        # iterate through models
-        for model_num, (model_name, model_runner, params) in enumerate(model_runner_and_params):
+    writer = background_writer()
+    try:
+        # iterate through random seeds
+        for seed_num, seed in enumerate(range(random_seed, random_seed+num_seeds)):
 
-            # swap params to avoid recompiling
-            model_runner.params = params
+            # iterate through models
+            for model_num, (model_name, model_runner, params) in enumerate(model_runner_and_params):
 
-            #########################
-            # process input features
-            #########################
-            if "multimer" in model_type:
-                if model_num == 0 and seed_num == 0:
-                    # TODO: add pad_input_mulitmer()
-                    input_features = feature_dict
-                    input_features["asym_id"] = input_features["asym_id"] - input_features["asym_id"][...,0]
-            else:
-                if model_num == 0:
-                    input_features = model_runner.process_features(feature_dict, random_seed=seed)
-                    r = input_features["aatype"].shape[0]
-                    input_features["asym_id"] = np.tile(feature_dict["asym_id"],r).reshape(r,-1)
-                    if seq_len < pad_len:
-                        input_features = pad_input(input_features, model_runner,
-                            model_name, pad_len, use_templates)
-                        logger.info(f"Padding length to {pad_len}")
-
-
-            tag = f"{model_type}_{model_name}_seed_{seed:03d}"
-            model_names.append(tag)
-            files.set_tag(tag)
-
-            # initial guess
-            if initial_guess:
-                input_guess = Path(initial_guess)
-                if input_guess.suffix == ".pdb":
-                    pdb_string = pdb_to_string(initial_guess)
-                    input_features["all_atom_positions"] = protein.from_pdb_string(pdb_string).atom_positions
-                elif input_guess.suffix == ".cif":
-                    input_features["all_atom_positions"] = protein.from_mmcif_string(input_guess.read_text()).atom_positions
+                # swap params to avoid recompiling
+                if device_params is None:
+                    model_runner.params = params
+                else:
+                    if model_num + 1 < len(model_runner_and_params):
+                        next_num = model_num + 1
+                    else:
+                        next_num = 0 if seed_num + 1 < num_seeds else None
+                    model_runner.params = device_params.get(model_num, next_num)
+
+                #########################
+                # process input features
+                #########################
+                if "multimer" in model_type:
+                    if model_num == 0 and seed_num == 0:
+                        input_features = feature_dict
+                        input_features["asym_id"] = input_features["asym_id"] - input_features["asym_id"][...,0]
+                        if pad_multimer and seq_len <= pad_len:
+                            input_features = pad_input_multimer(input_features, pad_len)
+                            if seq_len < pad_len:
+                                logger.info(f"Padding length to {pad_len}")
                 else:
-                    raise ValueError(f"Unsupported initial guess file format: {initial_guess}")
+                    if model_num == 0:
+                        input_features = model_runner.process_features(feature_dict, random_seed=seed)
+                        r = input_features["aatype"].shape[0]
+                        input_features["asym_id"] = np.tile(feature_dict["asym_id"],r).reshape(r,-1)
+                        if seq_len < pad_len:
+                            input_features = pad_input(input_features, model_runner,
+                                model_name, pad_len, use_templates)
+                            logger.info(f"Padding length to {pad_len}")
+
+
+                tag = f"{model_type}_{model_name}_seed_{seed:03d}"
+                model_names.append(tag)
+                files.set_tag(tag)
+
+                # initial guess
+                if initial_guess:
+                    input_guess = Path(initial_guess)
+                    if input_guess.suffix == ".pdb":
+                        pdb_string = pdb_to_string(initial_guess)
+                        input_features["all_atom_positions"] = protein.from_pdb_string(pdb_string).atom_positions
+                    elif input_guess.suffix == ".cif":
+                        input_features["all_atom_positions"] = protein.from_mmcif_string(input_guess.read_text()).atom_positions
+                    else:
+                        raise ValueError(f"Unsupported initial guess file format: {initial_guess}")
+                    num_res = input_features["aatype"].shape[-1]
+                    if len(input_features["all_atom_positions"]) < num_res:
+                        input_features["all_atom_positions"] = np.pad(input_features["all_atom_positions"],
+                            [(0, num_res - len(input_features["all_atom_positions"])), (0, 0), (0, 0)])
                 
 
-            ########################
-            # predict
-            ########################
-            start = time.time()
+                ########################
+                # predict
+                ########################
+                start = time.time()
+
+                # monitor intermediate results
+                def callback(result, recycles):
+                    if recycles == 0: result.pop("tol",None)
+                    if not is_complex: result.pop("iptm",None)
+                    print_line = ""
+                    for x,y in [["mean_plddt","pLDDT"],["ptm","pTM"],["iptm","ipTM"],["tol","tol"]]:
+                      if x in result:
+                        print_line += f" {y}={result[x]:.3g}"
+                    logger.info(f"{tag} recycle={recycles}{print_line}")
+
+                    if save_recycles:
+                        final_atom_mask = result["structure_module"]["final_atom_mask"]
+                        b_factors = result["plddt"][:, None] * final_atom_mask
+                        unrelaxed_protein = protein.from_prediction(
+                            features=input_features,
+                            result=result, b_factors=b_factors,
+                            remove_leading_feature_dimension=("multimer" not in model_type))
+                        writer.submit(write_pdb, unrelaxed_protein, files.get("unrelaxed",f"r{recycles}.pdb"))
+
+                        if save_all:
+                            writer.submit(write_pickle, dict(result), files.get("all",f"r{recycles}.pickle"))
+                        del unrelaxed_protein
+
+                return_representations = save_all or save_single_representations or save_pair_representations
+
+                # predict
+                result, recycles = \
+                model_runner.predict(input_features,
+                    random_seed=seed,
+                    return_representations=return_representations,
+                    callback=callback)
+                if device_params is not None:
+                    # the runner would keep the model on the device while the next models run
+                    model_runner.params = params
+
+                if calc_extra_ptm and 'predicted_aligned_error' in result.keys():
+                    extra_ptm_output = extra_ptm.get_chain_and_interface_metrics(
+                        *unpad_extra_ptm_inputs(result, input_features['asym_id'], seq_len),
+                        use_probs_extra=use_probs_extra,
+                        use_jnp=False)
+                    result.pop('pae_matrix_with_logits', None)
+                    result['actifptm'] = extra_ptm_output['actifptm']
+                else:
+                    calc_extra_ptm = False
+                prediction_times.append(time.time() - start)
+
+                ########################
+                # parse results
+                ########################
 
-            # monitor intermediate results
-            def callback(result, recycles):
+                # summary metrics
+                mean_scores.append(result["ranking_confidence"])
                 if recycles == 0: result.pop("tol",None)
                 if not is_complex: result.pop("iptm",None)
                 print_line = ""
-                for x,y in [["mean_plddt","pLDDT"],["ptm","pTM"],["iptm","ipTM"],["tol","tol"]]:
+                conf.append({})
+                for x,y in [["mean_plddt","pLDDT"],["ptm","pTM"],["iptm","ipTM"], ['actifptm', 'actifpTM']]:
                   if x in result:
                     print_line += f" {y}={result[x]:.3g}"
-                logger.info(f"{tag} recycle={recycles}{print_line}")
-
-                if save_recycles:
-                    final_atom_mask = result["structure_module"]["final_atom_mask"]
-                    b_factors = result["plddt"][:, None] * final_atom_mask
-                    unrelaxed_protein = protein.from_prediction(
-                        features=input_features,
-                        result=result, b_factors=b_factors,
-                        remove_leading_feature_dimension=("multimer" not in model_type))
-                    files.get("unrelaxed",f"r{recycles}.pdb").write_text(protein.to_pdb(unrelaxed_protein))
-
-                    if save_all:
-                        with files.get("all",f"r{recycles}.pickle").open("wb") as handle:
-                            pickle.dump(result, handle)
-                    del unrelaxed_protein
-
-            return_representations = save_all or save_single_representations or save_pair_representations
-
-            # predict
-            result, recycles = \
-            model_runner.predict(input_features,
-                random_seed=seed,
-                return_representations=return_representations,
-                callback=callback)
-
-            if calc_extra_ptm and 'predicted_aligned_error' in result.keys():
-                extra_ptm_output = extra_ptm.get_chain_and_interface_metrics(result, input_features['asym_id'],
-                    use_probs_extra=use_probs_extra,
-                    use_jnp=False)
-                result.pop('pae_matrix_with_logits', None)
-                result['actifptm'] = extra_ptm_output['actifptm']
-            else:
-                calc_extra_ptm = False
-            prediction_times.append(time.time() - start)
-
-            ########################
-            # parse results
-            ########################
-
-            # summary metrics
-            mean_scores.append(result["ranking_confidence"])
-            if recycles == 0: result.pop("tol",None)
-            if not is_complex: result.pop("iptm",None)
-            print_line = ""
-            conf.append({})
-            for x,y in [["mean_plddt","pLDDT"],["ptm","pTM"],["iptm","ipTM"], ['actifptm', 'actifpTM']]:
-              if x in result:
-                print_line += f" {y}={result[x]:.3g}"
-                conf[-1][x] = float(result[x])
-            conf[-1]["print_line"] = print_line
-            logger.info(f"{tag} took {prediction_times[-1]:.1f}s ({recycles} recycles)")
-
-            # create protein object
-            final_atom_mask = result["structure_module"]["final_atom_mask"]
-            b_factors = result["plddt"][:, None] * final_atom_mask
-            unrelaxed_protein = protein.from_prediction(
-                features=input_features,
-                result=result,
-                b_factors=b_factors,
-                remove_leading_feature_dimension=("multimer" not in model_type))
-
-            # callback for visualization
-            if prediction_callback is not None:
-                prediction_callback(unrelaxed_protein, sequences_lengths,
-                                    result, input_features, (tag, False))
-
-            #########################
-            # save results
-            #########################
-
-            # save pdb
-            protein_lines = protein.to_pdb(unrelaxed_protein)
-            files.get("unrelaxed","pdb").write_text(protein_lines)
-            unrelaxed_pdb_lines.append(protein_lines)
-
-            # save raw outputs
-            if save_all:
-                with files.get("all","pickle").open("wb") as handle:
-                    pickle.dump(result, handle)
-            if save_single_representations:
-                np.save(files.get("single_repr","npy"),result["representations"]["single"])
-            if save_pair_representations:
-                np.save(files.get("pair_repr","npy"),result["representations"]["pair"])
-
-            # write an easy-to-use format (pAE and pLDDT)
-            with files.get("scores","json").open("w") as handle:
-                plddt = result["plddt"][:seq_len]
-                scores = {"plddt": np.around(plddt.astype(float), 2).tolist()}
+                    conf[-1][x] = float(result[x])
+                conf[-1]["print_line"] = print_line
+                logger.info(f"{tag} took {prediction_times[-1]:.1f}s ({recycles} recycles)")
+
+                # create protein object
+                final_atom_mask = result["structure_module"]["final_atom_mask"]
+                b_factors = result["plddt"][:, None] * final_atom_mask
+                unrelaxed_protein = protein.from_prediction(
+                    features=input_features,
+                    result=result,
+                    b_factors=b_factors,
+                    remove_leading_feature_dimension=("multimer" not in model_type))
+
+                # callback for visualization
+                if prediction_callback is not None:
+                    prediction_callback(unrelaxed_protein, sequences_lengths,
+                                        result, input_features, (tag, False))
+
+                #########################
+                # save results
+                #########################
+
+                # the files are written in the background while the next model is predicted,
+                # the paths are taken here to keep the order of the result files
+
+                # save pdb, the pdb lines are needed again for relaxation
+                unrelaxed_pdb_lines.append(writer.submit(write_pdb, unrelaxed_protein, files.get("unrelaxed","pdb")))
+
+                # save raw outputs
+                if save_all:
+                    writer.submit(write_pickle, result, files.get("all","pickle"))
+                if save_single_representations:
+                    writer.submit(np.save, files.get("single_repr","npy"), result["representations"]["single"])
+                if save_pair_representations:
+                    writer.submit(np.save, files.get("pair_repr","npy"), result["representations"]["pair"])
+
+                # write an easy-to-use format (pAE and pLDDT)
+                pae = None
                 if "predicted_aligned_error" in result:
-                  pae = result["predicted_aligned_error"][:seq_len,:seq_len]
-                  scores.update({"max_pae": pae.max().astype(float).item(),
-                                 "pae": np.around(pae.astype(float), 2).tolist()})
-                  if calc_extra_ptm:
-                    scores.update(extra_ptm_output)
-                  for k in ["ptm","iptm"]:
-                    if k in conf[-1]: scores[k] = np.around(conf[-1][k], 2).item()
-                  del pae
-                del plddt
-                json.dump(scores, handle)
-
-            del result, unrelaxed_protein
+                    pae = result["predicted_aligned_error"][:seq_len,:seq_len]
+                scores_exts = ["json", "npz"] if scores_format == "both" else [scores_format]
+                writer.submit(write_scores, [files.get("scores", ext) for ext in scores_exts], result["plddt"][:seq_len],
+                    pae, conf[-1], extra_ptm_output if calc_extra_ptm else None)
+                del pae
+
+                del result, unrelaxed_protein
+
+                # early stop criteria fulfilled
+                if mean_scores[-1] > stop_at_score: break
 
             # early stop criteria fulfilled
             if mean_scores[-1] > stop_at_score: break
 
-        # early stop criteria fulfilled
-        if mean_scores[-1] > stop_at_score: break
+            # cleanup
+            if "multimer" not in model_type: del input_features
+        if "multimer" in model_type: del input_features
+    except BaseException:
+        # don't wait for the writes of a failed prediction
+        writer.executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        if device_params is not None:
+            device_params.release()
+
+    if device_params is not None:
+        total = sum(params_nbytes(params) for params in device_params.params)
+        stats = device_memory_stats()
+        peak = f", peak device memory {stats['peak_bytes_in_use'] / 2**20:.0f} MB" if stats and "peak_bytes_in_use" in stats else ""
+        logger.info(
+            f"At most {device_params.peak_nbytes / 2**20:.0f} MB of the {total / 2**20:.0f} MB of model parameters "
+            f"were on the device, {(total - device_params.peak_nbytes) / 2**20:.0f} MB less{peak}"
+        )
 
-        # cleanup
-        if "multimer" not in model_type: del input_features
-    if "multimer" in model_type: del input_features
+    # all files are written before they are renamed
+    writer.close()
 
     ###################################################
     # rerank models based on predicted confidence
@@ -537,7 +789,7 @@ def predict_structure(
         if n < num_relax:
             start = time.time()
             pdb_lines = relax_me(
-                pdb_lines=unrelaxed_pdb_lines[key],
+                pdb_lines=unrelaxed_pdb_lines[key].result(),
                 max_iterations=relax_max_iterations,
                 tolerance=relax_tolerance,
                 stiffness=relax_stiffness,
@@ -573,6 +825,8 @@ def get_msa_and_templates(
     user_agent: str = "",
     max_template_date="2100-01-01",
     max_template_hits=20,
+    precomputed_msas: Optional[Mapping[str, str]] = None,
+    msa_cache: Optional["MsaCache"] = None,
 ) -> Tuple[
     Optional[List[str]], Optional[List[str]], List[str], List[int], List[Dict[str, Any]]
 ]:
@@ -620,41 +874,61 @@ def get_msa_and_templates(
             for index in range(0, len(query_seqs_unique)):
                 template_paths[index] = custom_template_path
         else:
-            a3m_lines_mmseqs2, template_paths = run_mmseqs2(
-                query_seqs_unique,
-                str(result_dir.joinpath(jobname)),
-                use_env,
-                use_templates=True,
-                host_url=host_url,
-                user_agent=user_agent,
-            )
-        if template_paths is None:
-            logger.info("No template detected")
-            for index in range(0, len(query_seqs_unique)):
-                template_feature = mk_mock_template(query_seqs_unique[index])
-                template_features.append(template_feature)
-        else:
-            for index in range(0, len(query_seqs_unique)):
-                if template_paths[index] is not None:
-                    template_feature = mk_template(
-                        a3m_lines_mmseqs2[index],
-                        template_paths[index],
-                        query_seqs_unique[index],
-                        max_template_date=max_template_date,
-                        max_hits=max_template_hits,
+            template_keys = []
+            templates_cached = False
+            if msa_cache is not None:
+                template_keys = [
+                    msa_cache.key(
+                        "templates", seq, use_env=use_env,
+                        max_template_date=max_template_date, max_template_hits=max_template_hits,
                     )
-                    if len(template_feature["template_domain_names"]) == 0:
+                    for seq in query_seqs_unique
+                ]
+                template_features = [msa_cache.get(key) for key in template_keys]
+                templates_cached = all(feature is not None for feature in template_features)
+            if templates_cached:
+                logger.info("Loaded template features from the MSA cache")
+            else:
+                template_features = []
+                a3m_lines_mmseqs2, template_paths = run_mmseqs2(
+                    query_seqs_unique,
+                    str(result_dir.joinpath(jobname)),
+                    use_env,
+                    use_templates=True,
+                    host_url=host_url,
+                    user_agent=user_agent,
+                )
+        if custom_template_path is not None or not templates_cached:
+            if template_paths is None:
+                logger.info("No template detected")
+                for index in range(0, len(query_seqs_unique)):
+                    template_feature = mk_mock_template(query_seqs_unique[index])
+                    template_features.append(template_feature)
+            else:
+                for index in range(0, len(query_seqs_unique)):
+                    if template_paths[index] is not None:
+                        template_feature = mk_template(
+                            a3m_lines_mmseqs2[index],
+                            template_paths[index],
+                            query_seqs_unique[index],
+                            max_template_date=max_template_date,
+                            max_hits=max_template_hits,
+                        )
+                        if len(template_feature["template_domain_names"]) == 0:
+                            template_feature = mk_mock_template(query_seqs_unique[index])
+                            logger.info(f"Sequence {index} found no templates")
+                        else:
+                            logger.info(
+                                f"Sequence {index} found templates: {template_feature['template_domain_names'].astype(str).tolist()}"
+                            )
+                    else:
                         template_feature = mk_mock_template(query_seqs_unique[index])
                         logger.info(f"Sequence {index} found no templates")
-                    else:
-                        logger.info(
-                            f"Sequence {index} found templates: {template_feature['template_domain_names'].astype(str).tolist()}"
-                        )
-                else:
-                    template_feature = mk_mock_template(query_seqs_unique[index])
-                    logger.info(f"Sequence {index} found no templates")
 
-                template_features.append(template_feature)
+                    template_features.append(template_feature)
+        if custom_template_path is None and not templates_cached:
+            for key, template_feature in zip(template_keys, template_features):
+                msa_cache.put(key, template_feature)
     else:
         for index in range(0, len(query_seqs_unique)):
             template_feature = mk_mock_template(query_seqs_unique[index])
@@ -670,15 +944,44 @@ def get_msa_and_templates(
             for i, seq in enumerate(query_seqs_unique):
                 a3m_lines.append(f">{num + i}\n{seq}")
         else:
-            # find normal a3ms
-            a3m_lines = run_mmseqs2(
-                query_seqs_unique,
-                str(result_dir.joinpath(jobname)),
-                use_env,
-                use_pairing=False,
-                host_url=host_url,
-                user_agent=user_agent,
-            )
+            # find normal a3ms, reusing MSAs that were searched together with other queries
+            # and MSAs found in the MSA cache
+            if precomputed_msas is None:
+                precomputed_msas = {}
+            a3m_lines_found = {}
+            cache_hits = set()
+            for seq in query_seqs_unique:
+                # None if the batch of the sequence failed, it's then searched with this query
+                precomputed = precomputed_msas.get(seq)
+                if precomputed is not None:
+                    a3m_lines_found[seq] = precomputed
+                elif msa_cache is not None:
+                    cached = msa_cache.get(msa_cache.key("unpaired", seq, use_env=use_env))
+                    if cached is not None:
+                        a3m_lines_found[seq] = cached
+                        cache_hits.add(seq)
+            query_seqs_missing = [seq for seq in query_seqs_unique if seq not in a3m_lines_found]
+            a3m_lines_missing = []
+            if len(query_seqs_missing) > 0:
+                a3m_lines_missing = run_mmseqs2(
+                    query_seqs_missing,
+                    str(result_dir.joinpath(jobname)),
+                    use_env,
+                    use_pairing=False,
+                    host_url=host_url,
+                    user_agent=user_agent,
+                )
+            a3m_lines_missing = dict(zip(query_seqs_missing, a3m_lines_missing))
+            a3m_lines = [
+                a3m_lines_missing[seq] if seq in a3m_lines_missing else a3m_lines_found[seq]
+                for seq in query_seqs_unique
+            ]
+            if msa_cache is not None:
+                # also the MSAs searched together with other queries, shared chains are only stored once
+                for seq, a3m in zip(query_seqs_unique, a3m_lines):
+                    key = msa_cache.key("unpaired", seq, use_env=use_env)
+                    if seq not in cache_hits and (seq in a3m_lines_missing or key not in msa_cache):
+                        msa_cache.put(key, a3m)
     else:
         a3m_lines = None
 
@@ -687,15 +990,24 @@ def get_msa_and_templates(
     ):
         # find paired a3m if not a homooligomers
         if len(query_seqs_unique) > 1:
-            paired_a3m_lines = run_mmseqs2(
-                query_seqs_unique,
-                str(result_dir.joinpath(jobname)),
-                use_envpair,
-                use_pairing=True,
-                pairing_strategy=pairing_strategy,
-                host_url=host_url,
-                user_agent=user_agent,
-            )
+            paired_a3m_lines = None
+            if msa_cache is not None:
+                paired_key = msa_cache.key(
+                    "paired", query_seqs_unique, use_env=use_envpair, pairing_strategy=pairing_strategy
+                )
+                paired_a3m_lines = msa_cache.get(paired_key)
+            if paired_a3m_lines is None:
+                paired_a3m_lines = run_mmseqs2(
+                    query_seqs_unique,
+                    str(result_dir.joinpath(jobname)),
+                    use_envpair,
+                    use_pairing=True,
+                    pairing_strategy=pairing_strategy,
+                    host_url=host_url,
+                    user_agent=user_agent,
+                )
+                if msa_cache is not None:
+                    msa_cache.put(paired_key, paired_a3m_lines)
         else:
             # homooligomers
             num = 101
@@ -713,24 +1025,147 @@ def get_msa_and_templates(
         template_features,
     )
 
+# ticket size for searching chains shared by several queries up front when --msa-batch-size isn't set
+SHARED_CHAIN_BATCH_SIZE = 20
+
+class UnpairedMsaBatches(Mapping[str, str]):
+    """Unpaired MSAs of many query sequences, searched together in tickets of at most
+    `batch_size` unique sequences instead of one ticket per job.
+
+    All tickets are submitted and polled concurrently when the object is created. Afterwards
+    the MSAs of one ticket at a time are kept in memory and looked up by sequence. The result of
+    a ticket is only parsed once, its MSAs are written to a file per sequence in
+    `msa_batch_<hash>_msas`, which is read when the ticket isn't the one in memory. MSAs of
+    sequences that occur more than once in `query_seqs` (e.g. a chain shared by many complexes)
+    stay in memory once loaded.
+
+    A ticket that fails is logged and its sequences are missing from the mapping, so the jobs
+    that use them search their MSAs on their own."""
+
+    def __init__(
+        self,
+        query_seqs: List[str],
+        result_dir: Path,
+        msa_mode: str,
+        batch_size: int,
+        host_url: str = DEFAULT_API_SERVER,
+        user_agent: str = "",
+    ):
+        from colabfold.colabfold import get_hash
+        from colabfold.mmseqs.api import run_sync
+
+        self.result_dir = result_dir
+        self.use_env = "env" in msa_mode
+        self.host_url = host_url
+        self.user_agent = user_agent
+
+        seqs_unique = list(dict.fromkeys(query_seqs))
+        self.batches = [seqs_unique[i:i + batch_size] for i in range(0, len(seqs_unique), batch_size)]
+        # the ticket directory name depends on its content, so a changed input never reuses a stale result
+        self.prefixes = [f"msa_batch_{get_hash(''.join(batch))}" for batch in self.batches]
+        self.batch_index = {seq: n for n, batch in enumerate(self.batches) for seq in batch}
+        self.batch_position = {seq: i for batch in self.batches for i, seq in enumerate(batch)}
+        self.parsed_batches = set()
+        self.failed_batches = set()
+        self.loaded_batch = None
+        self.loaded_msas = {}
+        self.shared = {seq for seq, count in Counter(query_seqs).items() if count > 1}
+        self.shared_msas = {}
+        self.lock = threading.Lock()
+
+        logger.info(f"Searching MSAs of {len(seqs_unique)} sequences in {len(self.batches)} batches")
+        run_sync(self._fetch_all())
+
+    async def _fetch_all(self):
+        from colabfold.mmseqs.api import MMseqs2API
+
+        with MMseqs2API(self.host_url, self.user_agent) as client:
+            results = await asyncio.gather(*[
+                client.fetch(batch, str(self.result_dir.joinpath(prefix)), self.use_env)
+                for batch, prefix in zip(self.batches, self.prefixes)
+            ], return_exceptions=True)
+        for n, result in enumerate(results):
+            if isinstance(result, Exception):
+                self._fail(n, result)
+
+    def _fail(self, n: int, e: Exception):
+        logger.error(
+            f"Could not search the MSAs of batch {n + 1}/{len(self.batches)}, "
+            f"its {len(self.batches[n])} sequences are searched per query: {e}"
+        )
+        self.failed_batches.add(n)
+
+    def _search(self, n: int) -> List[str]:
+        from colabfold.colabfold import run_mmseqs2
+
+        return run_mmseqs2(
+            self.batches[n],
+            str(self.result_dir.joinpath(self.prefixes[n])),
+            self.use_env,
+            use_pairing=False,
+            host_url=self.host_url,
+            user_agent=self.user_agent,
+        )
+
+    def _msa_file(self, n: int, seq: str) -> Path:
+        return self.result_dir.joinpath(f"{self.prefixes[n]}_msas", f"{self.batch_position[seq]}.a3m")
+
+    def __getitem__(self, seq: str) -> str:
+        n = self.batch_index[seq]
+        with self.lock:
+            if n in self.failed_batches:
+                raise KeyError(seq)
+            if seq in self.shared_msas:
+                return self.shared_msas[seq]
+            if self.loaded_batch == n:
+                return self.loaded_msas[seq]
+            if n in self.parsed_batches:
+                return self._msa_file(n, seq).read_text()
+            # the tickets were downloaded already, this only extracts the MSAs of the ticket
+            try:
+                a3m_lines = self._search(n)
+            except Exception as e:
+                self._fail(n, e)
+                raise KeyError(seq) from e
+            self.loaded_msas = dict(zip(self.batches[n], a3m_lines))
+            self.loaded_batch = n
+            self.result_dir.joinpath(f"{self.prefixes[n]}_msas").mkdir(exist_ok=True)
+            for batch_seq, a3m in self.loaded_msas.items():
+                self._msa_file(n, batch_seq).write_text(a3m)
+            self.parsed_batches.add(n)
+            for shared_seq in self.shared.intersection(self.loaded_msas):
+                self.shared_msas[shared_seq] = self.loaded_msas[shared_seq]
+            return self.loaded_msas[seq]
+
+    def __contains__(self, seq: object) -> bool:
+        return seq in self.batch_index and self.batch_index[seq] not in self.failed_batches
+
+    def __iter__(self):
+        return (seq for seq in self.batch_index if seq in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
 def build_monomer_feature(
     sequence: str, unpaired_msa: str, template_features: Dict[str, Any]
 ):
-    msa = pipeline.parsers.parse_a3m(unpaired_msa)
+    from colabfold.alphafold.msa import parse_a3m_features
+
     # gather features
     return {
         **pipeline.make_sequence_features(
             sequence=sequence, description="none", num_res=len(sequence)
         ),
-        **pipeline.make_msa_features([msa]),
+        **parse_a3m_features(unpaired_msa),
         **template_features,
     }
 
 def build_multimer_feature(paired_msa: str) -> Dict[str, ndarray]:
-    parsed_paired_msa = pipeline.parsers.parse_a3m(paired_msa)
+    from colabfold.alphafold.msa import parse_a3m_features
+
     return {
         f"{k}_all_seq": v
-        for k, v in pipeline.make_msa_features([parsed_paired_msa]).items()
+        for k, v in parse_a3m_features(paired_msa).items()
     }
 
 def process_multimer_features(
@@ -801,6 +1236,8 @@ def generate_input_feature(
     max_seq: int,
 ) -> Tuple[Dict[str, Any], Dict[str, str]]:
 
+    from colabfold.alphafold.msa import make_complex_msa_features
+
     input_feature = {}
     domain_names = {}
     if is_complex and "multimer" not in model_type:
@@ -812,11 +1249,16 @@ def generate_input_feature(
                 full_sequence += sequence
                 Ls.append(len(sequence))
 
-        # bugfix
-        a3m_lines = f">0\n{full_sequence}\n"
-        a3m_lines += pair_msa(query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa)
-
-        input_feature = build_monomer_feature(full_sequence, a3m_lines, mk_mock_template(full_sequence))
+        # the query of the whole complex followed by the paired and padded unpaired msa
+        input_feature = {
+            **pipeline.make_sequence_features(
+                sequence=full_sequence, description="none", num_res=len(full_sequence)
+            ),
+            **make_complex_msa_features(
+                query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa
+            ),
+            **mk_mock_template(full_sequence),
+        }
         input_feature["residue_index"] = np.concatenate([np.arange(L) for L in Ls])
         input_feature["asym_id"] = np.concatenate([np.full(L,n) for n,L in enumerate(Ls)])
         if any(
@@ -912,6 +1354,77 @@ def normalize_a3m(lines: list[str]) -> list[str]:
 
     return out
 
+def _split_a3m_sequence(seq: str, query_seq_len: List[int]) -> Tuple[List[str], List[bool]]:
+    # character by character reference of split_a3m_sequences, used for records with fewer columns than the query
+    has_amino_acid = [False] * len(query_seq_len)
+    seqs_line = []
+    prev_pos = 0
+    for n, query_len in enumerate(query_seq_len):
+        paired_seq = []
+        curr_seq_len = 0
+        for pos in range(prev_pos, len(seq)):
+            if curr_seq_len == query_len:
+                prev_pos = pos
+                break
+            paired_seq.append(seq[pos])
+            if seq[pos].islower():
+                continue
+            if seq[pos] != "-":
+                has_amino_acid[n] = True
+            curr_seq_len += 1
+        seqs_line.append("".join(paired_seq))
+    return seqs_line, has_amino_acid
+
+def split_a3m_sequences(
+    seqs: List[str], query_seq_len: List[int]
+) -> List[Tuple[List[str], List[bool]]]:
+    """Split aligned sequences of a complex a3m into the parts of each chain, and whether a part
+    contains any amino acid. Each chain spans `query_seq_len[n]` match columns (anything but lowercase
+    insertions), insertions after the last column of a chain belong to the next chain.
+
+    The chain boundaries of all sequences are found at once on the concatenated bytes."""
+    if len(seqs) == 0:
+        return []
+    joined = "".join(seqs)
+    data = joined.encode()
+    if len(data) != len(joined):
+        # not ascii, byte and character positions differ
+        return [_split_a3m_sequence(seq, query_seq_len) for seq in seqs]
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    is_match = (buffer < ord("a")) | (buffer > ord("z"))
+    is_amino_acid = is_match & (buffer != ord("-"))
+    # number of match columns/amino acids before each position
+    match_count = np.concatenate([[0], np.cumsum(is_match)])
+    amino_acid_count = np.concatenate([[0], np.cumsum(is_amino_acid)])
+
+    seq_lens = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+    seq_ends = np.cumsum(seq_lens)
+    seq_starts = seq_ends - seq_lens
+    # end of each chain: the position after its last match column
+    chain_ends = np.searchsorted(
+        match_count, match_count[seq_starts][:, None] + np.cumsum(query_seq_len)[None, :], side="left"
+    )
+    # all but the last chain need to end before the end of the sequence, the last one is truncated
+    complete = np.all(chain_ends[:, :-1] < seq_ends[:, None], axis=1)
+    chain_ends = np.minimum(chain_ends, seq_ends[:, None])
+    chain_starts = np.concatenate([seq_starts[:, None], chain_ends[:, :-1]], axis=1)
+    has_amino_acid = amino_acid_count[chain_ends] - amino_acid_count[chain_starts] > 0
+
+    chain_starts = chain_starts.tolist()
+    chain_ends = chain_ends.tolist()
+    has_amino_acid = has_amino_acid.tolist()
+    split = []
+    for i, seq in enumerate(seqs):
+        if not complete[i]:
+            split.append(_split_a3m_sequence(seq, query_seq_len))
+            continue
+        split.append((
+            [joined[start:end] for start, end in zip(chain_starts[i], chain_ends[i])],
+            has_amino_acid[i],
+        ))
+    return split
+
 def unserialize_msa(
     a3m_lines: List[str], query_sequence: Union[List[str], str]
 ) -> Tuple[
@@ -954,33 +1467,21 @@ def unserialize_msa(
             a3m_lines[2][prev_query_start : prev_query_start + query_len]
         )
         prev_query_start += query_len
-    paired_msa = [""] * len(query_seq_len)
-    unpaired_msa = [""] * len(query_seq_len)
-    already_in = dict()
+    # deduplicate records, keeping the first occurrence
+    headers, seqs = [], []
+    already_in = set()
     for i in range(1, len(a3m_lines), 2):
-        header = a3m_lines[i]
-        seq = a3m_lines[i + 1]
-        if (header, seq) in already_in:
+        record = (a3m_lines[i], a3m_lines[i + 1])
+        if record in already_in:
             continue
-        already_in[(header, seq)] = 1
-        has_amino_acid = [False] * len(query_seq_len)
-        seqs_line = []
-        prev_pos = 0
-        for n, query_len in enumerate(query_seq_len):
-            paired_seq = ""
-            curr_seq_len = 0
-            for pos in range(prev_pos, len(seq)):
-                if curr_seq_len == query_len:
-                    prev_pos = pos
-                    break
-                paired_seq += seq[pos]
-                if seq[pos].islower():
-                    continue
-                if seq[pos] != "-":
-                    has_amino_acid[n] = True
-                curr_seq_len += 1
-            seqs_line.append(paired_seq)
-
+        already_in.add(record)
+        headers.append(record[0])
+        seqs.append(record[1])
+    del already_in
+
+    paired_msa = [[] for _ in query_seq_len]
+    unpaired_msa = [[] for _ in query_seq_len]
+    for header, (seqs_line, has_amino_acid) in zip(headers, split_a3m_sequences(seqs, query_seq_len)):
         # if sequence is paired add them to output
         if (
             not is_single_protein
@@ -990,13 +1491,13 @@ def unserialize_msa(
             header_no_faster = header.replace(">", "")
             header_no_faster_split = header_no_faster.split("\t")
             for j in range(0, len(seqs_line)):
-                paired_msa[j] += ">" + header_no_faster_split[j] + "\n"
-                paired_msa[j] += seqs_line[j] + "\n"
+                paired_msa[j].append(">" + header_no_faster_split[j] + "\n" + seqs_line[j] + "\n")
         else:
             for j, seq in enumerate(seqs_line):
                 if has_amino_acid[j]:
-                    unpaired_msa[j] += header + "\n"
-                    unpaired_msa[j] += seq + "\n"
+                    unpaired_msa[j].append(header + "\n" + seq + "\n")
+    paired_msa = ["".join(lines) for lines in paired_msa]
+    unpaired_msa = ["".join(lines) for lines in unpaired_msa]
     if is_homooligomer:
         # homooligomers
         num = 101
@@ -1118,6 +1619,20 @@ def run(
     use_probs_extra: bool = True,
     max_template_date: str = "2100-01-01",
     max_template_hits: int = 20,
+    msa_prefetch: int = 0,
+    msa_batch_size: int = 0,
+    search_shared_chains: bool = False,
+    msa_cache_dir: Optional[Union[str, Path]] = None,
+    msa_cache_size: Optional[float] = None,
+    bucket_lengths: bool = False,
+    bucket_compile_cost: float = 10.0,
+    compilation_cache_dir: Optional[Union[str, Path]] = None,
+    num_devices: int = 1,
+    scores_format: str = "json",
+    claim_jobs: bool = False,
+    worker_id: Optional[str] = None,
+    claim_timeout: float = 600.0,
+    lazy_params: bool = False,
     **kwargs
 ):
     # check what device is available
@@ -1259,6 +1774,19 @@ def run(
         "use_probs_extra": use_probs_extra,
         "max_template_date": max_template_date,
         "max_template_hits": max_template_hits,
+        "msa_prefetch": msa_prefetch,
+        "msa_batch_size": msa_batch_size,
+        "search_shared_chains": search_shared_chains,
+        "msa_cache_dir": str(msa_cache_dir) if msa_cache_dir is not None else None,
+        "msa_cache_size": msa_cache_size,
+        "bucket_lengths": bucket_lengths,
+        "bucket_compile_cost": bucket_compile_cost,
+        "compilation_cache_dir": str(compilation_cache_dir) if compilation_cache_dir is not None else None,
+        "num_devices": num_devices,
+        "scores_format": scores_format,
+        "claim_jobs": claim_jobs,
+        "claim_timeout": claim_timeout,
+        "lazy_params": lazy_params,
     }
     config_out_file = result_dir.joinpath("config.json")
     config_out_file.write_text(json.dumps(config, indent=4))
@@ -1280,32 +1808,212 @@ def run(
     if custom_template_path is not None:
         mk_hhsearch_db(custom_template_path)
 
-    pad_len = 0
-    ranks, metrics = [],[]
-    first_job = True
-    job_number = 0
+    # assign job names up front, so that MSAs of later jobs can be prefetched
+    jobs = []
     for job_number, (raw_jobname, query_sequence, a3m_lines, _) in enumerate(queries):
         if jobname_prefix is not None:
             # pad job number based on number of queries
             fill = len(str(len(queries)))
             jobname = safe_filename(jobname_prefix) + "_" + str(job_number).zfill(fill)
-            job_number += 1
         else:
             jobname = safe_filename(raw_jobname)
+        jobs.append((job_number, jobname, query_sequence, a3m_lines))
+
+    def is_job_done(jobname: str) -> bool:
+        # In the colab version and with --zip we know we're done when a zip file has been written
+        if result_dir.joinpath(jobname).with_suffix(".result.zip").is_file():
+            return True
+        # In the local version we use a marker file
+        return result_dir.joinpath(jobname + ".done.txt").is_file()
+
+    def get_msa(jobname: str, query_sequence: Union[str, List[str]], a3m_lines: Optional[List[str]]):
+        pickled_msa_and_templates = result_dir.joinpath(f"{jobname}.pickle")
+        if pickled_msa_and_templates.is_file():
+            with open(pickled_msa_and_templates, 'rb') as f:
+                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = pickle.load(f)
+            logger.info(f"Loaded {pickled_msa_and_templates}")
+
+        else:
+            if a3m_lines is None:
+                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
+                = get_msa_and_templates(
+                    jobname, query_sequence, a3m_lines, result_dir, msa_mode, use_templates,
+                    custom_template_path, pair_mode, pairing_strategy, host_url, user_agent,
+                    max_template_date=max_template_date, max_template_hits=max_template_hits,
+                    precomputed_msas=precomputed_msas, msa_cache=msa_cache,
+                )
+
+            elif a3m_lines is not None:
+                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
+                = unserialize_msa(a3m_lines, query_sequence)
+                if use_templates:
+                    (_, _, _, _, template_features) \
+                        = get_msa_and_templates(
+                            jobname, query_seqs_unique, unpaired_msa, result_dir, 'single_sequence', use_templates,
+                            custom_template_path, pair_mode, pairing_strategy, host_url, user_agent,
+                            max_template_date=max_template_date, max_template_hits=max_template_hits,
+                        )
+
+            if num_models == 0:
+                with open(pickled_msa_and_templates, 'wb') as f:
+                    pickle.dump((unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features), f)
+                logger.info(f"Saved {pickled_msa_and_templates}")
+
+        # save a3m
+        msa = msa_to_str(unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality)
+        result_dir.joinpath(f"{jobname}.a3m").write_text(msa)
+        return (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features)
+
+    # pad queries to a few lengths chosen from all queries and predict them grouped by length,
+    # so the models are compiled once per length instead of whenever the length grows
+    job_bucket = None
+    if bucket_lengths and num_models > 0:
+        job_lengths = {
+            job_number: len("".join(query_sequence)) for job_number, jobname, query_sequence, _ in jobs
+            if not (keep_existing_results and is_job_done(jobname))
+        }
+        if len(job_lengths) > 0:
+            buckets = get_length_buckets(
+                list(job_lengths.values()), bucket_compile_cost, num_models * num_seeds
+            )
+            job_bucket = {
+                job_number: buckets[bisect.bisect_left(buckets, length)] for job_number, length in job_lengths.items()
+            }
+            jobs.sort(key=lambda job: job_bucket.get(job[0], 0))
+
+            # compilations of padding whenever the length grows, in the original order
+            pad_lens = set()
+            padded = 0
+            for length in job_lengths.values():
+                if length > padded:
+                    padded = math.ceil(length * recompile_padding) if isinstance(recompile_padding, float) \
+                        else length + recompile_padding
+                    padded = min(padded, max_len)
+                    pad_lens.add(padded)
+            logger.info(
+                f"Padding {len(job_lengths)} queries to {len(buckets)} lengths {buckets}, "
+                f"compiling {len(buckets)} instead of {len(pad_lens)} times "
+                f"({len(set(job_lengths.values()))} distinct lengths)"
+            )
+
+    # predict on several devices, each with its own copy of the models
+    devices = local_devices()
+    if num_devices > 0:
+        devices = devices[:num_devices]
+    if len(devices) > 1:
+        logger.info(f"Predicting on {len(devices)} devices: {', '.join(str(device) for device in devices)}")
+
+    # compiled models of earlier runs
+    compilation_cache_stats = None
+    if compilation_cache_dir is not None and num_models > 0:
+        from colabfold.alphafold.models import enable_compilation_cache
+        compilation_cache_stats = enable_compilation_cache(compilation_cache_dir)
+        # the counters are per process, only the compilations of this run are logged at the end
+        run_cache_hits, run_cache_misses = compilation_cache_stats.hits, compilation_cache_stats.misses
+        logger.info(f"Using compilation cache in {compilation_cache_dir}")
+
+    # MSAs and templates already searched in earlier runs
+    msa_cache = None
+    if msa_cache_dir is not None and msa_mode != "single_sequence":
+        from colabfold.mmseqs.cache import MsaCache
+        max_size = int(msa_cache_size * 1024 ** 3) if msa_cache_size is not None else None
+        msa_cache = MsaCache(msa_cache_dir, max_size, namespace=host_url)
+
+    # several processes sharing the result directory, each claims the job it works on
+    job_claims = None
+    if claim_jobs:
+        from colabfold.claims import JobClaims
+        job_claims = JobClaims(result_dir, worker_id, timeout=claim_timeout)
+        logger.info(f"Claiming jobs in {result_dir} as worker {job_claims.worker_id}")
+
+    def claim_job(jobname: str) -> bool:
+        if job_claims is None:
+            return True
+        if not job_claims.claim(jobname):
+            return False
+        # finished by another worker since it was checked
+        if keep_existing_results and is_job_done(jobname):
+            job_claims.release(jobname)
+            return False
+        return True
+
+    # search the unpaired MSAs of the chains of all queries up front, so a chain that is part of many
+    # complexes is only searched once. Only the paired MSAs are then searched per complex.
+    # Skipped when claiming jobs, the other workers would search the same chains, and with templates
+    # from the server, whose search of every chain of a job returns its unpaired MSA anyway.
+    precomputed_msas = None
+    server_templates = use_templates and custom_template_path is None
+    if (
+        (msa_batch_size > 0 or search_shared_chains)
+        and msa_mode != "single_sequence"
+        and job_claims is None
+        and not server_templates
+    ):
+        batch_seqs = []
+        for _, jobname, query_sequence, a3m_lines in jobs:
+            if a3m_lines is not None or (keep_existing_results and is_job_done(jobname)):
+                continue
+            if result_dir.joinpath(f"{jobname}.pickle").is_file():
+                continue
+            chains = [query_sequence] if isinstance(query_sequence, str) else list(dict.fromkeys(query_sequence))
+            if not isinstance(query_sequence, str) and len(query_sequence) > 1 and pair_mode == "paired":
+                # complexes only use paired MSAs
+                continue
+            batch_seqs.extend(
+                chain for chain in chains
+                if not (msa_cache is not None and msa_cache.key("unpaired", chain, use_env="env" in msa_mode) in msa_cache)
+            )
+        if msa_batch_size == 0:
+            # without batching, only chains shared by several queries are searched up front
+            chain_counts = Counter(batch_seqs)
+            batch_seqs = [chain for chain in batch_seqs if chain_counts[chain] > 1]
+        if len(batch_seqs) > 0:
+            try:
+                precomputed_msas = UnpairedMsaBatches(
+                    batch_seqs, result_dir, msa_mode, msa_batch_size or SHARED_CHAIN_BATCH_SIZE, host_url, user_agent
+                )
+            except Exception as e:
+                logger.exception(f"Could not search MSAs in batches, falling back to one search per query: {e}")
+
+    # retrieve MSAs/templates of the next jobs in background threads while the current job is predicted
+    msa_executor = ThreadPoolExecutor(max_workers=msa_prefetch) if msa_prefetch > 0 else None
+    msa_futures: Dict[int, Future] = {}
+    next_prefetch = 0
+    prefetch_lock = threading.Lock()
+
+    def prefetch_msas(start: int):
+        nonlocal next_prefetch
+        next_prefetch = max(next_prefetch, start)
+        while next_prefetch < len(jobs) and len(msa_futures) < msa_prefetch:
+            job_number, jobname, query_sequence, a3m_lines = jobs[next_prefetch]
+            next_prefetch += 1
+            if keep_existing_results and is_job_done(jobname):
+                continue
+            # the MSAs of jobs of other workers aren't retrieved
+            if not claim_job(jobname):
+                continue
+            msa_futures[job_number] = msa_executor.submit(get_msa, jobname, query_sequence, a3m_lines)
 
+    # the model runners and padding of each device
+    workers = [{"device": device, "pad_len": 0, "model_runner_and_params": None} for device in devices]
+    job_results: Dict[int, Tuple[List[str], List[Dict[str, Any]]]] = {}
+    # pyplot isn't thread safe
+    plot_lock = threading.Lock()
+
+    def process_job(job_index: int, job: Tuple[int, str, Union[str, List[str]], Optional[List[str]]], worker: Dict[str, Any]):
+        nonlocal max_seq, max_extra_seq
+        job_number, jobname, query_sequence, a3m_lines = job
         #######################################
         # check if job has already finished
         #######################################
-        # In the colab version and with --zip we know we're done when a zip file has been written
         result_zip = result_dir.joinpath(jobname).with_suffix(".result.zip")
         if keep_existing_results and result_zip.is_file():
             logger.info(f"Skipping {jobname} (result.zip)")
-            continue
-        # In the local version we use a marker file
+            return
         is_done_marker = result_dir.joinpath(jobname + ".done.txt")
         if keep_existing_results and is_done_marker.is_file():
             logger.info(f"Skipping {jobname} (already done)")
-            continue
+            return
 
         seq_len = len("".join(query_sequence))
         logger.info(f"Query {job_number + 1}/{len(queries)}: {jobname} (length {seq_len})")
@@ -1314,44 +2022,21 @@ def run(
         # generate MSA (a3m_lines) and templates
         ###########################################
         try:
-            pickled_msa_and_templates = result_dir.joinpath(f"{jobname}.pickle")
-            if pickled_msa_and_templates.is_file():
-                with open(pickled_msa_and_templates, 'rb') as f:
-                    (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = pickle.load(f)
-                logger.info(f"Loaded {pickled_msa_and_templates}")
-
+            if msa_executor is not None:
+                with prefetch_lock:
+                    msa_future = msa_futures.pop(job_number, None)
+                    if msa_future is None:
+                        msa_future = msa_executor.submit(get_msa, jobname, query_sequence, a3m_lines)
+                    prefetch_msas(job_index + 1)
+                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
+                = msa_future.result()
             else:
-                if a3m_lines is None:
-                    (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
-                    = get_msa_and_templates(
-                        jobname, query_sequence, a3m_lines, result_dir, msa_mode, use_templates,
-                        custom_template_path, pair_mode, pairing_strategy, host_url, user_agent,
-                        max_template_date=max_template_date, max_template_hits=max_template_hits,
-                    )
-
-                elif a3m_lines is not None:
-                    (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
-                    = unserialize_msa(a3m_lines, query_sequence)
-                    if use_templates:
-                        (_, _, _, _, template_features) \
-                            = get_msa_and_templates(
-                                jobname, query_seqs_unique, unpaired_msa, result_dir, 'single_sequence', use_templates,
-                                custom_template_path, pair_mode, pairing_strategy, host_url, user_agent,
-                                max_template_date=max_template_date, max_template_hits=max_template_hits,
-                            )
-
-                if num_models == 0:
-                    with open(pickled_msa_and_templates, 'wb') as f:
-                        pickle.dump((unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features), f)
-                    logger.info(f"Saved {pickled_msa_and_templates}")
-
-            # save a3m
-            msa = msa_to_str(unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality)
-            result_dir.joinpath(f"{jobname}.a3m").write_text(msa)
+                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) \
+                = get_msa(jobname, query_sequence, a3m_lines)
 
         except Exception as e:
             logger.exception(f"Could not get MSA/templates for {jobname}: {e}")
-            continue
+            return
 
         #######################
         # generate features
@@ -1367,7 +2052,7 @@ def run(
 
         except Exception as e:
             logger.exception(f"Could not generate input features {jobname}: {e}")
-            continue
+            return
 
         ###############
         # save plots not requiring prediction
@@ -1376,10 +2061,11 @@ def run(
         result_files = []
 
         # make msa plot
-        msa_plot = plot_msa_v2(feature_dict, dpi=dpi)
-        coverage_png = result_dir.joinpath(f"{jobname}_coverage.png")
-        msa_plot.savefig(str(coverage_png), bbox_inches='tight')
-        msa_plot.close()
+        with plot_lock:
+            msa_plot = plot_msa_v2(feature_dict, dpi=dpi)
+            coverage_png = result_dir.joinpath(f"{jobname}_coverage.png")
+            msa_plot.savefig(str(coverage_png), bbox_inches='tight')
+            msa_plot.close()
         result_files.append(coverage_png)
 
         if use_templates:
@@ -1400,15 +2086,19 @@ def run(
                     for x,y in zip(query_seqs_unique, query_seqs_cardinality)],[])
 
                 # decide how much to pad (to avoid recompiling)
-                if seq_len > pad_len:
+                pad_len = worker["pad_len"]
+                if job_bucket is not None:
+                    pad_len = job_bucket[job_number]
+                elif seq_len > pad_len:
                     if isinstance(recompile_padding, float):
                         pad_len = math.ceil(seq_len * recompile_padding)
                     else:
                         pad_len = seq_len + recompile_padding
                     pad_len = min(pad_len, max_len)
+                worker["pad_len"] = pad_len
 
                 # prep model and params
-                if first_job:
+                if worker["model_runner_and_params"] is None:
                     # if one job input adjust max settings
                     if len(queries) == 1 and msa_mode != "single_sequence":
                         # get number of sequences
@@ -1424,7 +2114,7 @@ def run(
                         max_extra_seq = max(min(num_seqs - max_seq, max_extra_seq), 1)
                         logger.info(f"Setting max_seq={max_seq}, max_extra_seq={max_extra_seq}")
 
-                    model_runner_and_params = load_models_and_params(
+                    worker["model_runner_and_params"] = load_models_and_params(
                         num_models=num_models,
                         use_templates=use_templates,
                         num_recycles=num_recycles,
@@ -1442,10 +2132,12 @@ def run(
                         use_fuse=use_fuse,
                         use_bfloat16=use_bfloat16,
                         save_all=save_all,
-                        calc_extra_ptm=calc_extra_ptm
+                        calc_extra_ptm=calc_extra_ptm,
+                        lazy_params=lazy_params,
                     )
-                    first_job = False
 
+                if compilation_cache_stats is not None:
+                    cache_hits, cache_misses = compilation_cache_stats.snapshot()
                 results = predict_structure(
                     prefix=jobname,
                     result_dir=result_dir,
@@ -1456,7 +2148,7 @@ def run(
                     pad_len=pad_len,
                     initial_guess=initial_guess,
                     model_type=model_type,
-                    model_runner_and_params=model_runner_and_params,
+                    model_runner_and_params=worker["model_runner_and_params"],
                     num_relax=num_relax,
                     relax_max_iterations=relax_max_iterations,
                     relax_tolerance=relax_tolerance,
@@ -1474,55 +2166,62 @@ def run(
                     save_recycles=save_recycles,
                     calc_extra_ptm=calc_extra_ptm,
                     use_probs_extra=use_probs_extra,
+                    scores_format=scores_format,
+                    lazy_params=lazy_params,
+                    pad_multimer=job_bucket is not None,
                 )
                 
+                if compilation_cache_stats is not None:
+                    job_hits, job_misses = compilation_cache_stats.snapshot()
+                    logger.info(f"Compilation cache: {job_hits - cache_hits} hits, {job_misses - cache_misses} misses")
                 result_files += results["result_files"]
-                ranks.append(results["rank"])
-                metrics.append(results["metric"])
+                job_results[job_number] = (results["rank"], results["metric"])
 
             except RuntimeError as e:
                 # This normally happens on OOM. TODO: Filter for the specific OOM error message
                 logger.error(f"Could not predict {jobname}. Not Enough GPU memory? {e}")
-                continue
+                return
 
             ###############
             # save prediction plots
             ###############
 
-            # load the scores
+            # load the scores, from the binary format if available
             scores = []
+            scores_ext = "json" if scores_format == "json" else "npz"
             for r in results["rank"][:5]:
-                scores_file = result_dir.joinpath(f"{jobname}_scores_{r}.json")
-                with scores_file.open("r") as handle:
-                    scores.append(json.load(handle))
+                scores.append(read_scores(result_dir.joinpath(f"{jobname}_scores_{r}.{scores_ext}")))
 
             # write alphafold-db format (pAE)
             if "pae" in scores[0]:
                 af_pae_file = result_dir.joinpath(f"{jobname}_predicted_aligned_error_v1.json")
                 af_pae_file.write_text(json.dumps({
-                    "predicted_aligned_error":scores[0]["pae"],
+                    "predicted_aligned_error":np.around(scores[0]["pae"].astype(float), 2).tolist(),
                     "max_predicted_aligned_error":scores[0]["max_pae"]}))
                 result_files.append(af_pae_file)
 
                 # make pAE plots
-                paes_plot = plot_paes([np.asarray(x["pae"]) for x in scores],
-                    Ls=query_sequence_len_array, dpi=dpi)
-                pae_png = result_dir.joinpath(f"{jobname}_pae.png")
-                paes_plot.savefig(str(pae_png), bbox_inches='tight')
-                paes_plot.close()
+                with plot_lock:
+                    paes_plot = plot_paes([x["pae"] for x in scores],
+                        Ls=query_sequence_len_array, dpi=dpi)
+                    pae_png = result_dir.joinpath(f"{jobname}_pae.png")
+                    paes_plot.savefig(str(pae_png), bbox_inches='tight')
+                    paes_plot.close()
                 result_files.append(pae_png)
 
                 # make pairwise interface metric plots and chainwise ptm plot
                 if calc_extra_ptm:
                     ext_metric_png = result_dir.joinpath(f"{jobname}_ext_metrics.png")
-                    extra_ptm.plot_chain_pairwise_analysis(scores, fig_path=ext_metric_png)
+                    with plot_lock:
+                        extra_ptm.plot_chain_pairwise_analysis(scores, fig_path=ext_metric_png)
 
             # make pLDDT plot
-            plddt_plot = plot_plddts([np.asarray(x["plddt"]) for x in scores],
-                Ls=query_sequence_len_array, dpi=dpi)
-            plddt_png = result_dir.joinpath(f"{jobname}_plddt.png")
-            plddt_plot.savefig(str(plddt_png), bbox_inches='tight')
-            plddt_plot.close()
+            with plot_lock:
+                plddt_plot = plot_plddts([x["plddt"] for x in scores],
+                    Ls=query_sequence_len_array, dpi=dpi)
+                plddt_png = result_dir.joinpath(f"{jobname}_plddt.png")
+                plddt_plot.savefig(str(plddt_png), bbox_inches='tight')
+                plddt_plot.close()
             result_files.append(plddt_png)
 
         if zip_results:
@@ -1538,6 +2237,60 @@ def run(
             if num_models > 0:
                 is_done_marker.touch()
 
+    # jobs claimed by other workers, retried after the pass in case their worker crashed
+    skipped_jobs: List[Tuple[int, Tuple[int, str, Union[str, List[str]], Optional[List[str]]]]] = []
+    skipped_lock = threading.Lock()
+
+    def process_claimed_job(job_index: int, job: Tuple[int, str, Union[str, List[str]], Optional[List[str]]], worker: Dict[str, Any]):
+        jobname = job[1]
+        if not claim_job(jobname):
+            logger.info(f"Skipping {jobname} (claimed by {job_claims.owner(jobname) or 'another worker'} or done)")
+            if not is_job_done(jobname):
+                with skipped_lock:
+                    skipped_jobs.append((job_index, job))
+            return
+        try:
+            process_job(job_index, job, worker)
+        finally:
+            # also after a failure, so another worker can retry the job
+            job_claims.release(jobname)
+
+    try:
+        if job_claims is None:
+            run_on_devices(jobs, workers, process_job)
+        else:
+            run_on_devices(jobs, workers, process_claimed_job)
+            # wait until the skipped jobs are done or their claim is released or stale, so the jobs of
+            # a crashed worker are taken over instead of waiting for another process to be started
+            while True:
+                with skipped_lock:
+                    retry_jobs = [(job_index, job) for job_index, job in skipped_jobs if not is_job_done(job[1])]
+                    skipped_jobs.clear()
+                if not retry_jobs:
+                    break
+                logger.info(f"Waiting for {len(retry_jobs)} jobs claimed by other workers")
+                time.sleep(job_claims.heartbeat_interval)
+                run_on_devices(
+                    retry_jobs,
+                    workers,
+                    lambda _, retry_job, worker: process_claimed_job(*retry_job, worker),
+                )
+    finally:
+        if job_claims is not None:
+            job_claims.close()
+
+    # ranks and metrics in the order of the queries, regardless of length buckets and which device finished first
+    ranks = [job_results[job_number][0] for job_number in sorted(job_results)]
+    metrics = [job_results[job_number][1] for job_number in sorted(job_results)]
+
+    if msa_executor is not None:
+        msa_executor.shutdown(cancel_futures=True)
+
+    if compilation_cache_stats is not None:
+        logger.info(
+            f"Compilation cache in total: {compilation_cache_stats.hits - run_cache_hits} hits, "
+            f"{compilation_cache_stats.misses - run_cache_misses} misses"
+        )
     logger.info("Done")
     return {"rank":ranks,"metric":metrics}
 
@@ -1630,7 +2383,8 @@ def main():
     parser.add_argument(
         "input",
         default="input",
-        help="One of: 1) directory with FASTA/A3M files, 2) CSV/TSV file, 3) FASTA file or 4) A3M file.",
+        help="One of: 1) directory with FASTA/A3M files, 2) CSV/TSV file, 3) FASTA file, 4) A3M file or "
+        "5) colabfold_search result directory with MMseqs2 databases (--unpack 0).",
     )
     parser.add_argument("results", help="Results output directory.")
 
@@ -1698,6 +2452,42 @@ def main():
         default=20,
         help="Maximum number of template hits to consider."
     )
+    msa_group.add_argument(
+        "--msa-prefetch",
+        type=int,
+        default=0,
+        help="Number of upcoming queries whose MSAs and templates are retrieved in background threads "
+        "while the current query is being predicted. "
+        "Keeps the accelerator busy while waiting for the MSA server. Set to 0 to disable.",
+    )
+    msa_group.add_argument(
+        "--msa-batch-size",
+        type=int,
+        default=0,
+        help="Submit the unique chains of all queries to the MSA server together, "
+        "in tickets of at most this many sequences, instead of one ticket per query. "
+        "Reduces the number of requests for large inputs. Not used with --templates.",
+    )
+    msa_group.add_argument(
+        "--search-shared-chains",
+        default=False,
+        action="store_true",
+        help="Search the unpaired MSAs of chains that are part of several queries once up front, "
+        "e.g. the bait of a pulldown. Not used with --templates.",
+    )
+    msa_group.add_argument(
+        "--msa-cache-dir",
+        default=None,
+        help="Directory of a persistent cache of MSAs and template features, keyed by sequence and search settings. "
+        "Can be shared by several runs, result directories and concurrently running processes.",
+    )
+    msa_group.add_argument(
+        "--msa-cache-size",
+        type=float,
+        default=None,
+        help="Maximum size of the MSA cache in GB. The least recently used entries are removed first. "
+        "No limit if not set.",
+    )
     msa_group.add_argument(
         "--pdb-hit-file",
         default=None,
@@ -1817,6 +2607,13 @@ def main():
         action="store_true",
         help="Experimental: For multimer models, disable cluster profiles.",
     )
+    pred_group.add_argument(
+        "--lazy-params",
+        default=False,
+        action="store_true",
+        help="Keep the model parameters in host memory and copy only the model that runs, and the next one, "
+        "to the GPU/TPU, instead of all models. Leaves more device memory for long sequences.",
+    )
     pred_group.add_argument(
         "--calc-extra-ptm",
         default=False,
@@ -1901,6 +2698,13 @@ def main():
         type=str,
         default=None,
     )
+    output_group.add_argument(
+        "--scores-format",
+        default="json",
+        choices=["json", "npz", "both"],
+        help="Format of the per model pLDDT/PAE scores files. npz stores them as float32 arrays, "
+        "which is smaller and faster than json for long sequences (read with colabfold.batch.read_scores).",
+    )
     output_group.add_argument(
         "--save-all",
         default=False,
@@ -1971,6 +2775,53 @@ def main():
         "but overall performance increases due to not recompiling. "
         "Set to 0 to disable.",
     )
+    adv_group.add_argument(
+        "--bucket-lengths",
+        default=False,
+        action="store_true",
+        help="Instead of --recompile-padding, choose a few lengths from all queries to pad to and predict the "
+        "queries grouped by these lengths, so the models are compiled once per length. "
+        "Also pads complexes predicted with the multimer models.",
+    )
+    adv_group.add_argument(
+        "--bucket-compile-cost",
+        type=float,
+        default=10.0,
+        help="Cost of compiling the models relative to one prediction of a 256 residue query, "
+        "used by --bucket-lengths to weigh compiling more often against padding more.",
+    )
+    adv_group.add_argument(
+        "--devices",
+        type=int,
+        default=1,
+        help="Number of local devices (GPUs/TPUs) to predict on, with one query per device at a time. "
+        "Set to 0 to use all devices. Without accelerators, this many CPU devices are created.",
+    )
+    adv_group.add_argument(
+        "--compilation-cache-dir",
+        default=None,
+        help="Directory to store the compiled models in, so that later or parallel runs with the same "
+        "model settings and input lengths reuse them instead of compiling again.",
+    )
+    adv_group.add_argument(
+        "--claim-jobs",
+        default=False,
+        action="store_true",
+        help="Run several colabfold_batch processes on the same input and result directory, e.g. on different "
+        "nodes with a shared filesystem. Each process claims the jobs it works on with a <jobname>.claim file "
+        "and skips the jobs claimed by the others or finished.",
+    )
+    adv_group.add_argument(
+        "--worker-id",
+        default=None,
+        help="Name of this process in the claims of --claim-jobs (default: host name and process id).",
+    )
+    adv_group.add_argument(
+        "--claim-timeout",
+        type=float,
+        default=600.0,
+        help="Seconds without a heartbeat after which the claim of a crashed or preempted process is taken over.",
+    )
     adv_group.add_argument(
         "--debug-logging",
         default=False,
@@ -1996,6 +2847,11 @@ def main():
         for k in ENV.keys():
             if k in os.environ: del os.environ[k]
 
+    # without accelerators, split the CPU into devices. This has to happen before jax initializes its backends
+    # and doesn't affect GPU/TPU devices
+    if args.devices > 1 and "xla_force_host_platform_device_count" not in os.environ.get("XLA_FLAGS", ""):
+        os.environ["XLA_FLAGS"] = (os.environ.get("XLA_FLAGS", "") + f" --xla_force_host_platform_device_count={args.devices}").strip()
+
     setup_logging(Path(args.results).joinpath("log.txt"), verbose=args.debug_logging)
 
     version = importlib_metadata.version("colabfold")
@@ -2036,6 +2892,10 @@ def main():
     model_order = [int(i) for i in args.model_order.split(",")]
 
     assert args.recompile_padding >= 0, "Can't apply negative padding"
+    assert args.msa_prefetch >= 0, "Can't prefetch a negative number of MSAs"
+    assert args.msa_batch_size >= 0, "Can't use a negative MSA batch size"
+    assert args.msa_cache_size is None or args.msa_cache_size > 0, "MSA cache size must be positive"
+    assert args.devices >= 0, "Can't use a negative number of devices"
 
     # backward compatibility
     if args.amber and args.num_relax == 0:
@@ -2094,6 +2954,11 @@ def main():
         num_seeds=args.num_seeds,
         stop_at_score=args.stop_at_score,
         recompile_padding=args.recompile_padding,
+        bucket_lengths=args.bucket_lengths,
+        bucket_compile_cost=args.bucket_compile_cost,
+        compilation_cache_dir=args.compilation_cache_dir,
+        num_devices=args.devices,
+        scores_format=args.scores_format,
         zip_results=args.zip,
         save_single_representations=args.save_single_representations,
         save_pair_representations=args.save_pair_representations,
@@ -2112,6 +2977,15 @@ def main():
         use_probs_extra=use_probs_extra,
         max_template_date=args.max_template_date,
         max_template_hits=args.max_template_hits,
+        msa_prefetch=args.msa_prefetch,
+        msa_batch_size=args.msa_batch_size,
+        search_shared_chains=args.search_shared_chains,
+        msa_cache_dir=args.msa_cache_dir,
+        msa_cache_size=args.msa_cache_size,
+        claim_jobs=args.claim_jobs,
+        worker_id=args.worker_id,
+        claim_timeout=args.claim_timeout,
+        lazy_params=args.lazy_params,
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+"""
+Claims of the jobs of a result directory, so several `colabfold_batch` processes can work on the
+same input and result directory, e.g. on preemptible nodes with a shared filesystem.
+
+A worker claims a job by creating `<jobname>.claim` exclusively, so only one worker can hold it.
+While it works on the job, a background thread refreshes the modification time of its claims
+(the heartbeat). A claim whose heartbeat is older than `timeout` belongs to a worker that crashed
+or was preempted and is taken over by the next worker that wants the job.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Set, Union
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobClaims:
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        worker_id: Optional[str] = None,
+        timeout: float = 600.0,
+        heartbeat_interval: Optional[float] = None,
+    ):
+        """
+        :param directory: The result directory shared by the workers
+        :param worker_id: Written into the claims, defaults to the host name and process id
+        :param timeout: Seconds without a heartbeat after which a claim is taken over
+        :param heartbeat_interval: Seconds between heartbeats, defaults to a quarter of `timeout`
+        """
+        self.directory = Path(directory)
+        self.worker_id = worker_id or default_worker_id()
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval or timeout / 4
+        self._held: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, name="job-claims-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _path(self, jobname: str) -> Path:
+        return self.directory.joinpath(f"{jobname}.claim")
+
+    def _create(self, jobname: str) -> bool:
+        try:
+            fd = os.open(self._path(jobname), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{self.worker_id}\n")
+        with self._lock:
+            self._held.add(jobname)
+        return True
+
+    def owner(self, jobname: str) -> Optional[str]:
+        try:
+            return self._path(jobname).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def claim(self, jobname: str) -> bool:
+        """Claim a job, returns whether this worker holds the claim"""
+        with self._lock:
+            if jobname in self._held:
+                return True
+        if self._create(jobname):
+            return True
+
+        path = self._path(jobname)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # released in the meantime
+            return self._create(jobname)
+        if time.time() - stat.st_mtime < self.timeout:
+            return False
+
+        # move the stale claim aside, only one of several workers doing this at once succeeds
+        owner = self.owner(jobname)
+        stale = path.with_name(f"{path.name}.{self.worker_id}.stale")
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+        moved = stale.stat()
+        if (moved.st_ino, moved.st_mtime) != (stat.st_ino, stat.st_mtime):
+            # the claim got a heartbeat or was taken over after we checked it, put it back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        logger.warning(f"Taking over {jobname} from {owner}, whose claim had no heartbeat for {self.timeout}s")
+        return self._create(jobname)
+
+    def release(self, jobname: str):
+        with self._lock:
+            if jobname not in self._held:
+                return
+            self._held.remove(jobname)
+        # the claim was taken over after a missed heartbeat, it belongs to the other worker now
+        owner = self.owner(jobname)
+        if owner != self.worker_id:
+            if owner is not None:
+                logger.warning(f"Not releasing {jobname}, it was taken over by {owner}")
+            return
+        try:
+            os.remove(self._path(jobname))
+        except FileNotFoundError:
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                held = list(self._held)
+            for jobname in held:
+                if self.owner(jobname) != self.worker_id:
+                    logger.warning(f"The claim of {jobname} was removed or taken over")
+                    continue
+                try:
+                    os.utime(self._path(jobname))
+                except FileNotFoundError:
+                    logger.warning(f"The claim of {jobname} was removed")
+
+    def close(self):
+        """Stop the heartbeat and release all claims"""
+        self._stop.set()
+        self._heartbeat.join()
+        with self._lock:
+            held = list(self._held)
+        for jobname in held:
+            self.release(jobname)
@@ -1,8 +1,13 @@
-from typing import List, Optional, Tuple, Union, Dict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
+import heapq
+import os
+import pickle
 import random
 import logging
+import tempfile
 from colabfold.utils import MolType
+from colabfold.mmseqs.db import SearchResultDb, is_mmseqs_db
 logger = logging.getLogger(__name__)
 
 def safe_filename(file: str) -> str:
@@ -11,41 +16,37 @@ def safe_filename(file: str) -> str:
 def pair_sequences(
     a3m_lines: List[str], query_sequences: List[str], query_cardinality: List[int]
 ) -> str:
-    a3m_line_paired = [""] * len(a3m_lines[0].splitlines())
+    # collect the parts of every line and join them once, appending to the strings is quadratic
+    a3m_line_paired = [[] for _ in a3m_lines[0].splitlines()]
     for n, seq in enumerate(query_sequences):
         lines = a3m_lines[n].splitlines()
         for i, line in enumerate(lines):
             if line.startswith(">"):
                 if n != 0:
                     line = line.replace(">", "\t", 1)
-                a3m_line_paired[i] = a3m_line_paired[i] + line
+                a3m_line_paired[i].append(line)
             else:
-                a3m_line_paired[i] = a3m_line_paired[i] + line * query_cardinality[n]
-    return "\n".join(a3m_line_paired)
+                a3m_line_paired[i].append(line * query_cardinality[n])
+    return "\n".join("".join(parts) for parts in a3m_line_paired)
 
 def pad_sequences(
     a3m_lines: List[str], query_sequences: List[str], query_cardinality: List[int]
 ) -> str:
-    _blank_seq = [
-        ("-" * len(seq))
-        for n, seq in enumerate(query_sequences)
-        for _ in range(query_cardinality[n])
-    ]
+    total_len = sum(len(seq) * query_cardinality[n] for n, seq in enumerate(query_sequences))
     a3m_lines_combined = []
-    pos = 0
+    offset = 0
     for n, seq in enumerate(query_sequences):
+        lines = [a3m_line for a3m_line in a3m_lines[n].split("\n") if len(a3m_line) > 0]
         for j in range(0, query_cardinality[n]):
-            lines = a3m_lines[n].split("\n")
+            # the gaps before and after this copy are built once, not for every line
+            prefix = "-" * offset
+            suffix = "-" * (total_len - offset - len(seq))
             for a3m_line in lines:
-                if len(a3m_line) == 0:
-                    continue
                 if a3m_line.startswith(">"):
                     a3m_lines_combined.append(a3m_line)
                 else:
-                    a3m_lines_combined.append(
-                        "".join(_blank_seq[:pos] + [a3m_line] + _blank_seq[pos + 1 :])
-                    )
-            pos += 1
+                    a3m_lines_combined.append(prefix + a3m_line + suffix)
+            offset += len(seq)
     return "\n".join(a3m_lines_combined)
 
 def pair_msa(
@@ -264,69 +265,110 @@ def decode_structure_sequences(
 
     return decoded_sequences
 
-def get_queries(
-    input_path: Union[str, Path], sort_queries_by: str = "length"
-) -> Tuple[List[Tuple[str, str, Optional[List[str]], Optional[List[Tuple[MolType, str, int]]]]], bool]:
-    """Reads a directory of fasta files, a single fasta file or a csv file and returns a tuple
-    of job name, sequence, optional a3m lines, and the optional non-protein sequences."""
-
+def iter_fasta(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Yields the description and sequence of every record like `parse_fasta`, but reads the
+    lines one at a time, e.g. from an open file."""
+    description, parts = None, []
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#") or not line:
+            continue
+        if line.startswith(">"):
+            if description is not None:
+                yield description, "".join(parts)
+            description, parts = line[1:], []
+        elif description is not None:
+            parts.append(line)
+    if description is not None:
+        yield description, "".join(parts)
+
+
+def is_complex_query(query_sequence: Union[str, List[str]], a3m_lines: Optional[List[str]]) -> bool:
+    if isinstance(query_sequence, list):
+        return True
+    # the MSAs of a search result database are complexes if they have several chains
+    if isinstance(a3m_lines, list) and a3m_lines[0].startswith("#"):
+        a3m_line = a3m_lines[0].splitlines()[0]
+        tab_sep_entries = a3m_line[1:].split("\t")
+        if len(tab_sep_entries) == 2:
+            query_seq_len = tab_sep_entries[0].split(",")
+            query_seq_len = list(map(int, query_seq_len))
+            query_seqs_cardinality = tab_sep_entries[1].split(",")
+            query_seqs_cardinality = list(map(int, query_seqs_cardinality))
+            is_single_protein = (
+                True
+                if len(query_seq_len) == 1 and query_seqs_cardinality[0] == 1
+                else False
+            )
+            return not is_single_protein
+    return False
+
+
+def _read_structure_sequences(file: Path) -> List[str]:
+    from alphafold.common import protein
+
+    if file.suffix.lower() == ".pdb":
+        pdb_string = pdb_to_string(file.read_text())
+        prot = protein.from_pdb_string(pdb_string)
+    else:  # file.suffix.lower() == ".cif"
+        prot = protein.from_mmcif_string(file.read_text())
+    return decode_structure_sequences(prot.aatype, prot.chain_index)
+
+
+def iter_queries(
+    input_path: Union[str, Path], chunk_size: int = 100000
+) -> Iterator[Tuple[str, Union[str, List[str]], Optional[List[str]], Optional[List[Tuple[MolType, str, int]]]]]:
+    """Yields the queries of `get_queries` in the order of the input, reading fasta and csv files
+    while the queries are used, so memory doesn't grow with the size of the input"""
     input_path = Path(input_path)
     if not input_path.exists():
         raise OSError(f"{input_path} could not be found")
 
-    if input_path.is_file():
+    if is_mmseqs_db(input_path) or is_mmseqs_db(input_path.joinpath("final.a3m")):
+        # the databases of colabfold_search --unpack 0, the MSAs are read when they are used
+        yield from SearchResultDb(input_path).get_queries()
+    elif input_path.is_file():
         if input_path.suffix == ".csv" or input_path.suffix == ".tsv":
             sep = "\t" if input_path.suffix == ".tsv" else ","
             import pandas
-            df = pandas.read_csv(input_path, sep=sep, dtype=str)
-            assert "id" in df.columns and "sequence" in df.columns
-            queries = [
-                (seq_id, sequence.upper().split(":"), None, None)
-                for seq_id, sequence in df[["id", "sequence"]].itertuples(index=False)
-            ]
-            for i in range(len(queries)):
-                if len(queries[i][1]) == 1:
-                    queries[i] = (queries[i][0], queries[i][1][0], None, None)
+            for df in pandas.read_csv(input_path, sep=sep, dtype=str, chunksize=chunk_size):
+                assert "id" in df.columns and "sequence" in df.columns
+                for seq_id, sequence in df[["id", "sequence"]].itertuples(index=False):
+                    sequences = sequence.upper().split(":")
+                    yield seq_id, sequences[0] if len(sequences) == 1 else sequences, None, None
         elif input_path.suffix == ".a3m":
-            (seqs, header) = parse_fasta(input_path.read_text())
+            a3m = input_path.read_text()
+            (seqs, header) = parse_fasta(a3m)
             if len(seqs) == 0:
                 raise ValueError(f"{input_path} is empty")
             query_sequence = seqs[0]
             # Use a list so we can easily extend this to multiple msas later
-            a3m_lines = [input_path.read_text()]
-            queries = [(input_path.stem, query_sequence, a3m_lines, None)]
+            a3m_lines = [a3m]
+            yield input_path.stem, query_sequence, a3m_lines, None
         elif input_path.suffix in [".fasta", ".faa", ".fa"]:
-            (sequences, headers) = parse_fasta(input_path.read_text())
-            queries = []
-            for sequence, header in zip(sequences, headers):
-                sequence = sequence.upper()
-                if sequence.count(":") == 0:
-                    # Single sequence
-                    queries.append((header, sequence, None, None))
-                else:
-                    # Complex mode
-                    protein_queries, other_queries = classify_molecules(sequence)
-                    queries.append((header, protein_queries, None, other_queries))
+            with input_path.open() as f:
+                for header, sequence in iter_fasta(f):
+                    sequence = sequence.upper()
+                    if sequence.count(":") == 0:
+                        # Single sequence
+                        yield header, sequence, None, None
+                    else:
+                        # Complex mode
+                        protein_queries, other_queries = classify_molecules(sequence)
+                        yield header, protein_queries, None, other_queries
         elif input_path.suffix in [".pdb", ".cif"]:
-            from alphafold.common import protein
-            if input_path.suffix == ".pdb":
-                pdb_string = pdb_to_string(input_path.read_text())
-                prot = protein.from_pdb_string(pdb_string)
-            elif input_path.suffix == ".cif":
-                prot = protein.from_mmcif_string(input_path.read_text())
             header = input_path.stem
-            sequences = decode_structure_sequences(prot.aatype, prot.chain_index)
+            sequences = _read_structure_sequences(input_path)
 
             if len(sequences) == 0:
                 raise ValueError(f"{input_path} is empty")
 
-            queries = [(header, sequences, None, None)]
+            yield header, sequences, None, None
 
         else:
             raise ValueError(f"Unknown file format {input_path.suffix}")
     else:
         assert input_path.is_dir(), "Expected either an input file or a input directory"
-        queries = []
         for file in sorted(input_path.iterdir()):
             if not file.is_file():
                 continue
@@ -334,21 +376,17 @@ def get_queries(
                 logger.warning(f"non-fasta/a3m/pdb/cif file in input directory: {file}")
                 continue
             if file.suffix.lower() in [".pdb", ".cif"]:
-                header = file.stem
-                if file.suffix.lower() == ".pdb":
-                    pdb_string = pdb_to_string(file.read_text())
-                    prot = protein.from_pdb_string(pdb_string)
-                else:  # file.suffix.lower() == ".cif"
-                    prot = protein.from_mmcif_string(file.read_text())
-                sequences = decode_structure_sequences(prot.aatype, prot.chain_index)
+                sequences = _read_structure_sequences(file)
 
                 if len(sequences) == 0:
                     logger.error(f"{file} is empty")
                     continue
 
-                queries.append((header, sequences, None))
-            else:  # file.suffix.lower() in [".a3m", ".fasta", ".faa"]
-                (seqs, header) = parse_fasta(file.read_text())
+                yield file.stem, sequences, None, None
+                continue
+            # file.suffix.lower() in [".a3m", ".fasta", ".faa"], read once for the sequences and the MSA
+            text = file.read_text()
+            (seqs, header) = parse_fasta(text)
             if len(seqs) == 0:
                 logger.error(f"{file} is empty")
                 continue
@@ -359,16 +397,89 @@ def get_queries(
                 )
 
             if file.suffix.lower() == ".a3m":
-                a3m_lines = [file.read_text()]
-                queries.append((file.stem, query_sequence.upper(), a3m_lines, None))
+                a3m_lines = [text]
+                yield file.stem, query_sequence.upper(), a3m_lines, None
             else:
                 if query_sequence.count(":") == 0:
                     # Single sequence
-                    queries.append((file.stem, query_sequence, None, None))
+                    yield file.stem, query_sequence, None, None
                 else:
                     # Complex mode
                     protein_queries, other_queries = classify_molecules(query_sequence)
-                    queries.append((file.stem, protein_queries, None, other_queries))
+                    yield file.stem, protein_queries, None, other_queries
+
+
+def _write_run(run: List[Tuple[Any, int, Any]], directory: str) -> str:
+    fd, path = tempfile.mkstemp(dir=directory, suffix=".pickle")
+    with os.fdopen(fd, "wb") as f:
+        for entry in run:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path: str) -> Iterator[Tuple[Any, int, Any]]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def sort_queries(
+    queries: Iterable[Any], sort_queries_by: Optional[str] = "length", chunk_size: Optional[int] = 100000
+) -> Iterator[Any]:
+    """Sorts queries by length ("length") or shuffles them ("random"), otherwise keeps their order.
+
+    At most `chunk_size` queries are kept in memory: every chunk is sorted and written to a temporary
+    file, and the sorted chunks are merged while the queries are read. The sort is stable. With a
+    `chunk_size` of None, all queries are sorted in memory."""
+    if sort_queries_by == "length":
+        key = lambda query: len("".join(query[1]))
+    elif sort_queries_by == "random":
+        key = lambda query: random.random()
+    else:
+        yield from queries
+        return
+
+    # the query number makes the entries unique, so the queries themselves are never compared
+    chunk = []
+    with tempfile.TemporaryDirectory(prefix="colabfold_queries_") as directory:
+        runs = []
+        for query_number, query in enumerate(queries):
+            chunk.append((key(query), query_number, query))
+            if chunk_size is not None and len(chunk) >= chunk_size:
+                chunk.sort(key=lambda entry: entry[:2])
+                runs.append(_write_run(chunk, directory))
+                chunk = []
+        chunk.sort(key=lambda entry: entry[:2])
+        if runs:
+            logger.info(f"Merging {len(runs) + 1} sorted chunks of queries")
+        merged = heapq.merge(*[_read_run(path) for path in runs], chunk, key=lambda entry: entry[:2])
+        for _, _, query in merged:
+            yield query
+
+
+def stream_queries(
+    input_path: Union[str, Path], sort_queries_by: Optional[str] = "length", chunk_size: int = 100000
+) -> Iterator[Tuple[str, Union[str, List[str]], Optional[List[str]], Optional[List[Tuple[MolType, str, int]]]]]:
+    """The queries of `get_queries` as an iterator that only keeps `chunk_size` queries in memory,
+    also when sorting them. Use `is_complex_query` to check for complexes while iterating."""
+    input_path = Path(input_path)
+    if is_mmseqs_db(input_path) or is_mmseqs_db(input_path.joinpath("final.a3m")):
+        # the lazily read MSAs can't be written to disk, and the jobs are in memory already
+        chunk_size = None
+    return sort_queries(iter_queries(input_path, chunk_size or 100000), sort_queries_by, chunk_size)
+
+
+def get_queries(
+    input_path: Union[str, Path], sort_queries_by: str = "length"
+) -> Tuple[List[Tuple[str, str, Optional[List[str]], Optional[List[Tuple[MolType, str, int]]]]], bool]:
+    """Reads a directory of fasta files, a single fasta file, a csv file or the MMseqs2 databases
+    of `colabfold_search --unpack 0` and returns a tuple of job name, sequence, optional a3m lines,
+    and the optional non-protein sequences. See `stream_queries` for large inputs."""
+
+    queries = list(iter_queries(input_path))
 
     # sort by seq. len
     if sort_queries_by == "length":
@@ -377,25 +488,5 @@ def get_queries(
     elif sort_queries_by == "random":
         random.shuffle(queries)
 
-    is_complex = False
-    for job_number, (_, query_sequence, a3m_lines, _) in enumerate(queries):
-        if isinstance(query_sequence, list):
-            is_complex = True
-            break
-        if a3m_lines is not None and a3m_lines[0].startswith("#"):
-            a3m_line = a3m_lines[0].splitlines()[0]
-            tab_sep_entries = a3m_line[1:].split("\t")
-            if len(tab_sep_entries) == 2:
-                query_seq_len = tab_sep_entries[0].split(",")
-                query_seq_len = list(map(int, query_seq_len))
-                query_seqs_cardinality = tab_sep_entries[1].split(",")
-                query_seqs_cardinality = list(map(int, query_seqs_cardinality))
-                is_single_protein = (
-                    True
-                    if len(query_seq_len) == 1 and query_seqs_cardinality[0] == 1
-                    else False
-                )
-                if not is_single_protein:
-                    is_complex = True
-                    break
+    is_complex = any(is_complex_query(query_sequence, a3m_lines) for _, query_sequence, a3m_lines, _ in queries)
     return queries, is_complex
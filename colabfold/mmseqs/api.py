@@ -0,0 +1,276 @@
+"""
+Asynchronous client for the MMseqs2 MSA API (the server behind `run_mmseqs2`).
+
+A single pooled HTTP session is shared by all requests and many tickets can be polled
+concurrently, e.g. `asyncio.run(client.search_many([...]))`. The blocking HTTP calls run
+in worker threads, so no additional dependency is required.
+
+`run_mmseqs2` is a blocking wrapper around `MMseqs2API.search` for a single ticket, so the
+submit/poll/download loop is only implemented here.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import shutil
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from colabfold.colabfold import (
+    get_mmseqs2_a3m_files,
+    get_mmseqs2_mode,
+    read_mmseqs2_a3m,
+    read_mmseqs2_templates,
+)
+from colabfold.utils import DEFAULT_API_SERVER
+
+logger = logging.getLogger(__name__)
+
+
+class MMseqs2API:
+    """Client for the ticket/status/download/template endpoints of the MSA API.
+
+    UNKNOWN and RATELIMIT statuses resubmit, ERROR and MAINTENANCE raise. Polling starts at
+    `poll_interval` and backs off by `backoff` up to `max_poll_interval` while a ticket is
+    still queued or running.
+    """
+
+    def __init__(
+        self,
+        host_url: str = DEFAULT_API_SERVER,
+        user_agent: str = "",
+        max_connections: int = 8,
+        timeout: float = 6.02,
+        poll_interval: float = 2.0,
+        max_poll_interval: float = 30.0,
+        backoff: float = 1.5,
+        max_errors: int = 5,
+    ):
+        self.host_url = host_url
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.max_connections = max_connections
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if user_agent != "":
+            self.session.headers["User-Agent"] = user_agent
+        else:
+            logger.warning(
+                "No user agent specified. Please set a user agent (e.g., 'toolname/version contact@email') "
+                "to help us debug in case of problems. This warning will become an error in the future."
+            )
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def _request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        # the semaphore bounds the number of requests in flight to the size of the connection pool
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        error_count = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    return await asyncio.to_thread(
+                        self.session.request,
+                        method,
+                        f"{self.host_url}/{endpoint}",
+                        timeout=self.timeout,
+                        **kwargs,
+                    )
+            except requests.exceptions.Timeout:
+                logger.warning(f"Timeout while requesting {endpoint} from MSA server. Retrying...")
+            except Exception as e:
+                error_count += 1
+                logger.warning(f"Error while requesting {endpoint} from MSA server. Retrying... ({error_count}/{self.max_errors})")
+                logger.warning(f"Error: {e}")
+                if error_count >= self.max_errors:
+                    raise
+                await asyncio.sleep(5)
+
+    @staticmethod
+    def _json(res: requests.Response) -> Dict[str, Any]:
+        try:
+            return res.json()
+        except ValueError:
+            logger.error(f"Server didn't reply with json: {res.text}")
+            return {"status": "ERROR"}
+
+    async def submit(self, seqs: Sequence[str], mode: str, use_pairing: bool = False, N: int = 101) -> Dict[str, Any]:
+        query = "".join(f">{N + n}\n{seq}\n" for n, seq in enumerate(seqs))
+        endpoint = "ticket/pair" if use_pairing else "ticket/msa"
+        res = await self._request("POST", endpoint, data={"q": query, "mode": mode})
+        return self._json(res)
+
+    async def status(self, ticket_id: str) -> Dict[str, Any]:
+        res = await self._request("GET", f"ticket/{ticket_id}")
+        return self._json(res)
+
+    async def download(self, ticket_id: str, path: Union[str, Path]):
+        """Stream the result archive of a ticket to `path`."""
+        res = await self._request("GET", f"result/download/{ticket_id}", stream=True)
+        await asyncio.to_thread(_write_stream, res, Path(path))
+
+    async def fetch_templates(self, pdb_ids: Sequence[str], path: Union[str, Path]):
+        """Download the template structures of one query into `path` in the layout expected by hhsearch."""
+        res = await self._request("GET", f"template/{','.join(pdb_ids)}", stream=True)
+        await asyncio.to_thread(_extract_templates, res, Path(path))
+
+    async def wait(self, seqs: Sequence[str], mode: str, use_pairing: bool = False, N: int = 101) -> str:
+        """Submit a ticket and poll it until it completes. Returns the ticket id."""
+        delay = self.poll_interval
+        out = await self.submit(seqs, mode, use_pairing, N)
+        while out["status"] in ["UNKNOWN", "RATELIMIT"]:
+            sleep_time = 5 + random.randint(0, 5)
+            logger.error(f"Sleeping for {sleep_time}s. Reason: {out['status']}")
+            await asyncio.sleep(sleep_time)
+            out = await self.submit(seqs, mode, use_pairing, N)
+
+        if out["status"] == "ERROR":
+            raise Exception(
+                "MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. "
+                "If error persists, please try again an hour later."
+            )
+        if out["status"] == "MAINTENANCE":
+            raise Exception("MMseqs2 API is undergoing maintenance. Please try again in a few minutes.")
+
+        ticket_id = out["id"]
+        logger.info(f"MSA ticket {ticket_id}: {out['status']}")
+        while out["status"] in ["UNKNOWN", "RUNNING", "PENDING"]:
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * self.backoff, self.max_poll_interval)
+            previous, out = out["status"], await self.status(ticket_id)
+            if out["status"] != previous:
+                logger.info(f"MSA ticket {ticket_id}: {out['status']}")
+
+        if out["status"] != "COMPLETE":
+            raise Exception(
+                "MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. "
+                "If error persists, please try again an hour later."
+            )
+        return ticket_id
+
+    async def fetch(
+        self,
+        x: Union[str, Sequence[str]],
+        prefix: Union[str, Path],
+        use_env: bool = True,
+        use_filter: bool = True,
+        use_pairing: bool = False,
+        pairing_strategy: str = "greedy",
+    ) -> str:
+        """Search the unique sequences of `x` unless the result archive already exists in the
+        `{prefix}_{mode}` directory used by `run_mmseqs2`. Returns that directory."""
+        seqs = [x] if isinstance(x, str) else list(x)
+        mode = get_mmseqs2_mode(use_env, use_filter, use_pairing, pairing_strategy)
+
+        path = f"{prefix}_{mode}"
+        os.makedirs(path, exist_ok=True)
+        tar_gz_file = f"{path}/out.tar.gz"
+        if not os.path.isfile(tar_gz_file):
+            ticket_id = await self.wait(list(dict.fromkeys(seqs)), mode, use_pairing)
+            await self.download(ticket_id, tar_gz_file)
+        return path
+
+    async def search(
+        self,
+        x: Union[str, Sequence[str]],
+        prefix: Union[str, Path],
+        use_env: bool = True,
+        use_filter: bool = True,
+        use_templates: bool = False,
+        use_pairing: bool = False,
+        pairing_strategy: str = "greedy",
+    ) -> Union[List[str], Tuple[List[str], List[Optional[str]]]]:
+        """Search `x` like `run_mmseqs2`, which calls this, and read the MSAs and
+        template paths from the `{prefix}_{mode}` result directory."""
+        seqs = [x] if isinstance(x, str) else list(x)
+        if use_pairing:
+            use_templates = False
+        path = await self.fetch(seqs, prefix, use_env, use_filter, use_pairing, pairing_strategy)
+        tar_gz_file = f"{path}/out.tar.gz"
+
+        # deduplicate and keep track of order, the server numbers queries starting at 101
+        N = 101
+        index = {seq: N + n for n, seq in enumerate(dict.fromkeys(seqs))}
+        Ms = [index[seq] for seq in seqs]
+
+        a3m_files = get_mmseqs2_a3m_files(path, use_env, use_pairing)
+        if any(not os.path.isfile(a3m_file) for a3m_file in a3m_files):
+            await asyncio.to_thread(_extract_tar, tar_gz_file, path)
+
+        a3m_lines = await asyncio.to_thread(read_mmseqs2_a3m, a3m_files, Ms)
+        if not use_templates:
+            return a3m_lines
+
+        templates = read_mmseqs2_templates(path)
+        template_paths = {}
+
+        async def fetch(M: int, pdb_ids: List[str]):
+            template_path = f"{path}/templates_{M}"
+            if not os.path.isdir(template_path):
+                await self.fetch_templates(pdb_ids[:20], template_path)
+            template_paths[M] = template_path
+
+        await asyncio.gather(*[fetch(M, pdb_ids) for M, pdb_ids in templates.items()])
+        return a3m_lines, [template_paths.get(M) for M in Ms]
+
+    async def search_many(self, searches: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Run many `search` calls concurrently, each given as a dict of keyword arguments."""
+        return await asyncio.gather(*[self.search(**search) for search in searches])
+
+
+def run_sync(coroutine):
+    """Run a coroutine from synchronous code, also if an event loop is already running
+    in this thread (e.g. in a notebook)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _write_stream(res: requests.Response, path: Path):
+    # write to a temporary file first, so an interrupted download is never mistaken for a result
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as out:
+        for chunk in res.iter_content(chunk_size=1024 * 1024):
+            out.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def _extract_tar(tar_gz_file: str, path: str):
+    with tarfile.open(tar_gz_file) as tar_gz:
+        tar_gz.extractall(path)
+
+
+def _extract_templates(res: requests.Response, path: Path):
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir()
+    with tarfile.open(fileobj=res.raw, mode="r|gz") as tar:
+        tar.extractall(path=tmp_path)
+    os.symlink("pdb70_a3m.ffindex", tmp_path.joinpath("pdb70_cs219.ffindex"))
+    tmp_path.joinpath("pdb70_cs219.ffdata").write_text("")
+    os.replace(tmp_path, path)
@@ -0,0 +1,117 @@
+"""
+Persistent MSA cache shared across runs and result directories.
+
+Entries are keyed by a hash of the query sequence(s) and everything else that changes the search
+result (kind of entry, MSA mode, pairing strategy, server and template settings). Every entry is
+a single pickle file that is written atomically, so several `colabfold_batch` processes can use
+the same cache directory at once. Reading an entry updates its modification time, which is used
+to evict the least recently used entries once the cache grows beyond its size limit.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+# bump when the format of the cached values changes
+CACHE_VERSION = 1
+
+
+class MsaCache:
+    def __init__(self, cache_dir: Union[str, Path], max_size: Optional[int] = None, namespace: str = ""):
+        """
+        :param cache_dir: Directory of the cache, created if it doesn't exist
+        :param max_size: Maximum size of the cache in bytes, None for no limit
+        :param namespace: Added to all keys, e.g. the MSA server url or database version
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._size = None
+
+    def key(self, kind: str, seqs: Union[str, Sequence[str]], **params) -> str:
+        seqs = [seqs] if isinstance(seqs, str) else list(seqs)
+        fields = [f"v{CACHE_VERSION}", self.namespace, kind, ":".join(seqs)]
+        fields += [f"{name}={params[name]}" for name in sorted(params)]
+        return hashlib.sha256("\n".join(fields).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key[:2], f"{key}.pickle")
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            with path.open("rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            # a corrupted entry is treated as missing and will be overwritten
+            logger.warning(f"Could not read MSA cache entry {path}: {e}")
+            return default
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file in the same directory, then atomically move it in place,
+        # so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.max_size is not None:
+            with self._lock:
+                if self._size is None or self._size + size > self.max_size:
+                    self.evict()
+                else:
+                    self._size += size
+
+    def entries(self):
+        for path in self.cache_dir.glob("*/*.pickle"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            yield path, stat
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into `max_size`."""
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        for path, stat in entries:
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                # another process evicted it already
+                pass
+            size -= stat.st_size
+        if removed > 0:
+            logger.info(f"Evicted {removed} entries from the MSA cache in {self.cache_dir}")
+        self._size = size
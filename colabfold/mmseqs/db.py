@@ -0,0 +1,266 @@
+"""
+Read-only access to MMseqs2 databases, e.g. the `final.a3m` written by `colabfold_search --unpack 0`.
+
+A database is a data file with null terminated entries, a `.index` file with a
+`key\toffset\tlength` line per entry and a `.dbtype` file. Entries are read by offset from a
+memory map of the data file, so using the search output doesn't need one file per query.
+"""
+
+import logging
+import mmap
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def read_db_index(index_file: Path) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read the keys, offsets and lengths of the entries of an MMseqs2 database from its `.index`
+    file, ordered by offset. The length includes the null terminator."""
+    keys, offsets, lengths = [], [], []
+    with index_file.open("rb") as f:
+        for line in f:
+            key, offset, length = line.split(b"\t")
+            keys.append(int(key))
+            offsets.append(int(offset))
+            lengths.append(int(length))
+    keys = np.array(keys, dtype=np.int64)
+    offsets = np.array(offsets, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+    order = np.argsort(offsets, kind="stable")
+    return keys[order], offsets[order], lengths[order]
+
+
+def is_mmseqs_db(path: Union[str, Path]) -> bool:
+    path = Path(path)
+    return path.with_name(path.name + ".dbtype").is_file() and path.with_name(path.name + ".index").is_file()
+
+
+def merge_dbs(dbs: List[Path], output: Path, key_offsets: List[int]):
+    """Concatenate MMseqs2 databases, adding `key_offsets[i]` to the keys of `dbs[i]`, like
+    `mmseqs concatdbs` but for any number of databases at once. Missing databases are skipped."""
+    index = []
+    offset = 0
+    dbtype = None
+    with output.open("wb") as out:
+        for db, key_offset in zip(dbs, key_offsets):
+            if not is_mmseqs_db(db):
+                continue
+            dbtype = dbtype or db.with_name(db.name + ".dbtype").read_bytes()
+            keys, offsets, lengths = read_db_index(db.with_name(db.name + ".index"))
+            with db.open("rb") as f:
+                shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+            index.append(np.stack([keys + key_offset, offsets + offset, lengths], axis=1))
+            offset += db.stat().st_size
+    if dbtype is None:
+        output.unlink()
+        return
+    index = np.concatenate(index)
+    index = index[np.argsort(index[:, 0], kind="stable")]
+    with output.with_name(output.name + ".index").open("w") as f:
+        for key, entry_offset, length in index.tolist():
+            f.write(f"{key}\t{entry_offset}\t{length}\n")
+    output.with_name(output.name + ".dbtype").write_bytes(dbtype)
+
+
+def append_db(db: Path, new: Path, key_offset: int):
+    """Append the entries of database `new` to `db` in place, adding `key_offset` to their keys,
+    without copying the entries of `db`. The index is replaced after the entries are written, so an
+    interrupted append leaves `db` as it was. Creates `db` if it doesn't exist."""
+    if not is_mmseqs_db(new):
+        return
+    if not is_mmseqs_db(db):
+        merge_dbs([new], db, [key_offset])
+        return
+    keys, offsets, lengths = read_db_index(new.with_name(new.name + ".index"))
+    offset = db.stat().st_size
+    with db.open("ab") as out, new.open("rb") as f:
+        shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+    index = db.with_name(db.name + ".index")
+    tmp_index = index.with_name(index.name + ".tmp")
+    shutil.copyfile(index, tmp_index)
+    order = np.argsort(keys, kind="stable")
+    with tmp_index.open("a") as f:
+        for key, entry_offset, length in zip(keys[order].tolist(), offsets[order].tolist(), lengths[order].tolist()):
+            f.write(f"{key + key_offset}\t{entry_offset + offset}\t{length}\n")
+    os.replace(tmp_index, index)
+
+
+def fan_out_db(db: Path, output: Path, entries: List[int]):
+    """Move the database `db` to `output`, where key `i` is the entry of key `entries[i]` of `db`.
+    Keys with the same entry share it in the data file, so nothing is copied. Does nothing if `db`
+    was moved already."""
+    if not is_mmseqs_db(db):
+        return
+    keys, offsets, lengths = read_db_index(db.with_name(db.name + ".index"))
+    order = np.argsort(keys, kind="stable")
+    keys, offsets, lengths = keys[order], offsets[order], lengths[order]
+    entries = np.asarray(entries, dtype=np.int64)
+    found = np.searchsorted(keys, entries).clip(max=max(len(keys) - 1, 0))
+    exists = (keys[found] == entries) if len(keys) > 0 else np.zeros(len(entries), dtype=bool)
+    tmp_index = output.with_name(output.name + ".index.tmp")
+    with tmp_index.open("w") as f:
+        for key in np.flatnonzero(exists).tolist():
+            f.write(f"{key}\t{offsets[found[key]]}\t{lengths[found[key]]}\n")
+    shutil.copyfile(db.with_name(db.name + ".dbtype"), output.with_name(output.name + ".dbtype"))
+    os.replace(tmp_index, output.with_name(output.name + ".index"))
+    os.replace(db, output)
+    remove_db(db)
+
+
+def max_db_key(db: Path) -> int:
+    """The largest key of a database, -1 if it doesn't exist or is empty"""
+    if not is_mmseqs_db(db):
+        return -1
+    keys, _, _ = read_db_index(db.with_name(db.name + ".index"))
+    return int(keys.max()) if len(keys) > 0 else -1
+
+
+def remove_db(db: Path):
+    """Remove a database, its index, type and lookup, like `mmseqs rmdb`"""
+    for suffix in ["", ".index", ".dbtype", ".lookup", ".source"]:
+        path = db.with_name(db.name + suffix)
+        if path.is_file():
+            os.remove(path)
+
+
+class MmseqsDb:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        if not self.path.is_file():
+            # databases written with several threads can be split into path.0, path.1, ...
+            raise FileNotFoundError(f"{self.path} does not exist, merge split databases with `mmseqs mergedbs`")
+        keys, offsets, lengths = read_db_index(self.path.with_name(self.path.name + ".index"))
+        # sorted keys to look up entries with a binary search, a dict would be much larger
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._offsets = offsets[order]
+        self._lengths = lengths[order]
+        self._data = None
+        self._lock = threading.Lock()
+
+    def _mmap(self) -> mmap.mmap:
+        with self._lock:
+            if self._data is None:
+                with self.path.open("rb") as f:
+                    self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._data
+
+    def _find(self, key: int) -> Optional[int]:
+        i = int(np.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return None
+
+    def __contains__(self, key: int) -> bool:
+        return self._find(key) is not None
+
+    def __getitem__(self, key: int) -> str:
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        offset, length = int(self._offsets[i]), int(self._lengths[i])
+        data = self._mmap()
+        end = offset + length
+        if length > 0 and data[end - 1] == 0:
+            end -= 1
+        return data[offset:end].decode()
+
+    def get(self, key: int, default: Optional[str] = None) -> Optional[str]:
+        return self[key] if key in self else default
+
+    def keys(self) -> Iterator[int]:
+        return iter(self._keys.tolist())
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def close(self):
+        with self._lock:
+            if self._data is not None:
+                self._data.close()
+                self._data = None
+
+
+class DbMsa:
+    """The MSA of a job in a search result database, as the `a3m_lines` of `get_queries`. The MSA
+    is only read from the databases when it is accessed, in the format of `colabfold_search --unpack 1`."""
+
+    def __init__(self, result: "SearchResultDb", ids: List[int], cardinality: List[int]):
+        self.result = result
+        self.ids = ids
+        self.cardinality = cardinality
+
+    def __len__(self) -> int:
+        return 1
+
+    def __getitem__(self, index: int) -> str:
+        if index not in (0, -1):
+            raise IndexError(index)
+        return self.result.read_msa(self.ids, self.cardinality)
+
+
+class SearchResultDb:
+    """The databases of a `colabfold_search --unpack 0` result folder: the `qdb` query database
+    with its `qdb.lookup`, the unpaired `final.a3m` and the paired `pair.a3m` and `pair.env.a3m`."""
+
+    PAIRED_DBS = ["pair.a3m", "pair.env.a3m"]
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        self.base = path if path.is_dir() else path.parent
+        self.unpaired = MmseqsDb(path if path.is_file() else path.joinpath("final.a3m"))
+        self.queries = MmseqsDb(self.base.joinpath("qdb"))
+        self.paired = [
+            MmseqsDb(self.base.joinpath(name))
+            for name in self.PAIRED_DBS
+            if is_mmseqs_db(self.base.joinpath(name))
+        ]
+
+    def read_msa(self, ids: List[int], cardinality: List[int]) -> str:
+        from colabfold.input import msa_to_str
+
+        unpaired_msa = [self.unpaired[id] for id in ids]
+        if len(ids) == 1 and cardinality[0] == 1:
+            return unpaired_msa[0]
+        paired_msa = None
+        if len(ids) > 1 and self.paired:
+            paired_msa = ["".join(db.get(id, "") for db in self.paired) for id in ids]
+        query_seqs_unique = [self.queries[id].strip() for id in ids]
+        return msa_to_str(unpaired_msa, paired_msa, query_seqs_unique, cardinality)
+
+    def close(self):
+        for db in [self.unpaired, self.queries] + self.paired:
+            db.close()
+
+    def get_queries(self) -> List[Tuple[str, Union[str, List[str]], DbMsa, None]]:
+        """The jobs of the search in the format of `colabfold.input.get_queries`"""
+        jobs: Dict[int, Tuple[str, List[int]]] = {}
+        with self.base.joinpath("qdb.lookup").open() as f:
+            for line in f:
+                id, name, file_number = line.rstrip("\n").split("\t")[:3]
+                jobs.setdefault(int(file_number), (name, []))[1].append(int(id))
+        # written by colabfold_search, without it every chain of a job is used once
+        cardinalities = {}
+        cardinality_file = self.base.joinpath("qdb.cardinality")
+        if cardinality_file.is_file():
+            with cardinality_file.open() as f:
+                for line in f:
+                    id, cardinality = line.split("\t")
+                    cardinalities[int(id)] = int(cardinality)
+
+        queries = []
+        for file_number in sorted(jobs):
+            name, ids = jobs[file_number]
+            cardinality = [cardinalities.get(id, 1) for id in ids]
+            query_sequences = [
+                self.queries[id].strip() for id, count in zip(ids, cardinality) for _ in range(count)
+            ]
+            query_sequence = query_sequences[0] if len(query_sequences) == 1 else query_sequences
+            queries.append((name, query_sequence, DbMsa(self, ids, cardinality), None))
+        return queries
@@ -0,0 +1,235 @@
+"""
+Checkpoints of the `colabfold_search` stages, so an interrupted search resumes where it stopped.
+
+A search is a graph of stages (query database, uniref, environmental and template searches, merging
+and pairing), each running a list of MMseqs2 commands. `search_manifest.json` in the result folder
+records every completed command with a hash of its parameters, its output and its duration. The
+hash is chained with the commands before it in the stage and with the stages it depends on, so
+changing a parameter only reruns that command and everything downstream of it.
+
+The resource usage of the commands is kept as well and summarized per stage in
+`search_profile.json` and `search_profile.csv`, to compare search settings on a workload.
+"""
+
+import csv
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from colabfold.mmseqs.db import remove_db
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "search_manifest.json"
+# bump when the hashes or the layout of the manifest change
+MANIFEST_VERSION = 1
+PROFILE_NAMES = ["search_profile.json", "search_profile.csv"]
+PROFILE_FIELDS = ["wall_time", "cpu_time", "max_rss", "bytes_written"]
+
+
+def params_hash(previous: str, params: Sequence[Union[str, Path]]) -> str:
+    """Hash of a command chained with the hash before it. The number of threads doesn't change
+    the result, so a search can resume with a different number of threads."""
+    fields = [previous]
+    params = [str(param) for param in params]
+    for i, param in enumerate(params):
+        if param == "--threads" or (i > 0 and params[i - 1] == "--threads"):
+            continue
+        fields.append(param)
+    return hashlib.sha256("\0".join(fields).encode()).hexdigest()
+
+
+class SearchManifest:
+    def __init__(
+        self,
+        path: Union[str, Path],
+        run: Callable[[List[Union[str, Path]]], Optional[Dict[str, float]]],
+        output: Callable[[List[Union[str, Path]]], Optional[Path]] = lambda params: None,
+        dry_run: bool = False,
+    ):
+        """
+        :param path: The manifest file, usually `base/search_manifest.json`
+        :param run: Runs an MMseqs2 command, returns its resource usage or None if it was skipped
+        :param output: The output database of an MMseqs2 command, removed before the command
+            runs again with changed parameters
+        :param dry_run: Only print which commands would run or are skipped
+        """
+        self.path = Path(path)
+        self.run = run
+        self.output = output
+        self.dry_run = dry_run
+        self._lock = threading.Lock()
+        # the hash of every stage that finished in this run
+        self._hashes: Dict[str, str] = {}
+        self.stages = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with self.path.open() as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {self.path}, running all search stages: {e}")
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            logger.warning(f"{self.path} is from another version, running all search stages")
+            return {}
+        return manifest.get("stages", {})
+
+    def stage(self, name: str, depends: Sequence[str] = (), inputs: Optional[Dict[str, str]] = None) -> "SearchStage":
+        """The stage `name`, to run its commands in a `with` block"""
+        return SearchStage(self, name, list(depends), dict(inputs or {}))
+
+    def stage_hash(self, name: str) -> str:
+        if name in self._hashes:
+            return self._hashes[name]
+        # a stage that isn't part of this run, e.g. the query database when searching an existing qdb
+        recorded = self.stages.get(name, {})
+        return recorded.get("hash", "") if recorded.get("complete") else ""
+
+    def profile(self) -> Dict[str, Dict[str, Any]]:
+        """The resource usage of every stage: the sum of the times and bytes written of its commands
+        and the peak memory of the largest one. Commands completed in earlier runs are included."""
+        profile = {}
+        for name, entry in self.stages.items():
+            commands = [{"command": step["command"], **step["usage"]} for step in entry["steps"] if step.get("usage")]
+            stage = {
+                # includes the steps that aren't MMseqs2 commands
+                "wall_time": entry["duration"],
+                "cpu_time": round(sum(command["cpu_time"] for command in commands), 3),
+                "max_rss": max((command["max_rss"] for command in commands), default=0),
+                "bytes_written": sum(command["bytes_written"] for command in commands),
+                "complete": entry["complete"],
+                "commands": commands,
+            }
+            profile[name] = stage
+        return profile
+
+    def write_profile(self, base: Path, settings: Optional[Dict[str, Any]] = None):
+        """Write the resource usage of the stages to `base/search_profile.json` and a row per stage
+        to `base/search_profile.csv`, with the search `settings` that are compared"""
+        if self.dry_run:
+            return
+        profile = self.profile()
+        json_file, csv_file = (base.joinpath(name) for name in PROFILE_NAMES)
+        json_file.write_text(json.dumps({"settings": settings or {}, "stages": profile}, indent=2))
+        with csv_file.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "commands"] + PROFILE_FIELDS)
+            for name, stage in profile.items():
+                writer.writerow([name, len(stage["commands"])] + [stage[field] for field in PROFILE_FIELDS])
+
+    def update(self, name: str, entry: dict, stage_hash: Optional[str] = None):
+        if self.dry_run:
+            if stage_hash is not None:
+                self._hashes[name] = stage_hash
+            return
+        with self._lock:
+            self.stages[name] = entry
+            if stage_hash is not None:
+                self._hashes[name] = stage_hash
+            content = json.dumps({"version": MANIFEST_VERSION, "stages": self.stages}, indent=2)
+            # write to a temporary file and move it in place, so a crash never leaves a partial manifest
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+
+class SearchStage:
+    def __init__(self, manifest: SearchManifest, name: str, depends: List[str], inputs: Dict[str, str]):
+        self.manifest = manifest
+        self.name = name
+        self.depends = depends
+        self.inputs = inputs
+        self.start_hash = params_hash(
+            "",
+            [name]
+            + [f"{dep}={manifest.stage_hash(dep)}" for dep in depends]
+            + [f"{key}={inputs[key]}" for key in sorted(inputs)],
+        )
+        self.hash = self.start_hash
+        recorded = manifest.stages.get(name)
+        self._recorded = list(recorded["steps"]) if recorded else []
+        self._steps = []
+        # set once a recorded command had other parameters, the outputs from there on are outdated
+        self.stale = recorded is not None and recorded.get("start_hash") != self.start_hash
+        if self.stale:
+            self._recorded = []
+
+    def __enter__(self) -> "SearchStage":
+        if self.manifest.dry_run:
+            print(f"{self.name}:")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        complete = exc_type is None
+        self.manifest.update(self.name, self._entry(complete), self.hash if complete else None)
+        return False
+
+    def _entry(self, complete: bool) -> dict:
+        return {
+            "depends": self.depends,
+            "inputs": self.inputs,
+            "start_hash": self.start_hash,
+            "hash": self.hash,
+            "complete": complete,
+            "duration": round(sum(step["duration"] for step in self._steps), 3),
+            "outputs": [step["output"] for step in self._steps if step["output"] is not None],
+            "steps": self._steps,
+        }
+
+    def run(self, params: List[Union[str, Path]]):
+        """Run an MMseqs2 command unless it completed in an earlier run"""
+        output = self.manifest.output(params)
+        self._step(params_hash(self.hash, params), " ".join(str(param) for param in params), output,
+                   lambda: self.manifest.run(params))
+
+    def call(self, description: str, function: Callable[[], Any]):
+        """Run a step that isn't an MMseqs2 command, e.g. removing temporary files"""
+        self._step(params_hash(self.hash, [description]), description, None, function)
+
+    def _step(self, step_hash: str, command: str, output: Optional[Path], function: Callable[[], Any]):
+        index = len(self._steps)
+        self.hash = step_hash
+        recorded = self._recorded[index] if index < len(self._recorded) else None
+        if recorded is not None and recorded["hash"] == step_hash:
+            self._steps.append(recorded)
+            if self.manifest.dry_run:
+                print(f"  done  {command}")
+            else:
+                logger.info(f"Skipping completed step of search stage {self.name}: {command}")
+            return
+        if recorded is not None:
+            self.stale = True
+            del self._recorded[index:]
+        if self.manifest.dry_run:
+            print(f"  run   {command}")
+            return
+
+        if self.stale and output is not None:
+            remove_db(output)
+        start = time.time()
+        usage = function()
+        step = {
+            "hash": step_hash,
+            "command": command,
+            "output": None if output is None else str(output),
+            "duration": round(time.time() - start, 3),
+        }
+        if isinstance(usage, dict):
+            step["usage"] = usage
+        self._steps.append(step)
+        self.manifest.update(self.name, self._entry(False))
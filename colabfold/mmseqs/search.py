@@ -2,17 +2,37 @@
 Functionality for running mmseqs locally. Takes in a fasta file, outputs final.a3m
 """
 
+import hashlib
+import heapq
 import logging
 import math
+import multiprocessing
 import os
+import shlex
 import shutil
 import subprocess
+import sys
+import time
 import json
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-from colabfold.input import get_queries, msa_to_str, safe_filename
+from colabfold.input import is_complex_query, msa_to_str, safe_filename, stream_queries
+from colabfold.mmseqs.db import (
+    MmseqsDb,
+    SearchResultDb,
+    append_db,
+    fan_out_db,
+    is_mmseqs_db,
+    max_db_key,
+    merge_dbs,
+    remove_db,
+)
+from colabfold.mmseqs.manifest import MANIFEST_NAME, PROFILE_NAMES, SearchManifest
 from colabfold.utils import AF3Utils
 
 logger = logging.getLogger(__name__)
@@ -30,20 +50,118 @@ MODULE_OUTPUT_POS = {
     "search":       3,
 }
 
-def run_mmseqs(mmseqs: Path, params: List[Union[str, Path]]):
+def mmseqs_output(params: List[Union[str, Path]]) -> Optional[Path]:
+    """The output database of an MMseqs2 command, if it has one"""
+    if params[0] not in MODULE_OUTPUT_POS:
+        return None
+    return Path(params[MODULE_OUTPUT_POS[params[0]]])
+
+
+def run_mmseqs(mmseqs: Path, params: List[Union[str, Path]]) -> Optional[Dict[str, float]]:
+    """Run an MMseqs2 command and return its resource usage: wall and CPU time in seconds, the peak
+    resident memory and the bytes written to storage. Returns None if the command was skipped."""
     module = params[0]
-    if module in MODULE_OUTPUT_POS:
-        output_pos = MODULE_OUTPUT_POS[module]
-        output_path = Path(params[output_pos]).with_suffix('.dbtype')
+    output = mmseqs_output(params)
+    if output is not None:
+        output_path = output.with_name(output.name + ".dbtype")
         if output_path.exists():
             logger.info(f"Skipping {module} because {output_path} already exists")
             return
+    if module == "rmdb":
+        db = Path(params[1])
+        if not any(db.with_name(db.name + suffix).exists() for suffix in ["", ".index", ".dbtype"]):
+            # removed before the search was interrupted
+            logger.info(f"Skipping rmdb because {db} doesn't exist")
+            return
 
     params_log = " ".join(str(i) for i in params)
     logger.info(f"Running {mmseqs} {params_log}")
     # hide MMseqs2 verbose paramters list that clogs up the log
     os.environ["MMSEQS_CALL_DEPTH"] = "1"
-    subprocess.check_call([mmseqs] + params)
+    start = time.time()
+    process = subprocess.Popen([mmseqs] + params)
+    try:
+        # the resource usage of only this child, other stages can run commands at the same time
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, [mmseqs] + params)
+    return {
+        "wall_time": round(time.time() - start, 3),
+        "cpu_time": round(usage.ru_utime + usage.ru_stime, 3),
+        # kilobytes on linux, bytes on macOS
+        "max_rss": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        # in blocks of 512 bytes
+        "bytes_written": usage.ru_oublock * 512,
+    }
+
+
+def search_manifest(base: Path, mmseqs: Path, dry_run: bool = False) -> SearchManifest:
+    """The checkpoints of a search in `base`, see `colabfold.mmseqs.manifest`"""
+    return SearchManifest(
+        base.joinpath(MANIFEST_NAME),
+        lambda params: run_mmseqs(mmseqs, params),
+        mmseqs_output,
+        dry_run=dry_run,
+    )
+
+
+def run_stages(
+    stages: Dict[str, Tuple[Callable[[int], None], List[str], float]],
+    threads: int,
+    parallel: bool = True,
+):
+    """Run search stages given as `name: (run(threads), dependencies, weight)` after their dependencies.
+
+    Stages whose dependencies are done run at the same time and split the threads by their weight.
+    A failing stage doesn't stop the stages that don't depend on it, so a rerun can skip everything that
+    completed. The first error is raised after all other stages finished."""
+    done = set()
+    failed = {}
+    remaining = dict(stages)
+    while remaining:
+        ready = [name for name, (_, depends, _) in remaining.items() if all(dep in done for dep in depends)]
+        blocked = [name for name, (_, depends, _) in remaining.items() if any(dep in failed for dep in depends)]
+        for name in blocked:
+            logger.error(f"Skipping search stage {name} because a stage it depends on failed")
+            failed[name] = None
+            del remaining[name]
+        if not ready:
+            if remaining and not blocked:
+                raise ValueError(f"Search stages {list(remaining)} have unknown or cyclic dependencies")
+            continue
+
+        if parallel and len(ready) > 1:
+            total_weight = sum(remaining[name][2] for name in ready)
+            stage_threads = {name: max(1, int(threads * remaining[name][2] / total_weight)) for name in ready}
+            logger.info("Running search stages " + ", ".join(f"{name} ({stage_threads[name]} threads)" for name in ready))
+            with ThreadPoolExecutor(len(ready)) as executor:
+                futures = {name: executor.submit(remaining[name][0], stage_threads[name]) for name in ready}
+            results = {}
+            for name, future in futures.items():
+                results[name] = future.exception()
+        else:
+            results = {}
+            for name in ready:
+                try:
+                    remaining[name][0](threads)
+                    results[name] = None
+                except Exception as e:
+                    results[name] = e
+        for name, error in results.items():
+            del remaining[name]
+            if error is None:
+                done.add(name)
+            else:
+                logger.error(f"Search stage {name} failed: {error}")
+                failed[name] = error
+    errors = [error for error in failed.values() if error is not None]
+    if errors:
+        raise errors[0]
 
 
 def mmseqs_search_monomer(
@@ -68,12 +186,23 @@ def mmseqs_search_monomer(
     gpu: int = 0,
     gpu_server: int = 0,
     unpack: bool = True,
+    parallel_stages: bool = True,
+    manifest: Optional[SearchManifest] = None,
+    query_db: str = "qdb",
+    chain_entries: Optional[List[int]] = None,
 ):
     """Run mmseqs with a local colabfold database set
 
     db1: uniprot db (UniRef30)
     db2: Template (unused by default)
     db3: metagenomic db (colabfold_envdb_202108 or bfd_mgy_colabfold, the former is preferred)
+
+    Completed steps are recorded in `manifest` (default: base/search_manifest.json) and skipped
+    when the search runs again.
+
+    With `chain_entries`, `query_db` has the unique sequences of the chains in qdb, the entry of
+    chain `i` is `chain_entries[i]`. The results are searched once per unique sequence and then
+    referenced by every chain with that sequence in final.a3m and the template database.
     """
     if filter:
         # 0.1 was not used in benchmarks due to POSIX shell bug in line above
@@ -126,87 +255,102 @@ def mmseqs_search_monomer(
     filter_param = ["--filter-msa", str(filter), "--filter-min-enable", "1000", "--diff", str(diff), "--qid", "0.0,0.2,0.4,0.6,0.8,1.0", "--qsc", "0", "--max-seq-id", "0.95",]
     expand_param = ["--expansion-mode", "0", "-e", str(expand_eval), "--expand-filter-clusters", str(filter), "--max-seq-id", "0.95",]
 
-    if not base.joinpath("uniref.a3m").with_suffix('.a3m.dbtype').exists():
-        run_mmseqs(mmseqs, ["search", base.joinpath("qdb"), dbbase.joinpath(uniref_db), base.joinpath("res"), base.joinpath("tmp"), "--threads", str(threads)] + search_param)
-        run_mmseqs(mmseqs, ["mvdb", base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res")])
-        run_mmseqs(mmseqs, ["lndb", base.joinpath("qdb_h"), base.joinpath("prof_res_h")])
-        run_mmseqs(mmseqs, ["expandaln", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res"), dbbase.joinpath(f"{uniref_db}{dbSuffix2}"), base.joinpath("res_exp"), "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + expand_param)
-        run_mmseqs(mmseqs, ["align", base.joinpath("prof_res"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads", str(threads), "--alt-ali", "10", "-a"])
-        run_mmseqs(mmseqs, ["filterresult", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
-                            base.joinpath("res_exp_realign"), base.joinpath("res_exp_realign_filter"), "--db-load-mode",
-                            str(db_load_mode), "--qid", "0", "--qsc", str(qsc), "--diff", "0", "--threads",
-                            str(threads), "--max-seq-id", "1.0", "--filter-min-enable", "100"])
-        run_mmseqs(mmseqs, ["result2msa", base.joinpath("qdb"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
-                            base.joinpath("res_exp_realign_filter"), base.joinpath("uniref.a3m"), "--msa-format-mode",
-                            "6", "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + filter_param)
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp_realign_filter")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp_realign")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res")])
-    else:
-        logger.info(f"Skipping {uniref_db} search because uniref.a3m already exists")
-
-    if use_env and not base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m").with_suffix('.a3m.dbtype').exists():
-        run_mmseqs(mmseqs, ["search", base.joinpath("prof_res"), dbbase.joinpath(metagenomic_db), base.joinpath("res_env"),
-                            base.joinpath("tmp3"), "--threads", str(threads)] + search_param)
-        run_mmseqs(mmseqs, ["expandaln", base.joinpath("prof_res"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"), base.joinpath("res_env"),
-                            dbbase.joinpath(f"{metagenomic_db}{dbSuffix2}"), base.joinpath("res_env_exp"), "-e", str(expand_eval),
-                            "--expansion-mode", "0", "--db-load-mode", str(db_load_mode), "--threads", str(threads)])
-        run_mmseqs(mmseqs, ["align", base.joinpath("tmp3/latest/profile_1"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
-                            base.joinpath("res_env_exp"), base.joinpath("res_env_exp_realign"), "--db-load-mode",
-                            str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads",
-                            str(threads), "--alt-ali", "10", "-a"])
-        run_mmseqs(mmseqs, ["filterresult", base.joinpath("qdb"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
-                            base.joinpath("res_env_exp_realign"), base.joinpath("res_env_exp_realign_filter"),
-                            "--db-load-mode", str(db_load_mode), "--qid", "0", "--qsc", str(qsc), "--diff", "0",
-                            "--max-seq-id", "1.0", "--threads", str(threads), "--filter-min-enable", "100"])
-        run_mmseqs(mmseqs, ["result2msa", base.joinpath("qdb"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
-                            base.joinpath("res_env_exp_realign_filter"),
-                            base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m"), "--msa-format-mode", "6",
-                            "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + filter_param)
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_env_exp_realign_filter")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_env_exp_realign")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_env_exp")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_env")])
-    elif use_env:
-        logger.info(f"Skipping {metagenomic_db} search because bfd.mgnify30.metaeuk30.smag30.a3m already exists")
-
-    if use_templates and not base.joinpath(f"{template_db}.m8").with_suffix('.m8.dbtype').exists():
-        run_mmseqs(mmseqs, ["search", base.joinpath("prof_res"), dbbase.joinpath(template_db), base.joinpath("res_pdb"),
-                            base.joinpath("tmp2"), "--db-load-mode", str(db_load_mode), "--threads", str(threads), "-a", "-e", "0.1"] + template_search_param)
-        run_mmseqs(mmseqs, ["convertalis", base.joinpath("prof_res"), dbbase.joinpath(f"{template_db}{dbSuffix3}"), base.joinpath("res_pdb"),
-                            base.joinpath(f"{template_db}"), "--format-output",
-                            "query,target,fident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,evalue,bits,cigar",
-                            "--db-output", "1",
-                            "--db-load-mode", str(db_load_mode), "--threads", str(threads)])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_pdb")])
-    elif use_templates:
-        logger.info(f"Skipping {template_db} search because {template_db}.m8 already exists")
+    if manifest is None:
+        manifest = search_manifest(base, mmseqs)
+    unique = "" if chain_entries is None else ".unique"
 
-    if use_env:
-        run_mmseqs(mmseqs, ["mergedbs", base.joinpath("qdb"), base.joinpath("final.a3m"), base.joinpath("uniref.a3m"), base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("uniref.a3m")])
-    else:
-        run_mmseqs(mmseqs, ["mvdb", base.joinpath("uniref.a3m"), base.joinpath("final.a3m")])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("uniref.a3m")])
+    def search_uniref(threads: int):
+        with manifest.stage("uniref", ["querydb"]) as stage:
+            stage.run(["search", base.joinpath(query_db), dbbase.joinpath(uniref_db), base.joinpath("res"), base.joinpath("tmp"), "--threads", str(threads)] + search_param)
+            stage.run(["mvdb", base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res")])
+            stage.run(["lndb", base.joinpath(f"{query_db}_h"), base.joinpath("prof_res_h")])
+            stage.run(["expandaln", base.joinpath(query_db), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res"), dbbase.joinpath(f"{uniref_db}{dbSuffix2}"), base.joinpath("res_exp"), "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + expand_param)
+            stage.run(["align", base.joinpath("prof_res"), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads", str(threads), "--alt-ali", "10", "-a"])
+            stage.run(["filterresult", base.joinpath(query_db), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
+                       base.joinpath("res_exp_realign"), base.joinpath("res_exp_realign_filter"), "--db-load-mode",
+                       str(db_load_mode), "--qid", "0", "--qsc", str(qsc), "--diff", "0", "--threads",
+                       str(threads), "--max-seq-id", "1.0", "--filter-min-enable", "100"])
+            stage.run(["result2msa", base.joinpath(query_db), dbbase.joinpath(f"{uniref_db}{dbSuffix1}"),
+                       base.joinpath("res_exp_realign_filter"), base.joinpath("uniref.a3m"), "--msa-format-mode",
+                       "6", "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + filter_param)
+            stage.run(["rmdb", base.joinpath("res_exp_realign_filter")])
+            stage.run(["rmdb", base.joinpath("res_exp_realign")])
+            stage.run(["rmdb", base.joinpath("res_exp")])
+            stage.run(["rmdb", base.joinpath("res")])
 
-    if unpack:
-        run_mmseqs(mmseqs, ["unpackdb", base.joinpath("final.a3m"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", ".a3m"])
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("final.a3m")])
+    def search_env(threads: int):
+        with manifest.stage("env", ["uniref"]) as stage:
+            stage.run(["search", base.joinpath("prof_res"), dbbase.joinpath(metagenomic_db), base.joinpath("res_env"),
+                       base.joinpath("tmp3"), "--threads", str(threads)] + search_param)
+            stage.run(["expandaln", base.joinpath("prof_res"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"), base.joinpath("res_env"),
+                       dbbase.joinpath(f"{metagenomic_db}{dbSuffix2}"), base.joinpath("res_env_exp"), "-e", str(expand_eval),
+                       "--expansion-mode", "0", "--db-load-mode", str(db_load_mode), "--threads", str(threads)])
+            stage.run(["align", base.joinpath("tmp3/latest/profile_1"), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
+                       base.joinpath("res_env_exp"), base.joinpath("res_env_exp_realign"), "--db-load-mode",
+                       str(db_load_mode), "-e", str(align_eval), "--max-accept", str(max_accept), "--threads",
+                       str(threads), "--alt-ali", "10", "-a"])
+            stage.run(["filterresult", base.joinpath(query_db), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
+                       base.joinpath("res_env_exp_realign"), base.joinpath("res_env_exp_realign_filter"),
+                       "--db-load-mode", str(db_load_mode), "--qid", "0", "--qsc", str(qsc), "--diff", "0",
+                       "--max-seq-id", "1.0", "--threads", str(threads), "--filter-min-enable", "100"])
+            stage.run(["result2msa", base.joinpath(query_db), dbbase.joinpath(f"{metagenomic_db}{dbSuffix1}"),
+                       base.joinpath("res_env_exp_realign_filter"),
+                       base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m"), "--msa-format-mode", "6",
+                       "--db-load-mode", str(db_load_mode), "--threads", str(threads)] + filter_param)
+            stage.run(["rmdb", base.joinpath("res_env_exp_realign_filter")])
+            stage.run(["rmdb", base.joinpath("res_env_exp_realign")])
+            stage.run(["rmdb", base.joinpath("res_env_exp")])
+            stage.run(["rmdb", base.joinpath("res_env")])
 
-        if use_templates:
-            run_mmseqs(mmseqs, ["unpackdb", base.joinpath(f"{template_db}"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", ".m8"])
-            if base.joinpath(f"{template_db}").exists():
-                run_mmseqs(mmseqs, ["rmdb", base.joinpath(f"{template_db}")])
+    def search_templates(threads: int):
+        with manifest.stage("templates", ["uniref"]) as stage:
+            stage.run(["search", base.joinpath("prof_res"), dbbase.joinpath(template_db), base.joinpath("res_pdb"),
+                       base.joinpath("tmp2"), "--db-load-mode", str(db_load_mode), "--threads", str(threads), "-a", "-e", "0.1"] + template_search_param)
+            stage.run(["convertalis", base.joinpath("prof_res"), dbbase.joinpath(f"{template_db}{dbSuffix3}"), base.joinpath("res_pdb"),
+                       base.joinpath(f"{template_db}{unique}"), "--format-output",
+                       "query,target,fident,alnlen,mismatch,gapopen,qstart,qend,tstart,tend,evalue,bits,cigar",
+                       "--db-output", "1",
+                       "--db-load-mode", str(db_load_mode), "--threads", str(threads)])
+            stage.run(["rmdb", base.joinpath("res_pdb")])
 
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("prof_res")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("prof_res_h")])
-    shutil.rmtree(base.joinpath("tmp"))
-    if use_templates:
-        shutil.rmtree(base.joinpath("tmp2"))
+    def merge(threads: int):
+        with manifest.stage("merge", searches) as stage:
+            if use_env:
+                stage.run(["mergedbs", base.joinpath(query_db), base.joinpath(f"final.a3m{unique}"), base.joinpath("uniref.a3m"), base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m")])
+                stage.run(["rmdb", base.joinpath("bfd.mgnify30.metaeuk30.smag30.a3m")])
+                stage.run(["rmdb", base.joinpath("uniref.a3m")])
+            else:
+                stage.run(["mvdb", base.joinpath("uniref.a3m"), base.joinpath(f"final.a3m{unique}")])
+                stage.run(["rmdb", base.joinpath("uniref.a3m")])
+            if chain_entries is not None:
+                # from the unique sequences to the chains of qdb
+                stage.call("fan out final.a3m", partial(fan_out_db, base.joinpath(f"final.a3m{unique}"), base.joinpath("final.a3m"), chain_entries))
+                if use_templates:
+                    stage.call(f"fan out {template_db}", partial(fan_out_db, base.joinpath(f"{template_db}{unique}"), base.joinpath(f"{template_db}"), chain_entries))
+
+            if unpack:
+                stage.run(["unpackdb", base.joinpath("final.a3m"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", ".a3m"])
+                stage.run(["rmdb", base.joinpath("final.a3m")])
+
+                if use_templates:
+                    stage.run(["unpackdb", base.joinpath(f"{template_db}"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", ".m8"])
+                    stage.run(["rmdb", base.joinpath(f"{template_db}")])
+
+            stage.run(["rmdb", base.joinpath("prof_res")])
+            stage.run(["rmdb", base.joinpath("prof_res_h")])
+            tmp_dirs = ["tmp"] + (["tmp2"] if use_templates else []) + (["tmp3"] if use_env else [])
+            for tmp in tmp_dirs:
+                stage.call(f"rmtree {base.joinpath(tmp)}", partial(shutil.rmtree, base.joinpath(tmp), ignore_errors=True))
+
+    # the environmental and template searches only need the profiles of the uniref search
+    stages = {"uniref": (search_uniref, [], 1.0)}
     if use_env:
-        shutil.rmtree(base.joinpath("tmp3"))
+        stages["env"] = (search_env, ["uniref"], 3.0)
+    if use_templates:
+        stages["templates"] = (search_templates, ["uniref"], 1.0)
+    searches = list(stages)
+    stages["merge"] = (merge, searches, 1.0)
+    run_stages(stages, threads, parallel=parallel_stages and not manifest.dry_run)
 
 def mmseqs_search_pair(
     dbbase: Path,
@@ -223,6 +367,7 @@ def mmseqs_search_pair(
     db_load_mode: int = 2,
     pairing_strategy: int = 0,
     unpack: bool = True,
+    manifest: Optional[SearchManifest] = None,
 ):
     if not dbbase.joinpath(f"{uniref_db}.dbtype").is_file():
         raise FileNotFoundError(f"Database {uniref_db} does not exist")
@@ -244,9 +389,11 @@ def mmseqs_search_pair(
     if pair_env:
         db = spire_db
         output = ".env.paired.a3m"
+        pair_db = "pair.env.a3m"
     else:
         db = uniref_db
         output = ".paired.a3m"
+        pair_db = "pair.a3m"
 
     # fmt: off
     # @formatter:off
@@ -262,30 +409,399 @@ def mmseqs_search_pair(
     if gpu_server:
         search_param += ["--gpu-server", str(gpu_server)]
     expand_param = ["--expansion-mode", "0", "-e", "inf", "--expand-filter-clusters", "0", "--max-seq-id", "0.95",]
-    run_mmseqs(mmseqs, ["search", base.joinpath("qdb"), dbbase.joinpath(db), base.joinpath("res"), base.joinpath("tmp"), "--threads", str(threads),] + search_param,)
-    run_mmseqs(mmseqs, ["mvdb", base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res")])
-    run_mmseqs(mmseqs, ["lndb", base.joinpath("qdb_h"), base.joinpath("prof_res_h")])    
-    run_mmseqs(mmseqs, ["expandaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res"), dbbase.joinpath(f"{db}{dbSuffix2}"), base.joinpath("res_exp"), "--db-load-mode", str(db_load_mode), "--threads", str(threads),] + expand_param,)
-    run_mmseqs(mmseqs, ["align", base.joinpath("prof_res"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", "0.001", "--max-accept", "1000000", "--threads", str(threads),],)
-    run_mmseqs(mmseqs, ["pairaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}"), base.joinpath("res_exp_realign"), base.joinpath("res_exp_realign_pair"), "--db-load-mode", str(db_load_mode), "--pairing-mode", str(pairing_strategy), "--pairing-dummy-mode", "0", "--threads", str(threads), ],)
-    run_mmseqs(mmseqs, ["align", base.joinpath("prof_res"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_exp_realign_pair"), base.joinpath("res_exp_realign_pair_bt"), "--db-load-mode", str(db_load_mode), "-e", "inf", "-a", "--threads", str(threads), ],)
-    run_mmseqs(mmseqs, ["pairaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}"), base.joinpath("res_exp_realign_pair_bt"), base.joinpath("res_final"), "--db-load-mode", str(db_load_mode), "--pairing-mode", str(pairing_strategy), "--pairing-dummy-mode", "1", "--threads", str(threads),],)
-    run_mmseqs(mmseqs, ["result2msa", base.joinpath("qdb"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_final"), base.joinpath("pair.a3m"), "--db-load-mode", str(db_load_mode), "--msa-format-mode", "5", "--threads", str(threads),],)
-    if unpack:
-        run_mmseqs(mmseqs, ["unpackdb", base.joinpath("pair.a3m"), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", output,],)
-        run_mmseqs(mmseqs, ["rmdb", base.joinpath("pair.a3m")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp_realign")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp_realign_pair")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_exp_realign_pair_bt")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("res_final")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("prof_res")])
-    run_mmseqs(mmseqs, ["rmdb", base.joinpath("prof_res_h")])
-    shutil.rmtree(base.joinpath("tmp"))
+    if manifest is None:
+        manifest = search_manifest(base, mmseqs)
+    with manifest.stage("pair.env" if pair_env else "pair", ["querydb"]) as stage:
+        stage.run(["search", base.joinpath("qdb"), dbbase.joinpath(db), base.joinpath("res"), base.joinpath("tmp"), "--threads", str(threads),] + search_param,)
+        stage.run(["mvdb", base.joinpath("tmp/latest/profile_1"), base.joinpath("prof_res")])
+        stage.run(["lndb", base.joinpath("qdb_h"), base.joinpath("prof_res_h")])
+        stage.run(["expandaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res"), dbbase.joinpath(f"{db}{dbSuffix2}"), base.joinpath("res_exp"), "--db-load-mode", str(db_load_mode), "--threads", str(threads),] + expand_param,)
+        stage.run(["align", base.joinpath("prof_res"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_exp"), base.joinpath("res_exp_realign"), "--db-load-mode", str(db_load_mode), "-e", "0.001", "--max-accept", "1000000", "--threads", str(threads),],)
+        stage.run(["pairaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}"), base.joinpath("res_exp_realign"), base.joinpath("res_exp_realign_pair"), "--db-load-mode", str(db_load_mode), "--pairing-mode", str(pairing_strategy), "--pairing-dummy-mode", "0", "--threads", str(threads), ],)
+        stage.run(["align", base.joinpath("prof_res"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_exp_realign_pair"), base.joinpath("res_exp_realign_pair_bt"), "--db-load-mode", str(db_load_mode), "-e", "inf", "-a", "--threads", str(threads), ],)
+        stage.run(["pairaln", base.joinpath("qdb"), dbbase.joinpath(f"{db}"), base.joinpath("res_exp_realign_pair_bt"), base.joinpath("res_final"), "--db-load-mode", str(db_load_mode), "--pairing-mode", str(pairing_strategy), "--pairing-dummy-mode", "1", "--threads", str(threads),],)
+        stage.run(["result2msa", base.joinpath("qdb"), dbbase.joinpath(f"{db}{dbSuffix1}"), base.joinpath("res_final"), base.joinpath(pair_db), "--db-load-mode", str(db_load_mode), "--msa-format-mode", "5", "--threads", str(threads),],)
+        if unpack:
+            stage.run(["unpackdb", base.joinpath(pair_db), base.joinpath("."), "--unpack-name-mode", "0", "--unpack-suffix", output,],)
+            stage.run(["rmdb", base.joinpath(pair_db)])
+        stage.run(["rmdb", base.joinpath("res")])
+        stage.run(["rmdb", base.joinpath("res_exp")])
+        stage.run(["rmdb", base.joinpath("res_exp_realign")])
+        stage.run(["rmdb", base.joinpath("res_exp_realign_pair")])
+        stage.run(["rmdb", base.joinpath("res_exp_realign_pair_bt")])
+        stage.run(["rmdb", base.joinpath("res_final")])
+        stage.run(["rmdb", base.joinpath("prof_res")])
+        stage.run(["rmdb", base.joinpath("prof_res_h")])
+        stage.call(f"rmtree {base.joinpath('tmp')}", partial(shutil.rmtree, base.joinpath("tmp"), ignore_errors=True))
     # @formatter:on
     # fmt: on
 
+def search_queries(
+    args: Namespace,
+    queries_unique: List[Tuple[str, List[str], List[int], Any]],
+    base: Path,
+    is_complex: bool,
+    unpack: bool,
+    threads: int,
+):
+    """Create the query database of the jobs in `base` and run the unpaired and paired searches.
+    With `args.dry_run`, only print which steps would run and which completed in an earlier run."""
+    query_fasta = []
+    # a sequence that is a chain of several jobs is only searched once, except for the pairing
+    unique_entries: Dict[str, int] = {}
+    unique_fasta = []
+    chain_entries = []
+    for job_number, (
+        raw_jobname,
+        query_sequences,
+        query_seqs_cardinality,
+        _
+    ) in enumerate(queries_unique):
+        for j, seq in enumerate(query_sequences):
+            # The header of first sequence set as 101
+            query_seq_headername = 101 + j
+            query_fasta.append(f">{query_seq_headername}\n{seq}\n")
+            if seq not in unique_entries:
+                unique_entries[seq] = len(unique_entries)
+                unique_fasta.append(f">{query_seq_headername}\n{seq}\n")
+            chain_entries.append(unique_entries[seq])
+    query_fasta = "".join(query_fasta)
+    deduplicate = len(unique_entries) < len(chain_entries)
+    if deduplicate:
+        logger.info(f"Searching {len(unique_entries)} unique sequences of {len(chain_entries)} chains")
+
+    query_file = base.joinpath("query.fas")
+    unique_query_file = base.joinpath("query.unique.fas")
+    manifest = search_manifest(base, args.mmseqs, dry_run=args.dry_run)
+    if not manifest.dry_run:
+        base.mkdir(exist_ok=True, parents=True)
+        query_file.write_text(query_fasta)
+        if deduplicate:
+            unique_query_file.write_text("".join(unique_fasta))
+
+    # the queries are the input of all stages, different queries rerun the whole search
+    query_hash = hashlib.sha256(query_fasta.encode()).hexdigest()
+    with manifest.stage("querydb", inputs={"query.fas": query_hash}) as stage:
+        stage.run(["createdb", query_file, base.joinpath("qdb"), "--shuffle", "0", "--dbtype", "1"])
+        if deduplicate:
+            stage.run(["createdb", unique_query_file, base.joinpath("qdb_unique"), "--shuffle", "0", "--dbtype", "1"])
+    # replaces the lookup of createdb
+    if not manifest.dry_run:
+        with base.joinpath("qdb.lookup").open("w") as f:
+            id = 0
+            file_number = 0
+            for job_number, (
+                raw_jobname,
+                query_sequences,
+                query_seqs_cardinality,
+                _
+            ) in enumerate(queries_unique):
+                for seq in query_sequences:
+                    raw_jobname_first = raw_jobname.split()[0]
+                    f.write(f"{id}\t{raw_jobname_first}\t{file_number}\n")
+                    id += 1
+                file_number += 1
+        # the copies of each unique sequence, so colabfold_batch can read complexes from the databases
+        with base.joinpath("qdb.cardinality").open("w") as f:
+            id = 0
+            for _, _, query_seqs_cardinality, _ in queries_unique:
+                for cardinality in query_seqs_cardinality:
+                    f.write(f"{id}\t{cardinality}\n")
+                    id += 1
+
+    mmseqs_search_monomer(
+        mmseqs=args.mmseqs,
+        dbbase=args.dbbase,
+        base=base,
+        uniref_db=args.db1,
+        template_db=args.db2,
+        metagenomic_db=args.db3,
+        use_env=args.use_env,
+        use_templates=args.use_templates,
+        filter=args.filter,
+        expand_eval=args.expand_eval,
+        align_eval=args.align_eval,
+        diff=args.diff,
+        qsc=args.qsc,
+        max_accept=args.max_accept,
+        prefilter_mode=args.prefilter_mode,
+        s=args.s,
+        db_load_mode=args.db_load_mode,
+        threads=threads,
+        gpu=args.gpu,
+        gpu_server=args.gpu_server,
+        unpack=unpack,
+        parallel_stages=args.parallel_stages,
+        manifest=manifest,
+        query_db="qdb_unique" if deduplicate else "qdb",
+        chain_entries=chain_entries if deduplicate else None,
+    )
+    if deduplicate:
+        with manifest.stage("cleanup", ["merge"]) as stage:
+            stage.run(["rmdb", base.joinpath("qdb_unique")])
+            stage.run(["rmdb", base.joinpath("qdb_unique_h")])
+    if is_complex is True:
+        mmseqs_search_pair(
+            mmseqs=args.mmseqs,
+            dbbase=args.dbbase,
+            base=base,
+            uniref_db=args.db1,
+            prefilter_mode=args.prefilter_mode,
+            s=args.s,
+            db_load_mode=args.db_load_mode,
+            threads=threads,
+            gpu=args.gpu,
+            gpu_server=args.gpu_server,
+            pairing_strategy=args.pairing_strategy,
+            pair_env=False,
+            unpack=unpack,
+            manifest=manifest,
+        )
+        if args.use_env_pairing:
+            mmseqs_search_pair(
+                mmseqs=args.mmseqs,
+                dbbase=args.dbbase,
+                base=base,
+                uniref_db=args.db1,
+                spire_db=args.db4,
+                prefilter_mode=args.prefilter_mode,
+                s=args.s,
+                db_load_mode=args.db_load_mode,
+                threads=threads,
+                gpu=args.gpu,
+                gpu_server=args.gpu_server,
+                pairing_strategy=args.pairing_strategy,
+                pair_env=True,
+                unpack=unpack,
+                manifest=manifest,
+            )
+
+    if not manifest.dry_run:
+        query_file.unlink()
+        unique_query_file.unlink(missing_ok=True)
+    manifest.write_profile(base, settings={
+        "prefilter_mode": args.prefilter_mode,
+        "s": args.s,
+        "db_load_mode": args.db_load_mode,
+        "gpu": args.gpu,
+        "threads": threads,
+        "queries": len(queries_unique),
+        "query_residues": sum(len(seq) for _, query_sequences, _, _ in queries_unique for seq in query_sequences),
+    })
+
+
+def shard_queries(queries_unique: List[Tuple[str, List[str], List[int], Any]], num_shards: int) -> List[List[int]]:
+    """Split the jobs into `num_shards` shards with a similar number of query residues to search,
+    by assigning the longest jobs first to the least loaded shard. Returns the job numbers of each shard."""
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0, shard) for shard in range(num_shards)]
+    lengths = [sum(len(seq) for seq in query_sequences) for _, query_sequences, _, _ in queries_unique]
+    for job_number in sorted(range(len(queries_unique)), key=lambda i: -lengths[i]):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(job_number)
+        heapq.heappush(loads, (load + lengths[job_number], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def shard_dir(base: Path, shard: int) -> Path:
+    return base.joinpath(f"shard_{shard}")
+
+
+def run_shard(args: Namespace, queries_unique, shard: int, jobs: List[int], is_complex: bool, threads: int):
+    logger.info(f"Searching shard {shard} with {len(jobs)} jobs")
+    base = shard_dir(args.base, shard)
+    if len(jobs) == 0:
+        # more shards than jobs
+        base.mkdir(exist_ok=True, parents=True)
+        base.joinpath("qdb.lookup").write_text("")
+        base.joinpath("qdb.cardinality").write_text("")
+        return
+    search_queries(args, [queries_unique[job] for job in jobs], base, is_complex, False, threads)
+
+
+def merge_shards(base: Path, shards: List[List[int]], template_db: str):
+    """Merge the databases of the shards into the databases of a single search in `base`. Query ids
+    continue from shard to shard, the jobs keep their number in the input in `qdb.lookup`."""
+    key_offsets = []
+    with base.joinpath("qdb.lookup").open("w") as lookup, base.joinpath("qdb.cardinality").open("w") as cardinality:
+        num_ids = 0
+        for shard, jobs in enumerate(shards):
+            key_offsets.append(num_ids)
+            shard_ids = 0
+            shard_base = shard_dir(base, shard)
+            if not shard_base.joinpath("qdb.lookup").is_file():
+                raise FileNotFoundError(f"Shard {shard} has no results in {shard_base}")
+            with shard_base.joinpath("qdb.cardinality").open() as f:
+                for line in f:
+                    id, count = line.rstrip("\n").split("\t")
+                    cardinality.write(f"{int(id) + num_ids}\t{count}\n")
+            with shard_base.joinpath("qdb.lookup").open() as f:
+                for line in f:
+                    id, name, file_number = line.rstrip("\n").split("\t")
+                    lookup.write(f"{int(id) + num_ids}\t{name}\t{jobs[int(file_number)]}\n")
+                    shard_ids = int(id) + 1
+            num_ids += shard_ids
+
+    names = ["qdb", "qdb_h", "final.a3m"] + SearchResultDb.PAIRED_DBS
+    if template_db:
+        names.append(template_db)
+    for name in names:
+        merge_dbs([shard_dir(base, shard).joinpath(name) for shard in range(len(shards))], base.joinpath(name), key_offsets)
+
+
+def unpack_search_result(base: Path, queries_unique, template_db: str):
+    """Write the a3m file, and m8 file of templates, of every job from the merged databases"""
+    jobs = SearchResultDb(base).get_queries()
+    for (raw_jobname, _, _, _), (_, _, msa, _) in zip(queries_unique, jobs):
+        base.joinpath(f"{safe_filename(raw_jobname)}.a3m").write_text(msa[0])
+    if template_db and base.joinpath(template_db).is_file():
+        templates = MmseqsDb(base.joinpath(template_db))
+        for (raw_jobname, _, _, _), (_, _, msa, _) in zip(queries_unique, jobs):
+            base.joinpath(f"{safe_filename(raw_jobname)}_{template_db}.m8").write_text(
+                "".join(templates.get(id, "") for id in msa.ids)
+            )
+        templates.close()
+        remove_db(base.joinpath(template_db))
+    for name in ["qdb", "qdb_h", "final.a3m"] + SearchResultDb.PAIRED_DBS:
+        remove_db(base.joinpath(name))
+
+
+def init_shard_process(level: int):
+    """Set up logging in a spawned shard process, which doesn't inherit the logging of the parent"""
+    logging.basicConfig(level=level, format="%(asctime)s %(processName)s %(message)s")
+
+
+def run_shards(args: Namespace, parser: ArgumentParser, queries_unique, is_complex: bool):
+    """Search the jobs in `args.shards` shards, either all shards locally in parallel, a single
+    shard (`--shard-index`) as a job of a scheduler, or only merge the results of the shards."""
+    if args.af3_json:
+        parser.error("--af3-json is not supported with --shards")
+    shards = shard_queries(queries_unique, args.shards)
+    template_db = str(args.db2) if args.use_templates else ""
+
+    if args.print_shard_commands:
+        # e.g. one job per line for a job array of a cluster scheduler
+        command = [sys.executable, "-m", "colabfold.mmseqs.search"]
+        command += [arg for arg in sys.argv[1:] if arg != "--print-shard-commands"]
+        for shard in range(args.shards):
+            print(shlex.join(command + ["--shard-index", str(shard)]))
+        print(shlex.join(command + ["--merge-shards"]))
+        return
+
+    args.base.mkdir(exist_ok=True, parents=True)
+    if args.shard_index is not None:
+        run_shard(args, queries_unique, args.shard_index, shards[args.shard_index], is_complex, args.threads)
+        return
+
+    if not args.merge_shards:
+        processes = min(args.shard_processes or args.shards, args.shards)
+        threads = max(1, args.threads // processes)
+        if processes == 1:
+            for shard, jobs in enumerate(shards):
+                run_shard(args, queries_unique, shard, jobs, is_complex, threads)
+        else:
+            # spawn, forking a process with threads can deadlock
+            with ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_shard_process,
+                initargs=(logging.getLogger().getEffectiveLevel(),),
+            ) as executor:
+                futures = [
+                    executor.submit(run_shard, args, queries_unique, shard, jobs, is_complex, threads)
+                    for shard, jobs in enumerate(shards)
+                ]
+                for future in futures:
+                    future.result()
+
+    logger.info(f"Merging {args.shards} shards")
+    merge_shards(args.base, shards, template_db)
+    if args.unpack:
+        unpack_search_result(args.base, queries_unique, template_db)
+    for shard in range(args.shards):
+        # keep the resource usage of the shards, e.g. base/shard_0.search_profile.json
+        for name in PROFILE_NAMES:
+            if shard_dir(args.base, shard).joinpath(name).is_file():
+                os.replace(shard_dir(args.base, shard).joinpath(name), args.base.joinpath(f"shard_{shard}.{name}"))
+        shutil.rmtree(shard_dir(args.base, shard))
+
+
+def job_hash(query_sequences: List[str], query_seqs_cardinality: List[int]) -> str:
+    """Hash of the chains of a job, the same for the jobs of two searches with the same sequences"""
+    chains = [seq for seq, count in zip(query_sequences, query_seqs_cardinality) for _ in range(count)]
+    return hashlib.sha256(":".join(chains).encode()).hexdigest()
+
+
+def append_search_result(base: Path, increment: Path, template_db: str):
+    """Append the databases, `qdb.lookup` and `qdb.cardinality` of the search in `increment` to the
+    search in `base`. Query ids and job numbers continue after the largest ones in `base`."""
+    names = ["qdb", "qdb_h", "final.a3m"] + SearchResultDb.PAIRED_DBS
+    if template_db:
+        names.append(template_db)
+    # above every key, also those of an earlier append that was interrupted before the lookup was written
+    key_offset = 1 + max(max_db_key(base.joinpath(name)) for name in names)
+    file_offset = 0
+    with base.joinpath("qdb.lookup").open() as f:
+        for line in f:
+            file_offset = max(file_offset, int(line.rstrip("\n").split("\t")[2]) + 1)
+
+    lookup, cardinality = [], []
+    with increment.joinpath("qdb.lookup").open() as f:
+        for line in f:
+            id, name, file_number = line.rstrip("\n").split("\t")
+            lookup.append(f"{int(id) + key_offset}\t{name}\t{int(file_number) + file_offset}\n")
+    with increment.joinpath("qdb.cardinality").open() as f:
+        for line in f:
+            id, count = line.rstrip("\n").split("\t")
+            cardinality.append(f"{int(id) + key_offset}\t{count}\n")
+
+    for name in names:
+        append_db(base.joinpath(name), increment.joinpath(name), key_offset)
+    # the new jobs are only visible once all databases have their entries
+    for name, lines in [("qdb.cardinality", cardinality), ("qdb.lookup", lookup)]:
+        with base.joinpath(name).open("a") as f:
+            f.writelines(lines)
+
+
+def search_incremental(args: Namespace, queries_unique, is_complex: bool):
+    """Only search the jobs whose chains aren't in the `--unpack 0` result in `args.base` yet and
+    append their results to it. Jobs are compared by the hash of their sequences, so a renamed job
+    isn't searched again."""
+    template_db = str(args.db2) if args.use_templates else ""
+    searched = set()
+    has_result = is_mmseqs_db(args.base.joinpath("final.a3m"))
+    if has_result:
+        result = SearchResultDb(args.base)
+        for _, query_sequence, _, _ in result.get_queries():
+            query_sequence = [query_sequence] if isinstance(query_sequence, str) else query_sequence
+            searched.add(job_hash(query_sequence, [1] * len(query_sequence)))
+        result.close()
+
+    new_jobs = []
+    # also skips repeated jobs in the queries
+    for job in queries_unique:
+        if job_hash(job[1], job[2]) not in searched:
+            searched.add(job_hash(job[1], job[2]))
+            new_jobs.append(job)
+    logger.info(f"Searching {len(new_jobs)} new jobs, {len(queries_unique) - len(new_jobs)} jobs were searched before")
+    if len(new_jobs) == 0:
+        return
+    if not has_result:
+        search_queries(args, new_jobs, args.base, is_complex, False, args.threads)
+        return
+
+    increment = args.base.joinpath("incremental")
+    search_queries(args, new_jobs, increment, is_complex, False, args.threads)
+    if args.dry_run:
+        return
+    append_search_result(args.base, increment, template_db)
+    # the resource usage of this increment
+    for name in PROFILE_NAMES:
+        if increment.joinpath(name).is_file():
+            os.replace(increment.joinpath(name), args.base.joinpath(name))
+    shutil.rmtree(increment)
+
+
 def main():
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument(
@@ -390,7 +906,8 @@ def main():
         help="Database preload mode 0: auto, 1: fread, 2: mmap, 3: mmap+touch",
     )
     parser.add_argument(
-        "--unpack", type=int, default=1, choices=[0, 1], help="Unpack results to loose files or keep MMseqs2 databases."
+        "--unpack", type=int, default=1, choices=[0, 1], help="Unpack results to loose files or keep MMseqs2 databases, "
+        "colabfold_batch reads the databases when given the result folder."
     )
     parser.add_argument(
         "--threads", type=int, default=64, help="Number of threads to use."
@@ -409,119 +926,94 @@ def main():
     parser.add_argument(
         "--af3-msa-as-path", action="store_true", help="Save MSA as a file path instead of a string in the JSON."
     )
+    parser.add_argument(
+        "--parallel-stages",
+        type=int,
+        default=1,
+        choices=[0, 1],
+        help="Run the environmental and template searches at the same time, splitting --threads between them.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Split the queries into this many shards of similar total length, which are searched "
+        "separately and merged afterwards.",
+    )
+    parser.add_argument(
+        "--shard-processes",
+        type=int,
+        default=None,
+        help="Number of shards searched at once on this machine, each with --threads divided by this "
+        "number (default: all shards).",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=None,
+        help="Only search this shard into base/shard_<index>, e.g. as a job on a cluster. "
+        "Merge the shards with --merge-shards afterwards.",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="Only merge the results of shards searched with --shard-index.",
+    )
+    parser.add_argument(
+        "--print-shard-commands",
+        action="store_true",
+        help="Print the commands to search each shard and to merge them, for a cluster scheduler.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=f"Only print the steps of the search, marking those that completed in an earlier run "
+        f"and are skipped. Interrupted searches resume from the steps recorded in base/{MANIFEST_NAME}.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only search the queries that aren't in the --unpack 0 result in base yet, compared by "
+        "their sequences, and add them to its databases.",
+    )
     args = parser.parse_args()
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shards:
+        parser.error("--shard-index needs to be between 0 and --shards - 1")
 
     logging.basicConfig(level = logging.INFO)
 
-    queries, is_complex = get_queries(args.query, None)
-
+    # only the deduplicated chains of the jobs are kept in memory
+    is_complex = False
     queries_unique = []
-    for job_number, (raw_jobname, query_sequences, a3m_lines, other_molecules) in enumerate(queries):
+    for job_number, (raw_jobname, query_sequences, a3m_lines, other_molecules) in enumerate(stream_queries(args.query, None)):
+        is_complex = is_complex or is_complex_query(query_sequences, a3m_lines)
         # remove duplicates before searching
         query_sequences = (
             [query_sequences] if isinstance(query_sequences, str) else query_sequences
         )
-        query_seqs_unique = []
-        for x in query_sequences:
-            if x not in query_seqs_unique:
-                query_seqs_unique.append(x)
-        query_seqs_cardinality = [0] * len(query_seqs_unique)
-        for seq in query_sequences:
-            seq_idx = query_seqs_unique.index(seq)
-            query_seqs_cardinality[seq_idx] += 1
+        # in order of the first copy, dict keys keep the insertion order
+        copies = Counter(query_sequences)
+        query_seqs_unique = list(copies)
+        query_seqs_cardinality = [copies[seq] for seq in query_seqs_unique]
 
         queries_unique.append([raw_jobname, query_seqs_unique, query_seqs_cardinality, other_molecules])
 
-    args.base.mkdir(exist_ok=True, parents=True)
-    query_file = args.base.joinpath("query.fas")
-    with query_file.open("w") as f:
-        for job_number, (
-            raw_jobname,
-            query_sequences,
-            query_seqs_cardinality,
-            _
-        ) in enumerate(queries_unique):
-            for j, seq in enumerate(query_sequences):
-                # The header of first sequence set as 101
-                query_seq_headername = 101 + j
-                f.write(f">{query_seq_headername}\n{seq}\n")
-
-    run_mmseqs(
-        args.mmseqs,
-        ["createdb", query_file, args.base.joinpath("qdb"), "--shuffle", "0", "--dbtype", "1"],
-    )
-    with args.base.joinpath("qdb.lookup").open("w") as f:
-        id = 0
-        file_number = 0
-        for job_number, (
-            raw_jobname,
-            query_sequences,
-            query_seqs_cardinality,
-            _
-        ) in enumerate(queries_unique):
-            for seq in query_sequences:
-                raw_jobname_first = raw_jobname.split()[0]
-                f.write(f"{id}\t{raw_jobname_first}\t{file_number}\n")
-                id += 1
-            file_number += 1
+    if args.incremental:
+        if args.unpack or args.af3_json or args.shards > 1:
+            parser.error("--incremental needs --unpack 0 and doesn't support --af3-json or --shards")
+        search_incremental(args, queries_unique, is_complex)
+        return
 
-    mmseqs_search_monomer(
-        mmseqs=args.mmseqs,
-        dbbase=args.dbbase,
-        base=args.base,
-        uniref_db=args.db1,
-        template_db=args.db2,
-        metagenomic_db=args.db3,
-        use_env=args.use_env,
-        use_templates=args.use_templates,
-        filter=args.filter,
-        expand_eval=args.expand_eval,
-        align_eval=args.align_eval,
-        diff=args.diff,
-        qsc=args.qsc,
-        max_accept=args.max_accept,
-        prefilter_mode=args.prefilter_mode,
-        s=args.s,
-        db_load_mode=args.db_load_mode,
-        threads=args.threads,
-        gpu=args.gpu,
-        gpu_server=args.gpu_server,
-        unpack=args.unpack,
-    )
-    if is_complex is True:
-        mmseqs_search_pair(
-            mmseqs=args.mmseqs,
-            dbbase=args.dbbase,
-            base=args.base,
-            uniref_db=args.db1,
-            prefilter_mode=args.prefilter_mode,
-            s=args.s,
-            db_load_mode=args.db_load_mode,
-            threads=args.threads,
-            gpu=args.gpu,
-            gpu_server=args.gpu_server,
-            pairing_strategy=args.pairing_strategy,
-            pair_env=False,
-            unpack=args.unpack,
-        )
-        if args.use_env_pairing:
-            mmseqs_search_pair(
-                mmseqs=args.mmseqs,
-                dbbase=args.dbbase,
-                base=args.base,
-                uniref_db=args.db1,
-                spire_db=args.db4,
-                prefilter_mode=args.prefilter_mode,
-                s=args.s,
-                db_load_mode=args.db_load_mode,
-                threads=args.threads,
-                gpu=args.gpu,
-                gpu_server=args.gpu_server,
-                pairing_strategy=args.pairing_strategy,
-                pair_env=True,
-                unpack=args.unpack,
-            )
+    if args.shards > 1:
+        if args.dry_run:
+            parser.error("--dry-run is not supported with --shards")
+        run_shards(args, parser, queries_unique, is_complex)
+        return
 
+    search_queries(args, queries_unique, args.base, is_complex, args.unpack, args.threads)
+    if args.dry_run:
+        return
+    if is_complex is True:
         if args.unpack or args.af3_json:
             id = 0
             for job_number, (
@@ -602,6 +1094,8 @@ def main():
                         id += 1
         run_mmseqs(args.mmseqs, ["rmdb", args.base.joinpath("qdb")])
         run_mmseqs(args.mmseqs, ["rmdb", args.base.joinpath("qdb_h")])
+        # the databases the manifest refers to are gone, a new search starts from scratch
+        args.base.joinpath(MANIFEST_NAME).unlink(missing_ok=True)
 
     if args.af3_json:
         # rename json files
@@ -611,8 +1105,6 @@ def main():
                 args.base.joinpath(f"{safe_filename(raw_jobname)}.json"),
             )
 
-    query_file.unlink()
-
 
 if __name__ == "__main__":
     main()
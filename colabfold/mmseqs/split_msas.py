@@ -2,14 +2,26 @@
 colabdfold_search produces two a3m files with null separated msa in them.
 We merge the two searches and then split into one a3m file per msa.
 """
+import io
 import logging
+import mmap
+import tarfile
+import time
+import zipfile
 from argparse import ArgumentParser
+import multiprocessing
 from pathlib import Path
+from typing import Iterator, Tuple
 
+import numpy as np
 from tqdm import tqdm
 
+from colabfold.mmseqs.db import read_db_index
+
 logger = logging.getLogger(__name__)
 
+ARCHIVE_SUFFIXES = (".zip", ".tar.gz", ".tgz")
+
 
 def split_msa(merged_msa: Path, output_folder: Path):
 
@@ -30,6 +42,100 @@ def split_msa(merged_msa: Path, output_folder: Path):
             line = f.readline()
 
 
+def _msa_filename(first_line: bytes) -> str:
+    # same names as split_msa
+    return first_line.decode().strip()[1:].split(" ")[0].strip().replace("/", "_").replace(">", "") + ".a3m"
+
+
+def _iter_db_entries(
+    data: mmap.mmap, offsets: np.ndarray, lengths: np.ndarray
+) -> Iterator[Tuple[str, bytes]]:
+    """Yield the filename and content of every non-empty entry, the MSA itself isn't parsed."""
+    for offset, length in zip(offsets.tolist(), lengths.tolist()):
+        end = offset + length
+        if length > 0 and data[end - 1] == 0:
+            end -= 1
+        first_line_end = data.find(b"\n", offset, end)
+        first_line = data[offset : end if first_line_end == -1 else first_line_end]
+        if not first_line.strip():
+            continue
+        yield _msa_filename(first_line), data[offset:end]
+
+
+_worker_data = None
+
+
+def _open_worker(data_file: Path):
+    global _worker_data
+    with data_file.open("rb") as f:
+        _worker_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_entries(args: Tuple[Path, np.ndarray, np.ndarray]) -> int:
+    output_folder, offsets, lengths = args
+    for filename, content in _iter_db_entries(_worker_data, offsets, lengths):
+        output_folder.joinpath(filename).write_bytes(content)
+    return len(offsets)
+
+
+def _write_archive(data_file: Path, offsets: np.ndarray, lengths: np.ndarray, archive: Path):
+    # a compressed archive is a single stream, so it is written by one process
+    with data_file.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        entries = _iter_db_entries(data, offsets, lengths)
+        progress = tqdm(total=len(offsets))
+        if archive.name.endswith(".zip"):
+            with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+                for filename, content in entries:
+                    zip_file.writestr(filename, content)
+                    progress.update(1)
+        else:
+            with tarfile.open(archive, "w:gz") as tar_file:
+                for filename, content in entries:
+                    info = tarfile.TarInfo(filename)
+                    info.size = len(content)
+                    info.mtime = int(time.time())
+                    tar_file.addfile(info, io.BytesIO(content))
+                    progress.update(1)
+        progress.close()
+
+
+def split_msa_db(db: Path, output: Path, threads: int = 1, chunk_size: int = 1000):
+    """Split an MMseqs2 a3m database such as `final.a3m` into one a3m file per MSA.
+
+    The data file is memory mapped and the entries are cut out at the offsets of the `.index`
+    file, so neither the database nor a single MSA is parsed line by line. Files are written by
+    `threads` worker processes. If `output` ends with .zip, .tar.gz or .tgz, the MSAs are written
+    into a compressed archive instead of a folder."""
+    index_file = db.with_name(db.name + ".index")
+    # write in file order, so the data file is read sequentially
+    _, offsets, lengths = read_db_index(index_file)
+    if len(offsets) == 0:
+        return
+    if lengths[-1] > 0 and offsets[-1] + lengths[-1] > db.stat().st_size:
+        raise ValueError(f"{index_file} doesn't match {db}, is it a database split into several files?")
+
+    if output.name.endswith(ARCHIVE_SUFFIXES):
+        _write_archive(db, offsets, lengths, output)
+        return
+
+    output.mkdir(parents=True, exist_ok=True)
+    chunks = [
+        (output, offsets[i : i + chunk_size], lengths[i : i + chunk_size])
+        for i in range(0, len(offsets), chunk_size)
+    ]
+    with tqdm(total=len(offsets)) as progress:
+        if threads <= 1:
+            _open_worker(db)
+            for chunk in chunks:
+                progress.update(_write_entries(chunk))
+            return
+        # spawn, forking a process with threads (e.g. of jax) can deadlock
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(threads, initializer=_open_worker, initargs=(db,)) as pool:
+            for num_entries in pool.imap_unordered(_write_entries, chunks):
+                progress.update(num_entries)
+
+
 def main():
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
@@ -40,14 +146,27 @@ def main():
         "search_folder",
         help="The search folder in which you ran colabfold_search with the final.a3m",
     )
-    parser.add_argument("output_folder", help="Will contain all the a3m files")
+    parser.add_argument(
+        "output_folder",
+        help="Will contain all the a3m files. A path ending with .zip, .tar.gz or .tgz "
+        "writes a compressed archive instead",
+    )
     parser.add_argument("--mmseqs", help="Path to the mmseqs2 binary", default="mmseqs")
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Number of processes writing a3m files"
+    )
     args = parser.parse_args()
     output_folder = Path(args.output_folder)
-    output_folder.mkdir(exist_ok=True)
+    final_a3m = Path(args.search_folder).joinpath("final.a3m")
 
     logger.info("Splitting MSAs")
-    split_msa(Path(args.search_folder).joinpath("final.a3m"), output_folder)
+    if final_a3m.with_name("final.a3m.index").is_file():
+        split_msa_db(final_a3m, output_folder, args.threads)
+    else:
+        if output_folder.name.endswith(ARCHIVE_SUFFIXES):
+            parser.error("Writing an archive needs the final.a3m.index file")
+        output_folder.mkdir(exist_ok=True)
+        split_msa(final_a3m, output_folder)
     logger.info("Done")
 
 
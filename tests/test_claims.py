@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+
+from colabfold.claims import JobClaims
+
+
+def test_job_claims(tmp_path):
+    first = JobClaims(tmp_path, "first", timeout=60)
+    second = JobClaims(tmp_path, "second", timeout=60)
+    assert first.claim("job")
+    assert first.claim("job")
+    assert not second.claim("job")
+    assert second.owner("job") == "first"
+
+    first.release("job")
+    assert second.claim("job")
+    assert not first.claim("job")
+    second.close()
+    assert not tmp_path.joinpath("job.claim").exists()
+    first.close()
+
+
+def test_job_claims_concurrent(tmp_path):
+    workers = [JobClaims(tmp_path, f"worker{n}", timeout=60) for n in range(8)]
+    claimed = {}
+    start = threading.Barrier(len(workers))
+
+    def claim(worker):
+        start.wait()
+        claimed[worker.worker_id] = [job for job in range(20) if worker.claim(f"job{job}")]
+
+    threads = [threading.Thread(target=claim, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # every job is claimed by exactly one worker
+    assert sorted(job for jobs in claimed.values() for job in jobs) == list(range(20))
+    for worker in workers:
+        worker.close()
+
+
+def test_job_claims_stale(tmp_path):
+    crashed = JobClaims(tmp_path, "crashed", timeout=60)
+    assert crashed.claim("job")
+    # stop the heartbeat without releasing, like a preempted node
+    crashed._stop.set()
+    crashed._heartbeat.join()
+
+    worker = JobClaims(tmp_path, "worker", timeout=60)
+    assert not worker.claim("job")
+    old = time.time() - 120
+    os.utime(tmp_path.joinpath("job.claim"), (old, old))
+    assert worker.claim("job")
+    assert worker.owner("job") == "worker"
+    assert [path.name for path in tmp_path.iterdir()] == ["job.claim"]
+    worker.close()
+
+
+def test_job_claims_heartbeat(tmp_path):
+    worker = JobClaims(tmp_path, "worker", timeout=60, heartbeat_interval=0.05)
+    assert worker.claim("job")
+    old = time.time() - 120
+    os.utime(tmp_path.joinpath("job.claim"), (old, old))
+    time.sleep(0.3)
+    # refreshed by the heartbeat, so it isn't taken over
+    assert time.time() - tmp_path.joinpath("job.claim").stat().st_mtime < 60
+    other = JobClaims(tmp_path, "other", timeout=60)
+    assert not other.claim("job")
+    other.close()
+    worker.close()
+
+
+def test_job_claims_release_after_takeover(tmp_path):
+    stalled = JobClaims(tmp_path, "stalled", timeout=60)
+    assert stalled.claim("job")
+    old = time.time() - 120
+    os.utime(tmp_path.joinpath("job.claim"), (old, old))
+
+    worker = JobClaims(tmp_path, "worker", timeout=60)
+    assert worker.claim("job")
+    # the stalled worker continues and releases the claim it lost
+    stalled.release("job")
+    assert worker.owner("job") == "worker"
+    third = JobClaims(tmp_path, "third", timeout=60)
+    assert not third.claim("job")
+    for claims in [stalled, worker, third]:
+        claims.close()
+    assert not tmp_path.joinpath("job.claim").exists()
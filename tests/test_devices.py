@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+from colabfold.batch import run_on_devices
+
+SCRIPT = """
+import threading
+import time
+import jax
+import jax.numpy as jnp
+from colabfold.batch import run_on_devices
+
+devices = jax.local_devices()
+assert len(devices) == 2, devices
+workers = [{"device": device, "model": None} for device in devices]
+processed = {}
+lock = threading.Lock()
+
+def process_job(job_index, job, worker):
+    if worker["model"] is None:
+        # created once per worker, on its device
+        worker["model"] = jax.jit(lambda x: x * 2)
+    out = worker["model"](jnp.full(3, job))
+    time.sleep(0.05)
+    with lock:
+        processed[job_index] = (float(out[0]), list(out.devices())[0].id, worker["device"].id)
+
+run_on_devices(list(range(8)), workers, process_job)
+assert sorted(processed) == list(range(8)), processed
+assert all(value == 2 * job for job, (value, _, _) in processed.items())
+assert all(device == worker_device for _, device, worker_device in processed.values())
+print(len({device for _, device, _ in processed.values()}))
+"""
+
+
+def test_run_on_devices():
+    env = {**os.environ, "XLA_FLAGS": "--xla_force_host_platform_device_count=2", "JAX_PLATFORMS": "cpu"}
+    out = subprocess.run([sys.executable, "-c", SCRIPT], env=env, check=True, capture_output=True, text=True)
+    # both devices took jobs from the queue
+    assert out.stdout.split()[-1] == "2"
+
+
+def test_run_on_devices_single():
+    order = []
+    workers = [{"device": None}]
+    run_on_devices(["a", "b", "c"], workers, lambda job_index, job, worker: order.append((job_index, job)))
+    assert order == [(0, "a"), (1, "b"), (2, "c")]
@@ -0,0 +1,109 @@
+import io
+import json
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from colabfold.mmseqs.api import MMseqs2API, run_sync
+
+
+def make_result_archive(seqs):
+    """Result archive as returned by the MSA server, with one null separated block per query."""
+    uniref = "".join(f">{101 + n}\n{seq}\n>UniRef100_{n}\n{seq.lower()}\n\0" for n, seq in enumerate(seqs))
+    env = "".join(f">{101 + n}\n{seq}\n>MGYP_{n}\n{seq}\n\0" for n, seq in enumerate(seqs))
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in [("uniref.a3m", uniref), ("bfd.mgnify30.metaeuk30.smag30.a3m", env)]:
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def msa_server():
+    """Minimal stand-in for the MSA server, tickets complete after two status requests."""
+    state = {"tickets": {}, "status_requests": 0, "agents": set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, body, content_type="application/json"):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            state["agents"].add(self.headers.get("User-Agent"))
+            length = int(self.headers["Content-Length"])
+            form = parse_qs(self.rfile.read(length).decode())
+            seqs = [line for line in form["q"][0].splitlines() if not line.startswith(">")]
+            ticket_id = f"ticket{len(state['tickets'])}"
+            state["tickets"][ticket_id] = {"seqs": seqs, "polls": 0}
+            self.reply(json.dumps({"id": ticket_id, "status": "PENDING"}).encode())
+
+        def do_GET(self):
+            if self.path.startswith("/ticket/"):
+                ticket = state["tickets"][self.path.split("/")[-1]]
+                ticket["polls"] += 1
+                state["status_requests"] += 1
+                status = "COMPLETE" if ticket["polls"] >= 2 else "RUNNING"
+                self.reply(json.dumps({"id": self.path.split("/")[-1], "status": status}).encode())
+            elif self.path.startswith("/result/download/"):
+                ticket = state["tickets"][self.path.split("/")[-1]]
+                self.reply(make_result_archive(ticket["seqs"]), "application/octet-stream")
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", state
+    server.shutdown()
+
+
+def test_search_many(msa_server, tmp_path):
+    host_url, state = msa_server
+    client = MMseqs2API(host_url, "colabfold/test", poll_interval=0.01)
+    searches = [
+        {"x": ["AAAA", "CCCC", "AAAA"], "prefix": tmp_path.joinpath("job1")},
+        {"x": "DDDD", "prefix": tmp_path.joinpath("job2"), "use_env": False},
+    ]
+    with client:
+        job1, job2 = run_sync(client.search_many(searches))
+
+    assert job1 == [
+        ">101\nAAAA\n>UniRef100_0\naaaa\n>101\nAAAA\n>MGYP_0\nAAAA\n",
+        ">102\nCCCC\n>UniRef100_1\ncccc\n>102\nCCCC\n>MGYP_1\nCCCC\n",
+        ">101\nAAAA\n>UniRef100_0\naaaa\n>101\nAAAA\n>MGYP_0\nAAAA\n",
+    ]
+    assert job2 == [">101\nDDDD\n>UniRef100_0\ndddd\n"]
+    # duplicates are only submitted once
+    assert [ticket["seqs"] for ticket in state["tickets"].values()] in (
+        [["AAAA", "CCCC"], ["DDDD"]],
+        [["DDDD"], ["AAAA", "CCCC"]],
+    )
+    assert state["agents"] == {"colabfold/test"}
+    assert tmp_path.joinpath("job1_env", "out.tar.gz").is_file()
+
+    # results are reused from the result directory
+    with MMseqs2API(host_url, "colabfold/test", poll_interval=0.01) as client:
+        assert run_sync(client.search(["AAAA", "CCCC", "AAAA"], tmp_path.joinpath("job1"))) == job1
+    assert len(state["tickets"]) == 2
+
+
+def test_run_mmseqs2(msa_server, tmp_path):
+    from colabfold.colabfold import run_mmseqs2
+
+    host_url, state = msa_server
+    a3m_lines = run_mmseqs2(["AAAA", "AAAA"], str(tmp_path.joinpath("job")), use_env=False, host_url=host_url, user_agent="colabfold/test")
+    assert a3m_lines == [">101\nAAAA\n>UniRef100_0\naaaa\n"] * 2
+    assert [ticket["seqs"] for ticket in state["tickets"].values()] == [["AAAA"]]
+    assert tmp_path.joinpath("job_all", "out.tar.gz").is_file()
@@ -0,0 +1,87 @@
+import subprocess
+import sys
+
+SCRIPT = """
+import sys
+import jax
+import jax.numpy as jnp
+from colabfold.alphafold.models import enable_compilation_cache
+
+stats = enable_compilation_cache(sys.argv[1])
+jax.jit(lambda x: jnp.tanh(x) @ x.T)(jnp.ones((17, 5))).block_until_ready()
+print(*stats.snapshot())
+"""
+
+
+def test_compilation_cache(tmp_path):
+    def compile_in_new_process():
+        out = subprocess.run(
+            [sys.executable, "-c", SCRIPT, str(tmp_path)], check=True, capture_output=True, text=True
+        )
+        hits, misses = map(int, out.stdout.split()[-2:])
+        return hits, misses
+
+    hits, misses = compile_in_new_process()
+    assert hits == 0 and misses > 0
+    # a new process loads the compiled functions from disk
+    hits, misses = compile_in_new_process()
+    assert hits > 0 and misses == 0
+
+
+def test_compilation_cache_stats_per_thread():
+    import threading
+    from colabfold.alphafold.models import CompilationCacheStats
+
+    stats = CompilationCacheStats()
+    stats._on_event("/jax/compilation_cache/cache_misses")
+    other = []
+
+    def compile_on_other_device():
+        for _ in range(3):
+            stats._on_event("/jax/compilation_cache/cache_hits")
+        other.append(stats.snapshot())
+
+    thread = threading.Thread(target=compile_on_other_device)
+    thread.start()
+    thread.join()
+    # the hits of the other thread don't count for this one
+    assert other == [(3, 0)]
+    assert stats.snapshot() == (0, 1)
+    assert (stats.hits, stats.misses) == (3, 1)
+
+
+def test_weights_store(tmp_path):
+    import numpy as np
+    from colabfold.alphafold.models import get_model_haiku_params
+    from colabfold.alphafold.weights import load_flat_params, read_manifest, weights_store_path
+
+    params_dir = tmp_path.joinpath("params")
+    params_dir.mkdir()
+    rng = np.random.default_rng(0)
+    expected = {}
+    for model_number in [1, 2]:
+        expected[model_number] = {
+            "alphafold/alphafold_iteration//w": rng.normal(size=(3, 5)).astype(np.float32),
+            "alphafold/alphafold_iteration//b": np.arange(model_number + 2, dtype=np.int32),
+        }
+        np.savez(params_dir.joinpath(f"params_model_{model_number}_ptm.npz"), **expected[model_number])
+
+    params = load_flat_params(params_dir, "alphafold2_ptm", 2)
+    store = weights_store_path(params_dir, "alphafold2_ptm")
+    assert set(read_manifest(store)["models"]) == {"1", "2"}
+    for key, array in expected[2].items():
+        np.testing.assert_array_equal(params[key], array)
+        assert isinstance(params[key].base, np.memmap) and not params[key].flags.writeable
+
+    # the npz files aren't needed anymore once converted
+    params_dir.joinpath("params_model_1_ptm.npz").unlink()
+    haiku_params = get_model_haiku_params(str(tmp_path), "alphafold2_ptm", 1, to_jnp=False)
+    np.testing.assert_array_equal(haiku_params["alphafold/alphafold_iteration"]["w"], expected[1]["alphafold/alphafold_iteration//w"])
+
+    # a changed npz rebuilds the store
+    np.savez(params_dir.joinpath("params_model_2_ptm.npz"), **expected[1])
+    params = load_flat_params(params_dir, "alphafold2_ptm", 2)
+    np.testing.assert_array_equal(params["alphafold/alphafold_iteration//b"], expected[1]["alphafold/alphafold_iteration//b"])
+    # the converted model without npz file is kept
+    params = load_flat_params(params_dir, "alphafold2_ptm", 1)
+    np.testing.assert_array_equal(params["alphafold/alphafold_iteration//w"], expected[1]["alphafold/alphafold_iteration//w"])
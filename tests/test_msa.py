@@ -1,6 +1,19 @@
+import logging
+import os
+import random
+import time
 from unittest import mock
 
-from colabfold.batch import get_msa_and_templates
+from colabfold.batch import (
+    UnpairedMsaBatches,
+    _split_a3m_sequence,
+    get_msa_and_templates,
+    msa_to_str,
+    run,
+    split_a3m_sequences,
+    unserialize_msa,
+)
+from colabfold.mmseqs.cache import MsaCache
 from tests.mock import MMseqs2Mock
 
 
@@ -37,4 +50,308 @@ def test_get_msa_and_templates(pytestconfig, caplog, tmp_path):
         assert query_seqs_unique == [Q60262]
         assert query_seqs_cardinality == [1]
 
-    assert caplog.messages == []
\ No newline at end of file
+    assert caplog.messages == []
+
+def test_msa_prefetch(pytestconfig, tmp_path):
+    queries = [("5AWL_1", "YYDPETGTWY", None, None), ("6A5J", "IKKILSKIKKLLK", None, None)]
+
+    mmseqs2mock = MMseqs2Mock(pytestconfig.rootpath, "batch")
+    for msa_prefetch, result_dir in [(0, tmp_path / "serial"), (2, tmp_path / "prefetch")]:
+        with mock.patch("colabfold.colabfold.run_mmseqs2", mmseqs2mock.mock_run_mmseqs2):
+            run(
+                queries,
+                result_dir,
+                num_models=0,
+                is_complex=False,
+                msa_prefetch=msa_prefetch,
+            )
+
+    for jobname, _, _, _ in queries:
+        serial = tmp_path.joinpath("serial", f"{jobname}.a3m").read_text()
+        prefetched = tmp_path.joinpath("prefetch", f"{jobname}.a3m").read_text()
+        assert serial == prefetched
+
+
+def test_unpaired_msa_batches(tmp_path):
+    calls = []
+
+    def mock_run_mmseqs2(query, prefix, use_env=True, use_pairing=False, **kwargs):
+        calls.append((list(query), prefix))
+        return [f">101\n{seq}\n>UP1\n{seq.lower()}\n" for seq in query]
+
+    tickets = []
+
+    async def mock_fetch(self, x, prefix, use_env=True, **kwargs):
+        tickets.append(list(x))
+        return f"{prefix}_env"
+
+    seqs = ["AAAA", "CCCC", "AAAA", "DDDD", "EEEE"]
+    with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2), \
+            mock.patch("colabfold.mmseqs.api.MMseqs2API.fetch", mock_fetch):
+        msas = UnpairedMsaBatches(seqs, tmp_path, "mmseqs2_uniref_env", batch_size=3, user_agent="colabfold/test")
+        # one ticket per batch of unique sequences
+        assert tickets == [["AAAA", "CCCC", "DDDD"], ["EEEE"]]
+        assert msas["DDDD"] == ">101\nDDDD\n>UP1\ndddd\n"
+        assert [query for query, _ in calls] == [["AAAA", "CCCC", "DDDD"]]
+        assert "FFFF" not in msas
+        # switching between batches parses each of them once
+        assert [msas[seq] for seq in ["EEEE", "CCCC", "EEEE", "DDDD"]] == [
+            f">101\n{seq}\n>UP1\n{seq.lower()}\n" for seq in ["EEEE", "CCCC", "EEEE", "DDDD"]
+        ]
+        assert [query for query, _ in calls] == [["AAAA", "CCCC", "DDDD"], ["EEEE"]]
+
+        calls.clear()
+        (unpaired_msa, paired_msa, _, _, _) = get_msa_and_templates(
+            "test", ["AAAA", "FFFF"], None, tmp_path, "mmseqs2_uniref_env", False, None,
+            "unpaired", precomputed_msas=msas,
+        )
+    # only the sequence without a precomputed MSA is searched again
+    assert [query for query, _ in calls] == [["FFFF"]]
+    assert unpaired_msa == [">101\nAAAA\n>UP1\naaaa\n", ">101\nFFFF\n>UP1\nffff\n"]
+    assert paired_msa is None
+
+
+def test_msa_cache(tmp_path):
+    calls = []
+
+    def mock_run_mmseqs2(x, prefix, use_env=True, use_pairing=False, **kwargs):
+        calls.append((list(x), use_pairing))
+        if use_pairing:
+            return [f">{101 + n}\n{seq}\n>UP1_paired\n{seq.lower()}\n" for n, seq in enumerate(x)]
+        return [f">{101 + n}\n{seq}\n>UP1\n{seq.lower()}\n" for n, seq in enumerate(x)]
+
+    msa_cache = MsaCache(tmp_path.joinpath("cache"), namespace="https://example.org")
+    with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2):
+        first = get_msa_and_templates(
+            "job1", ["AAAA", "CCCC"], None, tmp_path.joinpath("run1"), "mmseqs2_uniref_env", False, None,
+            "unpaired_paired", msa_cache=msa_cache,
+        )
+        assert calls == [(["AAAA", "CCCC"], False), (["AAAA", "CCCC"], True)]
+
+        # the same chains in another job and result directory are not searched again
+        calls.clear()
+        second = get_msa_and_templates(
+            "job2", ["AAAA", "CCCC"], None, tmp_path.joinpath("run2"), "mmseqs2_uniref_env", False, None,
+            "unpaired_paired", msa_cache=msa_cache,
+        )
+        assert calls == []
+        assert second[:4] == first[:4]
+
+        # only the new chain is searched, pairing depends on all chains
+        third = get_msa_and_templates(
+            "job3", ["CCCC", "DDDD"], None, tmp_path.joinpath("run3"), "mmseqs2_uniref_env", False, None,
+            "unpaired_paired", msa_cache=msa_cache,
+        )
+        assert calls == [(["DDDD"], False), (["CCCC", "DDDD"], True)]
+        assert third[0] == [first[0][1], ">101\nDDDD\n>UP1\ndddd\n"]
+
+        # a different search mode doesn't share entries
+        calls.clear()
+        get_msa_and_templates(
+            "job4", "AAAA", None, tmp_path.joinpath("run4"), "mmseqs2_uniref", False, None,
+            "unpaired", msa_cache=msa_cache,
+        )
+        assert calls == [(["AAAA"], False)]
+
+
+def test_unpaired_msa_batches_failed(tmp_path, caplog):
+    calls = []
+
+    def mock_run_mmseqs2(query, prefix, use_env=True, use_pairing=False, **kwargs):
+        calls.append(list(query))
+        if "msa_batch_" in prefix:
+            raise Exception("MMseqs2 API is giving errors")
+        return [f">101\n{seq}\n>UP1\n{seq.lower()}\n" for seq in query]
+
+    async def mock_fetch(self, x, prefix, use_env=True, **kwargs):
+        if "EEEE" in x:
+            raise Exception("rate limited")
+        return f"{prefix}_env"
+
+    seqs = ["AAAA", "CCCC", "DDDD", "EEEE"]
+    with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2), \
+            mock.patch("colabfold.mmseqs.api.MMseqs2API.fetch", mock_fetch):
+        msas = UnpairedMsaBatches(seqs, tmp_path, "mmseqs2_uniref_env", batch_size=3, user_agent="colabfold/test")
+        # the ticket of the second batch failed, the first fails when its MSAs are read
+        assert "EEEE" not in msas
+        assert "AAAA" in msas
+        (unpaired_msa, _, _, _, _) = get_msa_and_templates(
+            "test", ["AAAA", "EEEE"], None, tmp_path, "mmseqs2_uniref_env", False, None,
+            "unpaired", precomputed_msas=msas,
+        )
+        assert "AAAA" not in msas
+        assert len(msas) == 0
+    # searched with the job instead of failing it
+    assert calls == [["AAAA", "CCCC", "DDDD"], ["AAAA", "EEEE"]]
+    assert unpaired_msa == [">101\nAAAA\n>UP1\naaaa\n", ">101\nEEEE\n>UP1\neeee\n"]
+    assert "Could not search the MSAs of batch 2/2" in caplog.text
+
+
+def test_msa_cache_precomputed(tmp_path):
+    calls = []
+
+    def mock_run_mmseqs2(x, prefix, use_env=True, use_pairing=False, **kwargs):
+        calls.append(list(x))
+        return [f">{101 + n}\n{seq}\n>UP1\n{seq.lower()}\n" for n, seq in enumerate(x)]
+
+    msa_cache = MsaCache(tmp_path.joinpath("cache"))
+    precomputed_msas = {"AAAA": ">101\nAAAA\n>UP2\naaaa\n"}
+    with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2):
+        get_msa_and_templates(
+            "job1", ["AAAA", "CCCC"], None, tmp_path.joinpath("run1"), "mmseqs2_uniref_env", False, None,
+            "unpaired", precomputed_msas=precomputed_msas, msa_cache=msa_cache,
+        )
+        assert calls == [["CCCC"]]
+        # the MSAs of the batched search are cached as well
+        calls.clear()
+        unpaired_msa = get_msa_and_templates(
+            "job2", ["AAAA", "CCCC"], None, tmp_path.joinpath("run2"), "mmseqs2_uniref_env", False, None,
+            "unpaired", msa_cache=msa_cache,
+        )[0]
+        assert calls == []
+        assert unpaired_msa == [precomputed_msas["AAAA"], ">101\nCCCC\n>UP1\ncccc\n"]
+
+
+def test_msa_cache_eviction(tmp_path):
+    msa_cache = MsaCache(tmp_path, max_size=2500)
+    keys = [msa_cache.key("unpaired", seq) for seq in ["AAAA", "CCCC", "DDDD"]]
+    assert len(set(keys)) == 3
+    assert msa_cache.key("unpaired", "AAAA", use_env=True) != msa_cache.key("unpaired", "AAAA", use_env=False)
+
+    msa_cache.put(keys[0], "A" * 1000)
+    msa_cache.put(keys[1], "C" * 1000)
+    # make the first entry the most recently used one
+    for n, key in enumerate(keys[:2]):
+        os.utime(msa_cache._path(key), (n, n))
+    assert msa_cache.get(keys[0]) == "A" * 1000
+
+    msa_cache.put(keys[2], "D" * 1000)
+    assert keys[0] in msa_cache
+    assert keys[1] not in msa_cache
+    assert msa_cache.get(keys[2]) == "D" * 1000
+    assert msa_cache.get(keys[1], "missing") == "missing"
+    # no temporary files are left behind
+    assert len(list(tmp_path.glob("**/*.tmp"))) == 0
+
+
+def test_shared_chain_msas(tmp_path):
+    calls = []
+
+    def mock_run_mmseqs2(x, prefix, use_env=True, use_pairing=False, use_templates=False, **kwargs):
+        calls.append((list(x), use_pairing, "msa_batch_" in prefix))
+        suffix = "_paired" if use_pairing else ""
+        a3m_lines = [f">{101 + n}\n{seq}\n>UP1{suffix}\n{seq.lower()}\n" for n, seq in enumerate(x)]
+        return (a3m_lines, None) if use_templates else a3m_lines
+
+    tickets = []
+
+    async def mock_fetch(self, x, prefix, use_env=True, **kwargs):
+        tickets.append(list(x))
+        return f"{prefix}_env"
+
+    bait = "MAAAAK"
+    queries = [(f"prey{n}", [bait, prey], None, None) for n, prey in enumerate(["MCCCCK", "MDDDDK", "MEEEEK"])]
+    with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2), \
+            mock.patch("colabfold.mmseqs.api.MMseqs2API.fetch", mock_fetch):
+        run(queries, tmp_path, num_models=0, is_complex=True, user_agent="colabfold/test", search_shared_chains=True)
+
+    # the bait is searched once up front, the preys and the pairs once per complex
+    assert tickets == [[bait]]
+    assert [query for query, use_pairing, batched in calls if batched] == [[bait]]
+    assert [(query, use_pairing) for query, use_pairing, batched in calls if not batched] == [
+        (["MCCCCK"], False), ([bait, "MCCCCK"], True),
+        (["MDDDDK"], False), ([bait, "MDDDDK"], True),
+        (["MEEEEK"], False), ([bait, "MEEEEK"], True),
+    ]
+    for jobname, (_, prey), _, _ in queries:
+        a3m = tmp_path.joinpath(f"{jobname}.a3m").read_text()
+        assert bait.lower() in a3m and prey.lower() in a3m
+
+    # opt-in, and not with templates, whose search returns the unpaired MSAs of every chain anyway
+    for result_dir, kwargs in [("default", {}), ("templates", {"use_templates": True, "search_shared_chains": True})]:
+        tickets.clear()
+        with mock.patch("colabfold.colabfold.run_mmseqs2", mock_run_mmseqs2), \
+                mock.patch("colabfold.mmseqs.api.MMseqs2API.fetch", mock_fetch):
+            run(queries, tmp_path.joinpath(result_dir), num_models=0, is_complex=True, user_agent="colabfold/test", **kwargs)
+        assert tickets == []
+
+
+def random_a3m_sequence(rng, query_seq_len, truncate=False, gapped_chains=0.3):
+    # match columns with gaps and lowercase insertions, optionally truncated
+    parts = []
+    for n, query_len in enumerate(query_seq_len):
+        gapped = rng.random() < gapped_chains
+        for _ in range(query_len):
+            if rng.random() < 0.1:
+                parts.append("".join(rng.choices("acdefghiklmnpqrstvwy", k=rng.randint(1, 4))))
+            parts.append("-" if gapped or rng.random() < 0.1 else rng.choice("ACDEFGHIKLMNPQRSTVWYX"))
+    seq = "".join(parts)
+    if truncate and rng.random() < 0.05:
+        seq = seq[: rng.randint(0, len(seq))]
+    return seq
+
+
+def test_split_a3m_sequences(pytestconfig):
+    rng = random.Random(42)
+    query_seq_len = [37, 5, 120, 1]
+    seqs = [random_a3m_sequence(rng, query_seq_len, truncate=True) for _ in range(2000)]
+    seqs += ["", "-" * sum(query_seq_len), "a" * 10]
+    for a3m_file in pytestconfig.rootpath.joinpath("test-data/a3m").glob("*.a3m"):
+        lines = [line for line in a3m_file.read_text().splitlines() if line and line[0] not in "#>"]
+        seqs += lines
+        if lines:
+            query_len = sum(1 for c in lines[0] if not c.islower())
+            assert split_a3m_sequences(lines, [query_len]) == [
+                _split_a3m_sequence(line, [query_len]) for line in lines
+            ]
+
+    assert split_a3m_sequences(seqs, query_seq_len) == [
+        _split_a3m_sequence(seq, query_seq_len) for seq in seqs
+    ]
+    assert split_a3m_sequences(["AäA-A"], [2, 3]) == [_split_a3m_sequence("AäA-A", [2, 3])]
+    assert split_a3m_sequences([], query_seq_len) == []
+
+
+def test_unserialize_msa_benchmark(caplog):
+    caplog.set_level(logging.INFO)
+    rng = random.Random(0)
+    query_sequence_unique = ["".join(rng.choices("ACDEFGHIKLMNPQRSTVWY", k=length)) for length in [150, 80]]
+    query_sequence_cardinality = [1, 1]
+
+    def random_msa(query_seq_len, offset):
+        return "".join(
+            f">{offset + n}\n{random_a3m_sequence(rng, query_seq_len, gapped_chains=0)}\n"
+            for n in range(3000)
+        )
+
+    unpaired_msa = [f">101\n{query}\n" + random_msa([len(query)], 0) for query in query_sequence_unique]
+    paired_msa = [f">101\n{query}\n" + random_msa([len(query)], 10000) for query in query_sequence_unique]
+    msa = msa_to_str(unpaired_msa, paired_msa, query_sequence_unique, query_sequence_cardinality)
+
+    start = time.perf_counter()
+    unpaired_msa_ret, paired_msa_ret, query_sequence_unique_ret, query_sequence_cardinality_ret, _ = (
+        unserialize_msa([msa], query_sequence_unique)
+    )
+    elapsed = time.perf_counter() - start
+    logging.info(f"unserialize_msa of {len(msa) >> 20}MB took {elapsed:.2f}s")
+
+    # split_a3m_sequences has to match the character by character reference on the same records
+    a3m_lines = msa.splitlines()[1:]
+    seqs = a3m_lines[1::2]
+    query_seq_len = [len(query) for query in query_sequence_unique]
+    start = time.perf_counter()
+    reference = [_split_a3m_sequence(seq, query_seq_len) for seq in seqs]
+    reference_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    split = split_a3m_sequences(seqs, query_seq_len)
+    elapsed = time.perf_counter() - start
+    assert split == reference
+    logging.info(
+        f"Splitting {len(seqs)} sequences took {elapsed:.2f}s, "
+        f"{reference_elapsed:.2f}s character by character"
+    )
+
+    assert query_sequence_unique_ret == query_sequence_unique
+    assert query_sequence_cardinality_ret == query_sequence_cardinality
+    assert [msa.count(">") for msa in unpaired_msa_ret] == [3001, 3001]
+    assert [msa.count(">") for msa in paired_msa_ret] == [3001, 3001]
@@ -0,0 +1,213 @@
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+from alphafold.data import pipeline
+
+from colabfold.alphafold.msa import make_complex_msa_features, parse_a3m_features
+from colabfold.batch import get_length_buckets, pad_input_multimer, unpad_extra_ptm_inputs
+from colabfold.input import msa_to_str, pair_msa
+
+
+def test_get_length_buckets():
+    lengths = [50, 52, 55, 60, 100, 101, 300, 310, 600, 52]
+    buckets = get_length_buckets(lengths, compile_cost=10, runs_per_query=5)
+    assert buckets == [101, 310, 600]
+
+    # the longest query always gets its own bucket
+    assert get_length_buckets([100, 100, 100]) == [100]
+    # without compile cost every length is its own bucket
+    assert get_length_buckets(lengths, compile_cost=0) == sorted(set(lengths))
+    # very expensive compiles pad everything to the longest query
+    assert get_length_buckets(lengths, compile_cost=1e6) == [600]
+
+
+def test_pad_input_multimer():
+    num_res, num_seq = 7, 600
+    features = {
+        "aatype": np.arange(num_res) % 20,
+        "residue_index": np.arange(num_res),
+        "seq_mask": np.ones(num_res),
+        "asym_id": np.array([0, 0, 0, 0, 1, 1, 1]),
+        "entity_id": np.array([1, 1, 1, 1, 2, 2, 2]),
+        "msa": np.ones((num_seq, num_res), dtype=np.int32),
+        "msa_mask": np.ones((num_seq, num_res)),
+        "cluster_bias_mask": np.ones(num_seq),
+        "template_aatype": np.ones((2, num_res), dtype=np.int32),
+        "template_all_atom_positions": np.ones((2, num_res, 37, 3)),
+        "num_alignments": np.asarray(num_seq),
+    }
+    padded = pad_input_multimer(features, 10)
+
+    assert padded["aatype"].shape == (10,)
+    assert padded["msa"].shape == (1024, 10)
+    assert padded["cluster_bias_mask"].shape == (1024,)
+    assert padded["template_all_atom_positions"].shape == (4, 10, 37, 3)
+    assert padded["num_alignments"] == num_seq
+    # padding is masked and has no entity
+    assert padded["seq_mask"].tolist() == [1] * num_res + [0] * 3
+    assert padded["msa_mask"][num_seq:].sum() == 0 and padded["msa_mask"][:, num_res:].sum() == 0
+    assert padded["entity_id"][num_res:].tolist() == [0, 0, 0]
+    np.testing.assert_array_equal(padded["msa"][:num_seq, :num_res], features["msa"])
+
+
+
+def test_extra_ptm_of_padded_input():
+    from colabfold.alphafold import extra_ptm
+
+    rng = np.random.default_rng(0)
+    seq_len, pad_len = 12, 16
+    asym_id = np.array([0] * 5 + [1] * 4 + [2] * 3)
+
+    def result(num_res):
+        logits = rng.normal(size=(seq_len, seq_len, 64))
+        pae_logits = rng.normal(size=(seq_len, seq_len, 64))
+        # random outputs for the padding
+        logits = np.pad(logits, [(0, num_res - seq_len)] * 2 + [(0, 0)], constant_values=1.0)
+        pae_logits = np.pad(pae_logits, [(0, num_res - seq_len)] * 2 + [(0, 0)], constant_values=2.0)
+        return {
+            "distogram": {"logits": logits, "bin_edges": np.linspace(2.3125, 21.6875, 63)},
+            "predicted_aligned_error": np.zeros((num_res, num_res)),
+            "pae_matrix_with_logits": {"logits": pae_logits, "breaks": np.linspace(0, 31, 63)},
+        }
+
+    for use_probs_extra in [False, True]:
+        rng = np.random.default_rng(0)
+        expected = extra_ptm.get_chain_and_interface_metrics(result(seq_len), asym_id, use_probs_extra, use_jnp=False)
+        rng = np.random.default_rng(0)
+        padded_asym_id = np.pad(asym_id, (0, pad_len - seq_len))
+        metrics = extra_ptm.get_chain_and_interface_metrics(
+            *unpad_extra_ptm_inputs(result(pad_len), padded_asym_id, seq_len), use_probs_extra, use_jnp=False
+        )
+        assert metrics == expected
+        assert set(metrics["per_chain_ptm"]) == {"A", "B", "C"}
+
+
+def assert_msa_features_equal(features, expected):
+    assert features.keys() == expected.keys()
+    for k, v in expected.items():
+        assert features[k].dtype == v.dtype, k
+        np.testing.assert_array_equal(features[k], v, err_msg=k)
+
+
+def random_a3m(num_seqs, num_res, seed=0):
+    rng = random.Random(seed)
+    query = "".join(rng.choices("ACDEFGHIKLMNPQRSTVWY", k=num_res))
+    lines = [">101", query]
+    for n in range(num_seqs):
+        lines.append(f">tr|A0A{n:05d}|A0A{n:05d}_HUMAN/1-{num_res}" if n % 2 else f">UniRef100_{n}")
+        seq = []
+        for _ in range(num_res):
+            if rng.random() < 0.05:
+                seq.append("".join(rng.choices("acdefghiklmnpqrstvwxy", k=rng.randint(1, 3))))
+            seq.append(rng.choice("ACDEFGHIKLMNPQRSTVWYXBZ-"))
+        if rng.random() < 0.1:
+            seq.append("kl")
+        lines.append("".join(seq))
+    return "\n".join(lines) + "\n"
+
+
+def test_parse_a3m_features(pytestconfig, tmp_path):
+    for a3m_file in pytestconfig.rootpath.joinpath("test-data/a3m").glob("*.a3m"):
+        a3m = a3m_file.read_text()
+        if ">" not in a3m:
+            continue
+        expected = pipeline.make_msa_features([pipeline.parsers.parse_a3m(a3m)])
+        assert_msa_features_equal(parse_a3m_features(a3m), expected)
+        assert_msa_features_equal(parse_a3m_features(a3m_file), expected)
+
+    a3m = random_a3m(300, 50)
+    expected = pipeline.make_msa_features([pipeline.parsers.parse_a3m(a3m)])
+    assert_msa_features_equal(parse_a3m_features(a3m, chunk_size=7), expected)
+    # sequences that span several lines
+    wrapped = "\n".join(
+        line if line.startswith(">") else "\n".join(line[i : i + 13] for i in range(0, len(line), 13))
+        for line in a3m.splitlines()
+    )
+    assert_msa_features_equal(parse_a3m_features(wrapped), expected)
+
+    truncated = parse_a3m_features(a3m, max_seqs=10)
+    assert truncated["msa"].shape == (10, 50)
+    np.testing.assert_array_equal(truncated["msa"], expected["msa"][:10])
+    np.testing.assert_array_equal(truncated["num_alignments"], np.full(50, 10))
+
+    with pytest.raises(ValueError, match="aligned residues"):
+        parse_a3m_features(">101\nAAAA\n>1\nAAA\n")
+    with pytest.raises(ValueError, match="Invalid characters"):
+        parse_a3m_features(">101\nAAAA\n>1\nAA*A\n")
+
+
+def test_parse_a3m_features_memory(tmp_path):
+    a3m_file = tmp_path.joinpath("deep.a3m")
+    a3m_file.write_text(random_a3m(4000, 200))
+
+    tracemalloc.start()
+    try:
+        features = pipeline.make_msa_features([pipeline.parsers.parse_a3m(a3m_file.read_text())])
+        _, parse_a3m_peak = tracemalloc.get_traced_memory()
+        del features
+        tracemalloc.reset_peak()
+        features = parse_a3m_features(a3m_file)
+        _, streaming_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # memory used on top of the returned features
+    output_size = sum(v.nbytes for v in features.values())
+    assert (streaming_peak - output_size) * 2 < parse_a3m_peak - output_size
+
+
+def test_pair_msa():
+    query_seqs_unique = ["AAA", "CC"]
+    query_seqs_cardinality = [2, 1]
+    paired_msa = [">101\nAAA\n>UP1\nAaAV\n", ">102\nCC\n>UP2\nC-k\n"]
+    unpaired_msa = [">101\nAAA\n>UP3\nA-Ak\n", ">102\nCC\n"]
+    assert pair_msa(query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa) == (
+        ">101\t102\nAAAAAACC\n>UP1\tUP2\nAaAVAaAVC-k\n"
+        ">101\nAAA-----\n>UP3\nA-Ak-----\n>101\n---AAA--\n>UP3\n---A-Ak--\n>102\n------CC"
+    )
+
+
+def test_make_complex_msa_features():
+    rng = random.Random(1)
+
+    def chain_msa(query, num_seqs, chain):
+        lines = [f">{101 + chain}", query]
+        for n in range(num_seqs):
+            lines.append(f">tr|A0A{chain}{n:04d}|A0A{chain}{n:04d}_SP{n % 3}" if n % 2 else f">UniRef100_{n}")
+            # insertions, also at the end of the chain, which count as deletions of the next chain
+            lines.append("".join(rng.choice(["A", "C", "-", "X", "aC", "dd-"]) for _ in query) + rng.choice(["", "k"]))
+        return "\n".join(lines) + "\n"
+
+    for query_seqs_unique, query_seqs_cardinality in [(["ACDE", "FG", "HIKLM"], [1, 3, 2]), (["MKV"], [24])]:
+        num_paired = 5
+        paired_msa = [chain_msa(seq, num_paired, n) for n, seq in enumerate(query_seqs_unique)]
+        unpaired_msa = [chain_msa(seq, 2 + n, n) for n, seq in enumerate(query_seqs_unique)]
+        full_sequence = "".join(seq * c for seq, c in zip(query_seqs_unique, query_seqs_cardinality))
+        for paired, unpaired in [(paired_msa, unpaired_msa), (None, unpaired_msa), (paired_msa, None)]:
+            a3m = f">0\n{full_sequence}\n" + pair_msa(
+                query_seqs_unique, query_seqs_cardinality, paired, unpaired
+            )
+            assert_msa_features_equal(
+                make_complex_msa_features(query_seqs_unique, query_seqs_cardinality, paired, unpaired),
+                parse_a3m_features(a3m),
+            )
+
+
+def test_make_complex_msa_features_homooligomer():
+    # monomer models pair a homo-oligomer with an msa per copy, of which only the first is used
+    query_seqs_unique, query_seqs_cardinality = ["MKVL"], [2]
+    paired_msa = [">101\nMKVL\n>UP1\nMK-Lk\n", ">101\nMKVL\n>UP1\nMK-Lk\n"]
+    unpaired_msa = [">101\nMKVL\n>UP2\nMaKVL\n"]
+    for paired in [paired_msa, None]:
+        a3m = ">0\nMKVLMKVL\n" + pair_msa(query_seqs_unique, query_seqs_cardinality, paired, unpaired_msa)
+        assert_msa_features_equal(
+            make_complex_msa_features(query_seqs_unique, query_seqs_cardinality, paired, unpaired_msa),
+            parse_a3m_features(a3m),
+        )
+        # the serialized msa of colabfold_batch, which has every unique chain once
+        a3m = msa_to_str(unpaired_msa, paired, query_seqs_unique, query_seqs_cardinality).split("\n", 1)[1]
+        assert_msa_features_equal(
+            make_complex_msa_features(query_seqs_unique, [1], paired, unpaired_msa),
+            parse_a3m_features(">0\nMKVL\n" + a3m),
+        )
@@ -0,0 +1,249 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from colabfold.batch import background_writer, predict_structure, read_scores, run, write_scores
+
+
+class FakeRunModel:
+    """Returns a fixed prediction with a confidence given by the params, without running a model"""
+
+    def __init__(self):
+        self.params = None
+        self.predicted_params = []
+
+    def process_features(self, feature_dict, random_seed=0):
+        return {k: v[None] for k, v in feature_dict.items()}
+
+    def predict(self, feat, random_seed=0, return_representations=False, callback=None):
+        num_res = feat["aatype"].shape[-1]
+        self.predicted_params.append(self.params)
+        confidence = float(self.params["confidence"])
+        result = {
+            "ranking_confidence": confidence,
+            "mean_plddt": confidence,
+            "ptm": confidence / 100,
+            "plddt": np.full(num_res, confidence),
+            "predicted_aligned_error": np.full((num_res, num_res), 100 - confidence),
+            "structure_module": {
+                "final_atom_positions": np.random.rand(num_res, 37, 3),
+                "final_atom_mask": np.ones((num_res, 37)) * (np.arange(37) < 4),
+            },
+        }
+        if return_representations:
+            result["representations"] = {"single": np.zeros((num_res, 4)), "pair": np.zeros((num_res, num_res, 2))}
+        return result, 0
+
+
+def test_predict_structure_writes_in_background(tmp_path):
+    num_res = 5
+    feature_dict = {"aatype": np.zeros(num_res, dtype=int), "residue_index": np.arange(num_res), "asym_id": np.zeros(num_res)}
+    runner = FakeRunModel()
+    model_runner_and_params = [(f"model_{n}", runner, {"confidence": c}) for n, c in [(1, 70.0), (2, 90.0), (3, 80.0)]]
+
+    results = predict_structure(
+        "job", tmp_path, feature_dict, is_complex=False, use_templates=False, sequences_lengths=[num_res],
+        pad_len=num_res, model_type="alphafold2_ptm", model_runner_and_params=model_runner_and_params,
+        save_single_representations=True, scores_format="both",
+    )
+
+    assert [rank.split("_model_")[1] for rank in results["rank"]] == ["2_seed_000", "3_seed_000", "1_seed_000"]
+    for n, rank in enumerate(results["rank"]):
+        scores = json.loads(tmp_path.joinpath(f"job_scores_{rank}.json").read_text())
+        assert scores["plddt"] == [[90.0, 80.0, 70.0][n]] * num_res
+        assert scores["max_pae"] == [10.0, 20.0, 30.0][n]
+        assert "ATOM" in tmp_path.joinpath(f"job_unrelaxed_{rank}.pdb").read_text()
+        assert tmp_path.joinpath(f"job_single_repr_{rank}.npy").is_file()
+        np.testing.assert_allclose(read_scores(tmp_path.joinpath(f"job_scores_{rank}.npz"))["pae"], scores["pae"])
+    assert sorted(file.name for file in results["result_files"]) == sorted(
+        file.name for file in tmp_path.iterdir())
+
+
+def test_predict_structure_lazy_params(tmp_path):
+    import jax
+
+    from colabfold.alphafold.models import DeviceParams
+
+    num_res = 5
+    feature_dict = {"aatype": np.zeros(num_res, dtype=int), "residue_index": np.arange(num_res), "asym_id": np.zeros(num_res)}
+    runner = FakeRunModel()
+    model_runner_and_params = [
+        (f"model_{n}", runner, {"confidence": np.asarray(c, dtype=np.float32)}) for n, c in [(1, 70.0), (2, 90.0), (3, 80.0)]
+    ]
+    results = predict_structure(
+        "job", tmp_path, feature_dict, is_complex=False, use_templates=False, sequences_lengths=[num_res],
+        pad_len=num_res, model_type="alphafold2_ptm", model_runner_and_params=model_runner_and_params,
+        num_seeds=2, lazy_params=True,
+    )
+    assert len(results["rank"]) == 6
+    # the models run with their params on the device and the runner doesn't keep them there
+    assert all(isinstance(params["confidence"], jax.Array) for params in runner.predicted_params)
+    assert [float(params["confidence"]) for params in runner.predicted_params] == [70.0, 90.0, 80.0] * 2
+    assert isinstance(runner.params["confidence"], np.ndarray)
+
+    device_params = DeviceParams(model_runner_and_params)
+    device_params.get(0, 1)
+    device_params.get(1, 2)
+    assert sorted(device_params._device) == [1, 2]
+    assert device_params.peak_nbytes == 2 * 4
+    device_params.get(2)
+    assert sorted(device_params._device) == [2]
+
+
+
+
+def test_predict_structure_multimer_padding(tmp_path):
+    num_res, num_seq = 7, 6
+    lengths = []
+
+    class FakeMultimerRunModel(FakeRunModel):
+        def predict(self, feat, **kwargs):
+            lengths.append(feat["aatype"].shape[-1])
+            return super().predict(feat, **kwargs)
+
+    for pad_multimer, expected in [(False, num_res), (True, 10)]:
+        feature_dict = {
+            "aatype": np.arange(num_res) % 20,
+            "residue_index": np.arange(num_res),
+            "seq_mask": np.ones(num_res),
+            "asym_id": np.array([1, 1, 1, 1, 2, 2, 2]),
+            "entity_id": np.array([1, 1, 1, 1, 2, 2, 2]),
+            "msa": np.ones((num_seq, num_res), dtype=np.int32),
+            "msa_mask": np.ones((num_seq, num_res)),
+            "num_alignments": np.asarray(num_seq),
+        }
+        lengths.clear()
+        model_runner_and_params = [("model_1", FakeMultimerRunModel(), {"confidence": 80.0})]
+        predict_structure(
+            f"job_{pad_multimer}", tmp_path, feature_dict, is_complex=True, use_templates=False,
+            sequences_lengths=[4, 3], pad_len=10, model_type="alphafold2_multimer_v3",
+            model_runner_and_params=model_runner_and_params, pad_multimer=pad_multimer,
+        )
+        # only padded with length buckets
+        assert lengths == [expected]
+
+
+def test_run_bucket_lengths_query_order(tmp_path):
+    from unittest import mock
+
+    from colabfold.input import get_queries
+
+    # unsorted queries, as with --sort-queries-by none
+    input_file = tmp_path.joinpath("queries.csv")
+    input_file.write_text("id,sequence\nlong,MKVLAAGIVALLLAAGCSSS\nshort,MKVLA\nmedium,MKVLAAGIVA\n")
+    queries, is_complex = get_queries(input_file, sort_queries_by="none")
+    assert [query[0] for query in queries] == ["long", "short", "medium"]
+    predicted = []
+
+    def fake_predict_structure(prefix, result_dir, sequences_lengths, pad_len, **kwargs):
+        predicted.append((prefix, pad_len))
+        rank = f"rank_001_model_1_pad_{pad_len}"
+        result_dir.joinpath(f"{prefix}_scores_{rank}.json").write_text(json.dumps({"plddt": [90.0] * sum(sequences_lengths)}))
+        return {"rank": [rank], "metric": [{"job": prefix}], "result_files": []}
+
+    with mock.patch("colabfold.batch.predict_structure", fake_predict_structure), \
+            mock.patch("colabfold.alphafold.models.load_models_and_params", lambda **kwargs: []):
+        results = run(
+            queries, tmp_path.joinpath("results"), num_models=1, is_complex=is_complex, msa_mode="single_sequence",
+            bucket_lengths=True, bucket_compile_cost=0,
+        )
+    # predicted grouped by length, returned in the order of the queries
+    assert [prefix for prefix, _ in predicted] == ["short", "medium", "long"]
+    assert [metric[0]["job"] for metric in results["metric"]] == ["long", "short", "medium"]
+
+
+def test_run_claimed_job_of_crashed_worker(tmp_path, caplog):
+    from unittest import mock
+
+    from colabfold.input import get_queries
+
+    input_file = tmp_path.joinpath("queries.csv")
+    input_file.write_text("id,sequence\nfirst,MKVLAAGIVA\nsecond,MKVLA\n")
+    queries, is_complex = get_queries(input_file, sort_queries_by="none")
+    result_dir = tmp_path.joinpath("results")
+    result_dir.mkdir()
+    # claimed by another worker, which has its last heartbeat while this one predicts the second job
+    claim = result_dir.joinpath("first.claim")
+    claim.write_text("crashed\n")
+    os.utime(claim, (time.time() + 3600, time.time() + 3600))
+    predicted = []
+
+    def fake_predict_structure(prefix, result_dir, sequences_lengths, pad_len, **kwargs):
+        predicted.append(prefix)
+        if prefix == "second":
+            os.utime(claim, (time.time(), time.time()))
+        result_dir.joinpath(f"{prefix}_scores_rank_001.json").write_text(json.dumps({"plddt": [90.0] * sum(sequences_lengths)}))
+        return {"rank": ["rank_001"], "metric": [{"job": prefix}], "result_files": []}
+
+    with mock.patch("colabfold.batch.predict_structure", fake_predict_structure), \
+            mock.patch("colabfold.alphafold.models.load_models_and_params", lambda **kwargs: []), \
+            caplog.at_level("INFO"):
+        results = run(
+            queries, result_dir, num_models=1, is_complex=is_complex, msa_mode="single_sequence",
+            claim_jobs=True, worker_id="worker", claim_timeout=1,
+        )
+    # skipped in the first pass and taken over once the claim went stale
+    assert predicted == ["second", "first"]
+    assert "Waiting for 1 jobs claimed by other workers" in caplog.text
+    assert [metric[0]["job"] for metric in results["metric"]] == ["first", "second"]
+    assert not claim.exists()
+
+
+def test_background_writer():
+    writer = background_writer(max_workers=1, max_pending=2)
+    release = threading.Event()
+    written = []
+
+    def slow_write(n):
+        release.wait()
+        written.append(n)
+
+    writer.submit(slow_write, 0)
+    writer.submit(slow_write, 1)
+    # a third write waits for a free slot
+    blocked = threading.Thread(target=writer.submit, args=(slow_write, 2))
+    blocked.start()
+    time.sleep(0.1)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    writer.flush()
+    assert written == [0, 1, 2]
+
+    def fail():
+        raise OSError("disk full")
+
+    writer.submit(fail)
+    with pytest.raises(OSError, match="disk full"):
+        writer.close()
+
+
+def test_scores_formats(tmp_path):
+    num_res = 4
+    plddt = np.linspace(50, 90.123, num_res)
+    pae = np.arange(num_res * num_res, dtype=float).reshape(num_res, num_res) / 3
+    conf = {"ptm": 0.8123, "iptm": 0.7, "print_line": ""}
+    extra = {"pairwise_iptm": {"A-B": 0.5}, "actifptm": 0.6}
+    paths = [tmp_path.joinpath("scores.json"), tmp_path.joinpath("scores.npz")]
+    write_scores(paths, plddt, pae, conf, extra)
+
+    from_json = read_scores(paths[0])
+    from_npz = read_scores(paths[1])
+    assert from_json.keys() == from_npz.keys()
+    assert from_npz["pae"].shape == (num_res, num_res)
+    np.testing.assert_allclose(from_npz["pae"], from_json["pae"], atol=0.01)
+    np.testing.assert_allclose(from_npz["plddt"], from_json["plddt"], atol=0.05)
+    # the npz format keeps the full precision of the PAE
+    assert from_npz["pae"].dtype == np.float32
+    np.testing.assert_array_equal(from_npz["pae"], pae.astype(np.float32))
+    assert from_npz["pairwise_iptm"] == {"A-B": 0.5}
+    assert from_npz["ptm"] == pytest.approx(0.8123)
+    assert from_npz["max_pae"] == pytest.approx(pae.max())
+
+    # monomers without pae
+    write_scores([tmp_path.joinpath("plddt.npz")], plddt, None, {}, None)
+    assert read_scores(tmp_path.joinpath("plddt.npz")).keys() == {"plddt"}
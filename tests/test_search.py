@@ -0,0 +1,391 @@
+import csv
+import json
+import subprocess
+import sys
+import logging
+import math
+import multiprocessing
+import threading
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from colabfold.mmseqs import search
+from colabfold.mmseqs.db import MmseqsDb, SearchResultDb, fan_out_db
+from colabfold.mmseqs.manifest import MANIFEST_NAME, SearchManifest
+from colabfold.mmseqs.search import (
+    init_shard_process,
+    mmseqs_search_monomer,
+    mmseqs_search_pair,
+    run_mmseqs,
+    run_shards,
+    run_stages,
+    search_incremental,
+    search_queries,
+    shard_queries,
+)
+from tests.test_split_msas import write_db
+
+
+def test_shard_queries():
+    lengths = [100, 90, 80, 50, 40, 30, 20, 10, 5]
+    queries_unique = [(f"job{n}", ["A" * length], [1], None) for n, length in enumerate(lengths)]
+    shards = shard_queries(queries_unique, 3)
+    assert sorted(job for shard in shards for job in shard) == list(range(len(lengths)))
+    loads = [sum(lengths[job] for job in shard) for shard in shards]
+    # longest processing time first is within 4/3 of the optimal makespan
+    assert sorted(loads) == [135, 140, 150]
+    assert max(loads) <= sum(lengths) / 3 * 4 / 3
+    assert shard_queries(queries_unique[:2], 3)[2] == []
+
+
+def test_init_shard_process():
+    # the shard processes log at the level of the parent
+    with ProcessPoolExecutor(
+        1, mp_context=multiprocessing.get_context("spawn"), initializer=init_shard_process, initargs=(logging.INFO,)
+    ) as executor:
+        assert executor.submit(logging.getLogger().getEffectiveLevel).result() == logging.INFO
+        assert executor.submit(logging.getLogger().hasHandlers).result()
+
+
+def mock_search_queries(args, queries_unique, base, is_complex, unpack, threads):
+    # writes the databases of colabfold_search --unpack 0, the MSA of every query is its sequence
+    base.mkdir(parents=True, exist_ok=True)
+    seqs = [seq for _, query_sequences, _, _ in queries_unique for seq in query_sequences]
+    lookup, cardinality = [], []
+    for file_number, (raw_jobname, query_sequences, query_seqs_cardinality, _) in enumerate(queries_unique):
+        for count in query_seqs_cardinality:
+            lookup.append(f"{len(lookup)}\t{raw_jobname.split()[0]}\t{file_number}\n")
+            cardinality.append(f"{len(cardinality)}\t{count}\n")
+    base.joinpath("qdb.lookup").write_text("".join(lookup))
+    base.joinpath("qdb.cardinality").write_text("".join(cardinality))
+    write_db(base.joinpath("qdb"), [f"{seq}\n" for seq in seqs])
+    write_db(base.joinpath("final.a3m"), [f">101\n{seq}\n>UP\n{seq.lower()}{seq}\n" for seq in seqs])
+    write_db(base.joinpath("pdb100"), [f"101\t{seq}_A\t1.0\n" for seq in seqs])
+
+
+def test_run_shards(tmp_path):
+    queries_unique = [
+        ("mono 1", ["MKV"], [1], None),
+        ("dimer", ["GGA", "CCWW"], [1, 1], None),
+        ("trimer", ["YYDPE"], [3], None),
+        ("mono 2", ["MKVLA"], [1], None),
+    ]
+    args = Namespace(
+        base=tmp_path, shards=3, shard_processes=1, shard_index=None, merge_shards=False,
+        print_shard_commands=False, af3_json=False, threads=4, db2="pdb100", use_templates=True, unpack=0,
+    )
+    with mock.patch.object(search, "search_queries", mock_search_queries):
+        run_shards(args, None, queries_unique, True)
+
+    assert not any(tmp_path.glob("shard_*"))
+    queries = SearchResultDb(tmp_path).get_queries()
+    assert [(name, seqs) for name, seqs, _, _ in queries] == [
+        ("mono", "MKV"),
+        ("dimer", ["GGA", "CCWW"]),
+        ("trimer", ["YYDPE"] * 3),
+        ("mono", "MKVLA"),
+    ]
+    assert queries[3][2][0] == ">101\nMKVLA\n>UP\nmkvlaMKVLA\n"
+
+    # one shard per scheduler job, then merge and unpack
+    args.base = tmp_path.joinpath("scheduler")
+    args.unpack = 1
+    with mock.patch.object(search, "search_queries", mock_search_queries):
+        for shard in range(3):
+            args.shard_index = shard
+            run_shards(args, None, queries_unique, True)
+        args.shard_index = None
+        args.merge_shards = True
+        run_shards(args, None, queries_unique, True)
+    assert sorted(path.name for path in args.base.iterdir()) == [
+        "dimer.a3m", "dimer_pdb100.m8", "mono_1.a3m", "mono_1_pdb100.m8", "mono_2.a3m",
+        "mono_2_pdb100.m8", "qdb.cardinality", "trimer.a3m", "trimer_pdb100.m8",
+    ]
+    assert args.base.joinpath("dimer_pdb100.m8").read_text() == "101\tGGA_A\t1.0\n101\tCCWW_A\t1.0\n"
+    assert args.base.joinpath("mono_2.a3m").read_text() == ">101\nMKVLA\n>UP\nmkvlaMKVLA\n"
+
+
+def test_run_stages():
+    calls = []
+    both_running = threading.Barrier(2, timeout=10)
+
+    def stage(name, fail=False, wait=False):
+        def run(threads):
+            calls.append((name, threads))
+            if wait:
+                # only passes if the other independent stage runs at the same time
+                both_running.wait()
+            if fail:
+                raise RuntimeError(f"{name} failed")
+        return run
+
+    run_stages(
+        {
+            "uniref": (stage("uniref"), [], 1.0),
+            "env": (stage("env", wait=True), ["uniref"], 3.0),
+            "templates": (stage("templates", wait=True), ["uniref"], 1.0),
+        },
+        threads=8,
+    )
+    assert calls[0] == ("uniref", 8)
+    assert sorted(calls[1:]) == [("env", 6), ("templates", 2)]
+
+    # a failing stage skips its dependents, but independent stages still complete
+    calls.clear()
+    try:
+        run_stages(
+            {
+                "uniref": (stage("uniref"), [], 1.0),
+                "env": (stage("env", fail=True), ["uniref"], 1.0),
+                "merge": (stage("merge"), ["env"], 1.0),
+                "templates": (stage("templates"), ["uniref"], 1.0),
+            },
+            threads=2,
+            parallel=False,
+        )
+        assert False, "expected the env stage to fail"
+    except RuntimeError as e:
+        assert str(e) == "env failed"
+    assert calls == [("uniref", 2), ("env", 2), ("templates", 2)]
+
+
+def test_mmseqs_search_monomer_stages(tmp_path):
+    dbbase = tmp_path.joinpath("db")
+    dbbase.mkdir()
+    for db in ["uniref", "env", "pdb"]:
+        dbbase.joinpath(f"{db}.dbtype").write_bytes(bytes(4))
+    commands = []
+
+    def run_mmseqs(mmseqs, params):
+        commands.append((params[0], threading.current_thread().name))
+        if params[0] == "search" and "pdb" in str(params[2]):
+            raise RuntimeError("template search failed")
+
+    with mock.patch.object(search, "run_mmseqs", run_mmseqs):
+        try:
+            mmseqs_search_monomer(
+                dbbase, tmp_path, uniref_db="uniref", metagenomic_db="env", template_db="pdb",
+                use_templates=True, threads=4,
+            )
+            assert False, "expected the template search to fail"
+        except RuntimeError:
+            pass
+    # the env search completed although the template search failed, nothing got merged
+    assert ("result2msa", threading.current_thread().name) in commands
+    assert sum(command == "result2msa" for command, _ in commands) == 2
+    assert not any(command == "mergedbs" for command, _ in commands)
+
+
+def test_search_manifest(tmp_path, capsys):
+    commands = []
+
+    def run(params):
+        commands.append(" ".join(params))
+        if params[0] == "fail":
+            raise RuntimeError("interrupted")
+
+    def search(align="align", fail=False, dry_run=False):
+        manifest = SearchManifest(tmp_path.joinpath(MANIFEST_NAME), run, dry_run=dry_run)
+        with manifest.stage("querydb", inputs={"query.fas": "hash"}) as stage:
+            stage.run(["createdb", "query.fas", "qdb"])
+        with manifest.stage("uniref", ["querydb"]) as stage:
+            stage.run(["search", "qdb", "uniref", "res", "--threads", "4"])
+            stage.run([align, "qdb", "res", "aln"])
+            if fail:
+                stage.run(["fail"])
+            stage.run(["result2msa", "qdb", "aln", "uniref.a3m"])
+        with manifest.stage("merge", ["uniref"]) as stage:
+            stage.run(["mvdb", "uniref.a3m", "final.a3m"])
+
+    try:
+        search(fail=True)
+        assert False, "expected the search to be interrupted"
+    except RuntimeError:
+        pass
+    assert commands == ["createdb query.fas qdb", "search qdb uniref res --threads 4", "align qdb res aln", "fail"]
+
+    # resumes after the last completed command
+    commands.clear()
+    search()
+    assert commands == ["result2msa qdb aln uniref.a3m", "mvdb uniref.a3m final.a3m"]
+    commands.clear()
+    search()
+    assert commands == []
+
+    # a changed parameter reruns the command and everything downstream of it
+    search(align="align2", dry_run=True)
+    assert commands == []
+    assert capsys.readouterr().out == (
+        "querydb:\n"
+        "  done  createdb query.fas qdb\n"
+        "uniref:\n"
+        "  done  search qdb uniref res --threads 4\n"
+        "  run   align2 qdb res aln\n"
+        "  run   result2msa qdb aln uniref.a3m\n"
+        "merge:\n"
+        "  run   mvdb uniref.a3m final.a3m\n"
+    )
+    search(align="align2")
+    assert commands == ["align2 qdb res aln", "result2msa qdb aln uniref.a3m", "mvdb uniref.a3m final.a3m"]
+
+    manifest = SearchManifest(tmp_path.joinpath(MANIFEST_NAME), run)
+    assert manifest.stages["uniref"]["complete"]
+    assert [step["command"] for step in manifest.stages["merge"]["steps"]] == ["mvdb uniref.a3m final.a3m"]
+
+
+def test_mmseqs_search_pair_resume(tmp_path):
+    dbbase = tmp_path.joinpath("db")
+    dbbase.mkdir()
+    dbbase.joinpath("uniref.dbtype").write_bytes(bytes(4))
+    commands = []
+    interrupt = [True]
+
+    def run_mmseqs(mmseqs, params):
+        if params[0] == "pairaln" and interrupt[0]:
+            raise RuntimeError("preempted")
+        commands.append(params[0])
+
+    with mock.patch.object(search, "run_mmseqs", run_mmseqs):
+        try:
+            mmseqs_search_pair(dbbase, tmp_path, uniref_db="uniref", pair_env=False, threads=4)
+            assert False, "expected the pair search to be interrupted"
+        except RuntimeError:
+            pass
+        assert commands == ["search", "mvdb", "lndb", "expandaln", "align"]
+
+        # a rerun with fewer threads continues with the pairing
+        commands.clear()
+        interrupt[0] = False
+        mmseqs_search_pair(dbbase, tmp_path, uniref_db="uniref", pair_env=False, threads=2)
+        assert commands[:4] == ["pairaln", "align", "pairaln", "result2msa"]
+        assert "search" not in commands
+
+
+def test_run_mmseqs_usage(tmp_path):
+    # any executable works, the usage is of the child process only
+    usage = run_mmseqs(sys.executable, ["-c", "x = bytearray(64 * 1024 * 1024); sum(range(10 ** 6))"])
+    assert set(usage) == {"wall_time", "cpu_time", "max_rss", "bytes_written"}
+    assert usage["max_rss"] >= 64 * 1024 * 1024
+    assert 0 < usage["cpu_time"] and 0 < usage["wall_time"]
+    try:
+        run_mmseqs(sys.executable, ["-c", "raise SystemExit(3)"])
+        assert False, "expected the command to fail"
+    except subprocess.CalledProcessError as e:
+        assert e.returncode == 3
+
+
+def test_search_profile(tmp_path):
+    def run(params):
+        return {"wall_time": 1.0, "cpu_time": float(params[1]), "max_rss": int(params[2]), "bytes_written": 100}
+
+    manifest = SearchManifest(tmp_path.joinpath(MANIFEST_NAME), run)
+    with manifest.stage("uniref") as stage:
+        stage.run(["search", "4", "1000"])
+        stage.run(["align", "2", "3000"])
+        stage.call("rmtree tmp", lambda: None)
+    with manifest.stage("env", ["uniref"]) as stage:
+        stage.run(["search", "8", "500"])
+    manifest.write_profile(tmp_path, settings={"s": 7.5})
+
+    profile = json.loads(tmp_path.joinpath("search_profile.json").read_text())
+    assert profile["settings"] == {"s": 7.5}
+    uniref = profile["stages"]["uniref"]
+    assert (uniref["cpu_time"], uniref["max_rss"], uniref["bytes_written"]) == (6.0, 3000, 200)
+    assert [command["command"] for command in uniref["commands"]] == ["search 4 1000", "align 2 3000"]
+    with tmp_path.joinpath("search_profile.csv").open() as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["stage", "commands", "wall_time", "cpu_time", "max_rss", "bytes_written"]
+    assert [row[:2] + row[3:] for row in rows[1:]] == [
+        ["uniref", "2", "6.0", "3000", "200"],
+        ["env", "1", "8.0", "500", "100"],
+    ]
+
+
+def test_search_incremental(tmp_path):
+    args = Namespace(base=tmp_path, threads=4, db2="pdb100", use_templates=True, dry_run=False)
+    searched = []
+
+    def search_queries(args, queries_unique, base, is_complex, unpack, threads):
+        searched.append([raw_jobname for raw_jobname, _, _, _ in queries_unique])
+        mock_search_queries(args, queries_unique, base, is_complex, unpack, threads)
+
+    with mock.patch.object(search, "search_queries", search_queries):
+        search_incremental(args, [("mono", ["MKV"], [1], None), ("dimer", ["GGA", "CCWW"], [1, 1], None)], True)
+        search_incremental(
+            args,
+            [
+                ("renamed", ["MKV"], [1], None),
+                ("dimer", ["GGA", "CCWW"], [1, 1], None),
+                ("homodimer", ["GGA"], [2], None),
+                ("new", ["YYDPE"], [1], None),
+                ("new again", ["YYDPE"], [1], None),
+            ],
+            True,
+        )
+    assert searched == [["mono", "dimer"], ["homodimer", "new"]]
+    assert not tmp_path.joinpath("incremental").exists()
+
+    result = SearchResultDb(tmp_path)
+    queries = result.get_queries()
+    assert [(name, seqs) for name, seqs, _, _ in queries] == [
+        ("mono", "MKV"),
+        ("dimer", ["GGA", "CCWW"]),
+        ("homodimer", ["GGA", "GGA"]),
+        ("new", "YYDPE"),
+    ]
+    assert queries[3][2][0] == ">101\nYYDPE\n>UP\nyydpeYYDPE\n"
+    assert queries[3][2].ids == [4]
+    assert MmseqsDb(tmp_path.joinpath("pdb100"))[4] == "101\tYYDPE_A\t1.0\n"
+    result.close()
+
+
+def test_fan_out_db(tmp_path):
+    write_db(tmp_path.joinpath("final.a3m.unique"), [">101\nMKV\n", ">102\nGGA\n", ">101\nYY\n"])
+    fan_out_db(tmp_path.joinpath("final.a3m.unique"), tmp_path.joinpath("final.a3m"), [0, 1, 0, 1, 2])
+    assert not tmp_path.joinpath("final.a3m.unique").exists()
+    db = MmseqsDb(tmp_path.joinpath("final.a3m"))
+    assert [db[key] for key in db.keys()] == [">101\nMKV\n", ">102\nGGA\n", ">101\nMKV\n", ">102\nGGA\n", ">101\nYY\n"]
+    # the chains share the entries of their sequence
+    assert tmp_path.joinpath("final.a3m").stat().st_size == len(">101\nMKV\n>102\nGGA\n>101\nYY\n") + 3
+    db.close()
+    # done already, e.g. when resuming a search
+    fan_out_db(tmp_path.joinpath("final.a3m.unique"), tmp_path.joinpath("final.a3m"), [0, 0, 0, 0, 0])
+    assert MmseqsDb(tmp_path.joinpath("final.a3m"))[4] == ">101\nYY\n"
+
+
+def test_search_queries_unique_sequences(tmp_path):
+    dbbase = tmp_path.joinpath("db")
+    dbbase.mkdir()
+    for db in ["uniref", "env"]:
+        dbbase.joinpath(f"{db}.dbtype").write_bytes(bytes(4))
+    args = Namespace(
+        mmseqs="mmseqs", dbbase=dbbase, db1="uniref", db2="", db3="env", db4="spire", use_env=1, use_templates=0,
+        filter=1, expand_eval=math.inf, align_eval=10, diff=3000, qsc=-20.0, max_accept=1000000, prefilter_mode=0,
+        s=8, db_load_mode=0, gpu=0, gpu_server=0, parallel_stages=1, pairing_strategy=0, use_env_pairing=0,
+        dry_run=False,
+    )
+    commands = []
+    fasta = {}
+
+    def run_mmseqs(mmseqs, params):
+        commands.append([str(param) for param in params[:3]])
+        if params[0] == "createdb":
+            fasta[params[2].name] = params[1].read_text()
+
+    queries_unique = [
+        ("a", ["MKV", "GGA"], [1, 1], None),
+        ("b", ["MKV"], [2], None),
+        ("c", ["GGA", "YY"], [1, 1], None),
+    ]
+    with mock.patch.object(search, "run_mmseqs", run_mmseqs):
+        search_queries(args, queries_unique, tmp_path.joinpath("out"), True, False, 4)
+
+    out = tmp_path.joinpath("out")
+    assert fasta["qdb"] == ">101\nMKV\n>102\nGGA\n>101\nMKV\n>101\nGGA\n>102\nYY\n"
+    assert fasta["qdb_unique"] == ">101\nMKV\n>102\nGGA\n>102\nYY\n"
+    searches = [command[1] for command in commands if command[0] == "search"]
+    # the unpaired uniref and env searches use the unique sequences, the pairing every chain of every job
+    assert searches == [str(out.joinpath("qdb_unique")), str(out.joinpath("prof_res")), str(out.joinpath("qdb"))]
+    assert ["rmdb", str(out.joinpath("qdb_unique"))] in commands
+    assert not out.joinpath("query.unique.fas").exists()
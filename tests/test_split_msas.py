@@ -0,0 +1,43 @@
+import tarfile
+import zipfile
+
+from colabfold.mmseqs.split_msas import split_msa_db
+
+
+def write_db(db, msas):
+    # an MMseqs2 database: null terminated entries and a key, offset, length index, not in file order
+    offset = 0
+    index = []
+    with db.open("wb") as f:
+        for key, msa in enumerate(msas):
+            data = msa.encode() + b"\0"
+            f.write(data)
+            index.append(f"{key}\t{offset}\t{len(data)}\n")
+            offset += len(data)
+    db.with_name(db.name + ".index").write_text("".join(reversed(index)))
+    db.with_name(db.name + ".dbtype").write_bytes(bytes(4))
+
+
+def test_split_msa_db(tmp_path):
+    msas = {
+        f"{filename}.a3m": f">{name} query\nMKV{n}\n>UniRef100_A{n}\tscore\nMKVA\n>tr|B/2\nM-va\n"
+        for n, (name, filename) in enumerate([("101", "101"), ("job/2", "job_2"), ("other", "other")])
+    }
+    final_a3m = tmp_path.joinpath("final.a3m")
+    # empty entries are skipped
+    write_db(final_a3m, [msas["101.a3m"], "", msas["job_2.a3m"], msas["other.a3m"]])
+
+    for threads in [1, 2]:
+        output = tmp_path.joinpath(f"threads_{threads}")
+        split_msa_db(final_a3m, output, threads=threads, chunk_size=2)
+        split = {path.name: path.read_text() for path in output.iterdir()}
+        assert split == msas
+
+    split_msa_db(final_a3m, tmp_path.joinpath("msas.zip"))
+    with zipfile.ZipFile(tmp_path.joinpath("msas.zip")) as zip_file:
+        assert {name: zip_file.read(name).decode() for name in zip_file.namelist()} == split
+    split_msa_db(final_a3m, tmp_path.joinpath("msas.tar.gz"))
+    with tarfile.open(tmp_path.joinpath("msas.tar.gz")) as tar_file:
+        assert {
+            member.name: tar_file.extractfile(member).read().decode() for member in tar_file
+        } == split
@@ -1,6 +1,10 @@
+import random
+
 import pytest
 
-from colabfold.batch import get_queries, convert_pdb_to_mmcif, validate_and_fix_mmcif
+from colabfold.batch import get_queries, convert_pdb_to_mmcif, validate_and_fix_mmcif, unserialize_msa
+from colabfold.input import is_complex_query, iter_fasta, iter_queries, msa_to_str, parse_fasta, stream_queries
+from tests.test_split_msas import write_db
 
 
 def test_get_queries_fasta_dir(pytestconfig, caplog):
@@ -17,6 +21,39 @@ def test_get_queries_empty_a3m(pytestconfig, caplog):
     assert caplog.messages == []
 
 
+def test_get_queries_mmseqs_db(tmp_path):
+    # colabfold_search --unpack 0 output of a monomer, a heterodimer and a homotrimer
+    seqs = ["MKV", "GGA", "CCW", "YYDPE"]
+    lookup = [(0, "mono", 0), (1, "dimer", 1), (2, "dimer", 1), (3, "trimer", 2)]
+    tmp_path.joinpath("qdb.lookup").write_text("".join(f"{i}\t{n}\t{f}\n" for i, n, f in lookup))
+    tmp_path.joinpath("qdb.cardinality").write_text("0\t1\n1\t1\n2\t1\n3\t3\n")
+    write_db(tmp_path.joinpath("qdb"), [f"{seq}\n" for seq in seqs])
+    unpaired = [f">101\n{seq}\n>UP{i}\n{seq[:-1]}a-\n" for i, seq in enumerate(seqs)]
+    unpaired[2] = ">102\nCCW\n>UP2\nC-W\n"
+    write_db(tmp_path.joinpath("final.a3m"), unpaired)
+    paired = ["", ">101\nGGA\n>P1\nGG-\n", ">102\nCCW\n>P2\nCCW\n", ""]
+    write_db(tmp_path.joinpath("pair.a3m"), paired)
+
+    for input_path in [tmp_path, tmp_path.joinpath("final.a3m")]:
+        queries, is_complex = get_queries(input_path, sort_queries_by="none")
+        assert is_complex
+        assert [(name, seq) for name, seq, _, _ in queries] == [
+            ("mono", "MKV"),
+            ("dimer", ["GGA", "CCW"]),
+            ("trimer", ["YYDPE"] * 3),
+        ]
+        assert queries[0][2][0] == unpaired[0]
+        assert queries[1][2][0] == msa_to_str(unpaired[1:3], paired[1:3], ["GGA", "CCW"], [1, 1])
+        assert queries[2][2][0] == msa_to_str(unpaired[3:], None, ["YYDPE"], [3])
+
+        unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, _ = unserialize_msa(
+            queries[1][2], queries[1][1]
+        )
+        assert unpaired_msa == unpaired[1:3]
+        assert paired_msa == paired[1:3]
+        assert query_seqs_cardinality == [1, 1]
+
+
 def test_get_queries_csv(pytestconfig, caplog, tmp_path):
     queries, is_complex = get_queries(
         pytestconfig.rootpath.joinpath("test-data/complex/input.csv")
@@ -138,3 +175,26 @@ def test_convert_pdb_to_mmcif_parse_with_alphafold(pytestconfig, tmp_path):
     )
 
     assert len(parsing_result.errors) == 0
+
+
+def test_stream_queries(tmp_path):
+    rng = random.Random(0)
+    records = []
+    for n in range(50):
+        chains = ["".join(rng.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(rng.randint(1, 30))) for _ in range(rng.randint(1, 2))]
+        records.append(f">job{n}\n{':'.join(chains).lower()}\n")
+    fasta = tmp_path.joinpath("queries.fasta")
+    fasta.write_text("".join(records))
+
+    queries, is_complex = get_queries(fasta)
+    # sorted chunks of 7 queries spilled to disk and merged give the same stable sort
+    streamed = list(stream_queries(fasta, "length", chunk_size=7))
+    assert streamed == queries
+    assert list(stream_queries(fasta, None, chunk_size=7)) == list(iter_queries(fasta))
+    shuffled = list(stream_queries(fasta, "random", chunk_size=7))
+    assert sorted(shuffled) == sorted(queries)
+    assert is_complex == any(is_complex_query(query[1], query[2]) for query in streamed)
+
+    sequences, descriptions = parse_fasta(fasta.read_text())
+    with fasta.open() as f:
+        assert list(iter_fasta(f)) == list(zip(descriptions, sequences))